@@ -0,0 +1,141 @@
+"""Time series of the experiencias of a menu or a category.
+
+Counts per emocion_resultante and mean valence/arousal come from the daily
+rollups (app.rollups), so they cover the days app.retention already dropped.
+Percentiles need the raw experiencias and are ranked with window functions
+in the database, they are None for buckets whose experiencias were dropped.
+"""
+from sqlalchemy import Date, case, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from .models import DbMenu, DbExperiencia, DbExperienciaDiaria
+
+
+# Length in days of each bucket, to bound how many a window holds
+PERIODOS = {"dia": 1, "semana": 7, "mes": 30}
+PERCENTILES = (25, 50, 75)
+
+
+class date_bucket(FunctionElement):
+    """First day of the bucket (dia, semana starting on monday or mes) of a
+    date column."""
+    type = Date()
+    inherit_cache = False
+
+    def __init__(self, column, periodo):
+        self.periodo = periodo
+        super().__init__(column)
+
+
+@compiles(date_bucket)
+def date_bucket_sqlite(element, compiler, **kw):
+    column = compiler.process(element.clauses, **kw)
+    if element.periodo == "semana":
+        return f"date({column}, 'weekday 0', '-6 days')"
+    if element.periodo == "mes":
+        return f"date({column}, 'start of month')"
+    return column
+
+
+@compiles(date_bucket, "postgresql")
+def date_bucket_postgresql(element, compiler, **kw):
+    column = compiler.process(element.clauses, **kw)
+    if element.periodo == "semana":
+        return f"CAST(date_trunc('week', {column}) AS DATE)"
+    if element.periodo == "mes":
+        return f"CAST(date_trunc('month', {column}) AS DATE)"
+    return column
+
+
+def menu_filter(menu_id_column, menu_id, categoria_id):
+    if menu_id is not None:
+        return menu_id_column == menu_id
+    return menu_id_column.in_(select(DbMenu.id).filter(DbMenu.categoria_id == categoria_id))
+
+
+async def bucket_totals(db, periodo, desde, hasta, menu_id, categoria_id):
+    # {inicio: {emocion: (count, valencia_total, arousal_total)}} from the rollups
+    bucket = date_bucket(DbExperienciaDiaria.fecha, periodo)
+    rows = await db.execute(
+        select(
+            bucket,
+            DbExperienciaDiaria.emocion_resultante,
+            func.sum(DbExperienciaDiaria.numero_experiencias),
+            func.sum(DbExperienciaDiaria.valencia_total),
+            func.sum(DbExperienciaDiaria.arousal_total)
+        )
+        .filter(
+            menu_filter(DbExperienciaDiaria.menu_id, menu_id, categoria_id),
+            DbExperienciaDiaria.fecha.between(desde, hasta)
+        )
+        .group_by(bucket, DbExperienciaDiaria.emocion_resultante)
+    )
+
+    totales = {}
+    for inicio, emocion, count, valencia_total, arousal_total in rows:
+        totales.setdefault(inicio, {})[emocion] = (count, valencia_total, arousal_total)
+    return totales
+
+
+async def bucket_percentiles(db, periodo, desde, hasta, menu_id, categoria_id):
+    """{inicio: {"valencia": {p25: ..}, "arousal": {..}}}, nearest rank
+    percentiles of the kept experiencias of every bucket."""
+    bucket = date_bucket(DbExperiencia.fecha, periodo)
+    ranked = (
+        select(
+            bucket.label("inicio"),
+            DbExperiencia.valencia_resultante.label("valencia"),
+            DbExperiencia.arousal_resultante.label("arousal"),
+            func.row_number().over(partition_by=bucket, order_by=DbExperiencia.valencia_resultante).label("rango_valencia"),
+            func.row_number().over(partition_by=bucket, order_by=DbExperiencia.arousal_resultante).label("rango_arousal"),
+            func.count().over(partition_by=bucket).label("total")
+        )
+        .filter(
+            menu_filter(DbExperiencia.menu_id, menu_id, categoria_id),
+            DbExperiencia.fecha.between(desde, hasta),
+            DbExperiencia.valencia_resultante.isnot(None), DbExperiencia.arousal_resultante.isnot(None)
+        )
+        .subquery()
+    )
+
+    columns = []
+    for percentil in PERCENTILES:
+        # Rank ceil(total * percentil / 100) in integer arithmetic
+        rango = (ranked.c.total * percentil + 99) // 100
+        columns.append(func.max(case((ranked.c.rango_valencia == rango, ranked.c.valencia))))
+        columns.append(func.max(case((ranked.c.rango_arousal == rango, ranked.c.arousal))))
+
+    rows = await db.execute(select(ranked.c.inicio, *columns).group_by(ranked.c.inicio))
+
+    percentiles = {}
+    for inicio, *values in rows:
+        percentiles[inicio] = {
+            "valencia": {f"p{p}": values[2 * i] for i, p in enumerate(PERCENTILES)},
+            "arousal": {f"p{p}": values[2 * i + 1] for i, p in enumerate(PERCENTILES)}
+        }
+    return percentiles
+
+
+async def trend_series(db, periodo, desde, hasta, menu_id=None, categoria_id=None):
+    """One point per bucket with experiencias between `desde` and `hasta`,
+    oldest first, for a menu or every menu of a category. Dates are ISO
+    strings so the series can be cached as is."""
+    totales = await bucket_totals(db, periodo, desde, hasta, menu_id, categoria_id)
+    percentiles = await bucket_percentiles(db, periodo, desde, hasta, menu_id, categoria_id)
+
+    series = []
+    for inicio in sorted(totales):
+        emociones = totales[inicio]
+        count = sum(c for c, _, _ in emociones.values())
+        kept = percentiles.get(inicio, {})
+        series.append({
+            "inicio": inicio.isoformat(),
+            "numero_experiencias": count,
+            "emociones": {emocion: c for emocion, (c, _, _) in sorted(emociones.items())},
+            "valencia_media": sum(v for _, v, _ in emociones.values()) / count,
+            "arousal_media": sum(a for _, _, a in emociones.values()) / count,
+            "valencia_percentiles": kept.get("valencia"),
+            "arousal_percentiles": kept.get("arousal")
+        })
+    return series
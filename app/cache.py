@@ -0,0 +1,266 @@
+"""Read-through cache for the menu and category lookups.
+
+Entries live in an in-process LRU with a TTL by default. Setting CACHE_URL to
+a redis:// url shares them between workers instead (needs the `redis`
+package). Values must be JSON serializable so any backend can store them.
+
+Every key has a generation, bumped when it is invalidated. A load records
+the generations of its keys before reading the database and its values are
+only stored if they have not changed, so a load that read a row before an
+invalidation cannot put the old row back after it.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_URL = os.getenv("CACHE_URL")
+
+MISSING = object()
+# Key of the redis epoch in the generations of a load
+EPOCH = object()
+# Seconds a redis generation is kept after its key is invalidated
+GENERATION_TTL = 3600
+
+
+class MemoryBackend:
+    """LRU of at most `max_entries` entries that expire `ttl` seconds after
+    being set."""
+
+    name = "memory"
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Generation of the invalidated keys, from one counter. A key evicted from
+        # here, or never invalidated, has `floor`, the highest generation evicted,
+        # so a generation never goes back to a value a load may have recorded
+        self.generations = OrderedDict()
+        self.counter = itertools.count(1)
+        self.floor = 0
+        # Also used from the threadpool by the sync handlers and jobs
+        self.lock = threading.Lock()
+
+    async def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                return MISSING
+
+            self.entries.move_to_end(key)
+            return value
+
+    async def get_many(self, keys):
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def set_many(self, values, ttl=None, generations=None):
+        # With `generations`, only the keys whose generation is still the one given
+        with self.lock:
+            if generations is not None:
+                values = {key: value for key, value in values.items()
+                          if self.generations.get(key, self.floor) == generations[key]}
+        for key, value in values.items():
+            await self.set(key, value, ttl)
+
+    async def get_generations(self, keys):
+        with self.lock:
+            return {key: self.generations.get(key, self.floor) for key in keys}
+
+    async def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.generations[key] = next(self.counter)
+                self.generations.move_to_end(key)
+            while len(self.generations) > self.max_entries:
+                _, generation = self.generations.popitem(last=False)
+                self.floor = max(self.floor, generation)
+
+    async def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+            self.floor = next(self.counter)
+
+    def size(self):
+        return len(self.entries)
+
+
+# Sets the keys of KEYS, in (key, generation key) pairs with the epoch key
+# last, whose generation is still the one given. ARGV holds the epoch and the
+# ttl, then a (generation, value) pair per key, an empty generation for none
+SET_IF_GENERATION = """
+if (redis.call('GET', KEYS[#KEYS]) or '') ~= ARGV[1] then return 0 end
+local set = 0
+for i = 1, (#KEYS - 1) / 2 do
+    if (redis.call('GET', KEYS[2 * i]) or '') == ARGV[2 * i + 1] then
+        redis.call('SET', KEYS[2 * i - 1], ARGV[2 * i + 2], 'EX', ARGV[2])
+        set = set + 1
+    end
+end
+return set
+"""
+
+
+class RedisBackend:
+    """Shared store for several workers, keys are prefixed so clear() only
+    drops this service's entries. The generation of a key is kept under
+    `gen:<key>`, and clear() bumps an epoch all loads compare too."""
+
+    name = "redis"
+
+    def __init__(self, url, ttl=CACHE_TTL, prefix="ms-menus:"):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.epoch_key = prefix + "epoch"
+        self.set_if_generation = self.client.register_script(SET_IF_GENERATION)
+
+    def generation_key(self, key):
+        return self.prefix + "gen:" + key
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        return MISSING if raw is None else json.loads(raw)
+
+    async def get_many(self, keys):
+        # One round trip for all of them
+        raws = await self.client.mget([self.prefix + key for key in keys]) if keys else []
+        return [MISSING if raw is None else json.loads(raw) for raw in raws]
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.prefix + key, json.dumps(value), ex=max(1, round(self.ttl if ttl is None else ttl)))
+
+    async def set_many(self, values, ttl=None, generations=None):
+        expires = max(1, round(self.ttl if ttl is None else ttl))
+        if generations is not None:
+            # Compared and set in one script, so an invalidation cannot fall in between
+            keys, args = [], [generations[EPOCH], expires]
+            for key, value in values.items():
+                keys += [self.prefix + key, self.generation_key(key)]
+                args += [generations[key], json.dumps(value)]
+            await self.set_if_generation(keys=keys + [self.epoch_key], args=args)
+            return
+
+        async with self.client.pipeline(transaction=False) as pipeline:
+            for key, value in values.items():
+                pipeline.set(self.prefix + key, json.dumps(value), ex=expires)
+            await pipeline.execute()
+
+    async def get_generations(self, keys):
+        raws = await self.client.mget([self.generation_key(key) for key in keys] + [self.epoch_key])
+        generations = {key: (raw or b"").decode() for key, raw in zip(keys, raws)}
+        generations[EPOCH] = (raws[-1] or b"").decode()
+        return generations
+
+    async def delete(self, *keys):
+        if keys:
+            async with self.client.pipeline(transaction=True) as pipeline:
+                pipeline.delete(*[self.prefix + key for key in keys])
+                for key in keys:
+                    # Outlives any load that could have recorded the previous generation
+                    pipeline.incr(self.generation_key(key))
+                    pipeline.expire(self.generation_key(key), max(GENERATION_TTL, round(self.ttl)))
+                await pipeline.execute()
+
+    async def clear(self):
+        await self.client.incr(self.epoch_key)
+        keys = [key async for key in self.client.scan_iter(match=self.prefix + "*") if key != self.epoch_key.encode()]
+        if keys:
+            await self.client.delete(*keys)
+
+    def size(self):
+        return None
+
+
+class Cache:
+    """Counts hits and misses per namespace, the part of the key before the
+    first ':' (menu:12 -> menu)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = Counter()
+        self.misses = Counter()
+
+    async def get_or_load(self, key, loader, ttl=None):
+        # `loader` is awaited on a miss, None results are not cached
+        namespace = key.split(":", 1)[0]
+        value = await self.backend.get(key)
+        if value is not MISSING:
+            self.hits[namespace] += 1
+            return value
+
+        self.misses[namespace] += 1
+        generations = await self.backend.get_generations([key])
+        value = await loader()
+        if value is not None:
+            await self.backend.set_many({key: value}, ttl, generations)
+
+        return value
+
+    async def get_many_or_load(self, keys, loader, ttl=None):
+        """{key: value} of the `keys` found in the cache or by `loader`,
+        awaited once with the list of keys missing from the cache and
+        returning {key: value} of those it found."""
+        values = {}
+        missing = []
+        for key, value in zip(keys, await self.backend.get_many(keys)):
+            namespace = key.split(":", 1)[0]
+            if value is MISSING:
+                self.misses[namespace] += 1
+                missing.append(key)
+            else:
+                self.hits[namespace] += 1
+                values[key] = value
+
+        if missing:
+            generations = await self.backend.get_generations(missing)
+            loaded = {key: value for key, value in (await loader(missing)).items() if value is not None}
+            if loaded:
+                await self.backend.set_many(loaded, ttl, generations)
+            values.update(loaded)
+
+        return values
+
+    async def invalidate(self, *keys):
+        await self.backend.delete(*keys)
+
+    async def clear(self):
+        await self.backend.clear()
+
+    def stats(self):
+        namespaces = sorted(set(self.hits) | set(self.misses))
+        return {
+            "backend": self.backend.name,
+            "entries": self.backend.size(),
+            "namespaces": {
+                namespace: {
+                    "hits": self.hits[namespace],
+                    "misses": self.misses[namespace],
+                    "hit_ratio": self.hits[namespace] / (self.hits[namespace] + self.misses[namespace])
+                } for namespace in namespaces
+            }
+        }
+
+
+cache = Cache(RedisBackend(CACHE_URL) if CACHE_URL else MemoryBackend())
@@ -0,0 +1,30 @@
+import os
+from datetime import date
+import tempfile
+
+import pytest
+
+
+# Tests run against a throwaway SQLite database unless TEST_DATABASE_URL
+# points them somewhere else (e.g. a disposable Postgres with a taca schema)
+TEST_DATABASE_FILE = os.path.join(tempfile.gettempdir(), "ms-menus-test.db")
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{TEST_DATABASE_FILE}")
+os.environ.setdefault("DATABASE_ASYNC", "true")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def create_tables():
+    from .database import Base, engine
+    from .retention import PARTITIONS_AHEAD, create_partitions, is_partitioned, month_start
+    from . import main  # noqa: F401 registers the models on Base
+
+    if engine.dialect.name == "sqlite" and os.path.exists(TEST_DATABASE_FILE):
+        os.remove(TEST_DATABASE_FILE)
+
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        # On a database partitioned by ddl/create_tables.py the tests write experiencias dated since 2020
+        if is_partitioned(connection):
+            create_partitions(connection, date(2020, 1, 1), month_start(date.today(), PARTITIONS_AHEAD))
+    yield
+    engine.dispose()
@@ -0,0 +1,194 @@
+"""Streaming export of menus and experiencias as NDJSON, CSV or Parquet.
+
+Rows are read through a server-side cursor `EXPORT_CHUNK_SIZE` at a time and
+encoded chunk by chunk, so an export only holds one chunk in memory however
+many rows it has. The generators block, StreamingResponse runs them in the
+threadpool, each one on its own connection. Parquet needs pyarrow
+(in requirements.txt).
+"""
+import csv
+import importlib.util
+import io
+import json
+import os
+
+from sqlalchemy import JSON, Date, DateTime, Float, Integer, select
+
+from .database import ReadSessionLocal
+from .models import DbMenu, DbExperiencia
+
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def parquet_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def menus_query(categoria_id=None):
+    statement = select(DbMenu.__table__).order_by(DbMenu.id)
+    if categoria_id is not None:
+        statement = statement.filter(DbMenu.categoria_id == categoria_id)
+    return statement
+
+
+def experiencias_query(desde=None, hasta=None, menu_id=None, categoria_id=None):
+    # Left in storage order, sorting every partition would hold back the first row
+    statement = select(DbExperiencia.__table__)
+    if desde is not None:
+        statement = statement.filter(DbExperiencia.fecha >= desde)
+    if hasta is not None:
+        statement = statement.filter(DbExperiencia.fecha <= hasta)
+    if menu_id is not None:
+        statement = statement.filter(DbExperiencia.menu_id == menu_id)
+    if categoria_id is not None:
+        statement = statement.filter(DbExperiencia.menu_id.in_(select(DbMenu.id).filter(DbMenu.categoria_id == categoria_id)))
+    return statement
+
+
+def row_chunks(statement, chunk_size):
+    # Opened on the first chunk, so a response that is never sent holds no connection. On
+    # the replica if there is one, without the statement timeout of the request sessions
+    session = ReadSessionLocal()
+    try:
+        result = session.execute(statement.execution_options(yield_per=chunk_size))
+        yield from result.partitions()
+    finally:
+        session.close()
+
+
+def plain(value):
+    # Dates as ISO strings, for JSON and CSV alike
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def cell(value, is_json):
+    # Arrays and JSON documents go into CSV and Parquet cells as JSON text
+    return json.dumps(value, ensure_ascii=False) if is_json and value is not None else plain(value)
+
+
+class NdjsonEncoder:
+    def __init__(self, columns):
+        self.names = [column.name for column in columns]
+
+    def header(self):
+        return b""
+
+    def encode(self, chunk):
+        lines = [json.dumps({name: plain(value) for name, value in zip(self.names, row)}, ensure_ascii=False) for row in chunk]
+        return ("\n".join(lines) + "\n").encode()
+
+    def footer(self):
+        return b""
+
+
+class CsvEncoder:
+    def __init__(self, columns):
+        self.names = [column.name for column in columns]
+        self.structured = [isinstance(column.type, JSON) for column in columns]
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def take(self):
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def header(self):
+        self.writer.writerow(self.names)
+        return self.take()
+
+    def encode(self, chunk):
+        self.writer.writerows([cell(value, is_json) for value, is_json in zip(row, self.structured)] for row in chunk)
+        return self.take()
+
+    def footer(self):
+        return b""
+
+
+class ChunkSink:
+    """Write-only file the Parquet writer flushes to, emptied after every
+    row group."""
+
+    closed = False
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def parquet_type(column, pa):
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us", tz="UTC")
+    if isinstance(column.type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+class ParquetEncoder:
+    """One row group per chunk, with a schema fixed from the column types so
+    every chunk matches it."""
+
+    def __init__(self, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([(column.name, parquet_type(column, pa)) for column in columns])
+        self.structured = [isinstance(column.type, JSON) for column in columns]
+        self.sink = ChunkSink()
+        self.writer = pq.ParquetWriter(pa.PythonFile(self.sink, mode="w"), self.schema)
+
+    def header(self):
+        return self.sink.take()
+
+    def encode(self, chunk):
+        arrays = [
+            self.pa.array([cell(value, is_json) if is_json else value for value in values], data_type)
+            for values, is_json, data_type in zip(zip(*chunk), self.structured, self.schema.types)
+        ]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        return self.sink.take()
+
+    def footer(self):
+        self.writer.close()
+        return self.sink.take()
+
+
+ENCODERS = {"ndjson": NdjsonEncoder, "csv": CsvEncoder, "parquet": ParquetEncoder}
+
+
+def export(statement, formato, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields the rows of `statement` encoded as `formato`, chunk by chunk."""
+    encoder = ENCODERS[formato](list(statement.selected_columns))
+    yield encoder.header()
+    for chunk in row_chunks(statement, chunk_size):
+        yield encoder.encode(chunk)
+    yield encoder.footer()
@@ -0,0 +1,243 @@
+"""Bulk import of menus from a JSON array or a CSV file.
+
+Menus are matched on (categoria_id, nombre), unique in taca.menu: the ones
+already there get the columns present in their row updated, their aggregates
+are kept, the others are created. Rows are validated up front and upserted
+`IMPORT_BATCH_SIZE` at a time with multi-row INSERT ... ON CONFLICT. The
+category of a row is its categoria_id or the name of a taca.categoria in a
+`categoria` column. Invalid rows are reported by index and skipped, the rest
+are imported.
+
+    python -m app.importer menus.csv [--crear-categorias]
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+from typing import Optional
+
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import func, select, tuple_
+
+from . import media
+from .database import SessionLocal
+from .models import DbMenu, DbCategoria
+from .summaries import dialect_insert
+
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+MAX_IMPORT_ROWS = 20000
+# Size of the file POST /importar/menus reads, data URI photos included
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(50 * 1024 * 1024)))
+
+# Columns a file can set, the aggregates only change with experiencias
+IMPORT_COLUMNS = ["descripcion", "preparacion", "ingredientes", "foto"]
+
+
+class MenuImportado(BaseModel):
+    nombre: str = Field(min_length=1)
+    categoria_id: Optional[int] = None
+    categoria: Optional[str] = None
+    descripcion: Optional[str] = None
+    preparacion: Optional[str] = None
+    ingredientes: Optional[list[str]] = None
+    foto: Optional[str] = None
+
+
+def csv_row(row):
+    # Empty cells are nulls, ingredientes a JSON array (as exported) or comma separated
+    values = {column: value or None for column, value in row.items() if column is not None}
+    ingredientes = values.get("ingredientes")
+    if ingredientes is not None:
+        try:
+            values["ingredientes"] = json.loads(ingredientes)
+        except ValueError:
+            values["ingredientes"] = [i.strip() for i in ingredientes.split(",") if i.strip()]
+    return values
+
+
+def read_menus(content, formato):
+    """Rows of `content` as dicts, raises ValueError if it cannot be parsed."""
+    if formato == "csv":
+        try:
+            return [csv_row(row) for row in csv.DictReader(io.StringIO(content))]
+        except csv.Error as error:
+            raise ValueError(str(error))
+
+    rows = json.loads(content)
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of menus")
+    return rows
+
+
+def error_message(error):
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" if detail["loc"] else detail["msg"]
+        for detail in error.errors()
+    )
+
+
+def validate_rows(rows):
+    # ({index: MenuImportado}, errores) of the rows of a file, their data URI photos stored
+    menus = {}
+    errores = []
+    for index, row in enumerate(rows):
+        try:
+            menus[index] = MenuImportado.model_validate(row)
+        except ValidationError as error:
+            errores.append({"index": index, "message": error_message(error)})
+            continue
+        # Assigning foto would mark it as sent, and a row updates the columns it sent
+        if "foto" not in menus[index].model_fields_set:
+            continue
+        try:
+            menus[index].foto = media.offload(menus[index].foto)
+        except ValueError as error:
+            errores.append({"index": index, "message": f"foto: {error}"})
+            del menus[index]
+    return menus, errores
+
+
+def categoria_ids(session, nombres):
+    return dict(session.execute(select(DbCategoria.categoria, DbCategoria.id).filter(DbCategoria.categoria.in_(nombres))).all())
+
+
+def resolve_categorias(session, menus, errores, crear_categorias):
+    """Sets the categoria_id of the rows naming their category, with one
+    query. Unknown categories are created or their rows dropped as errors.
+    Returns how many categories were created."""
+    nombres = {menu.categoria for menu in menus.values() if menu.categoria_id is None and menu.categoria is not None}
+    ids = categoria_ids(session, nombres)
+
+    creadas = 0
+    missing = nombres - ids.keys()
+    if missing and crear_categorias:
+        session.execute(
+            dialect_insert(DbCategoria).on_conflict_do_nothing(index_elements=[DbCategoria.categoria]),
+            [{"categoria": nombre} for nombre in sorted(missing)]
+        )
+        ids = categoria_ids(session, nombres)
+        creadas = len(missing & ids.keys())
+
+    for index, menu in list(menus.items()):
+        if menu.categoria_id is not None:
+            continue
+        if menu.categoria is None:
+            errores.append({"index": index, "message": "categoria or categoria_id is required"})
+            del menus[index]
+        elif menu.categoria not in ids:
+            errores.append({"index": index, "message": f"Categoria '{menu.categoria}' not found"})
+            del menus[index]
+        else:
+            menu.categoria_id = ids[menu.categoria]
+
+    return creadas
+
+
+def upsert_menus(columns):
+    # New menus start with the same aggregates as POST /menus
+    statement = dialect_insert(DbMenu)
+    excluded = statement.excluded
+    # nombre is set to itself so RETURNING also yields the updated rows
+    return statement.on_conflict_do_update(
+        index_elements=[DbMenu.categoria_id, DbMenu.nombre],
+        set_={
+            "nombre": excluded.nombre,
+            **{column: excluded[column] for column in columns},
+            "version": DbMenu.version + 1,
+            "actualizado": func.now()
+        }
+    )
+
+
+def import_menus(session, rows, crear_categorias=False, batch_size=IMPORT_BATCH_SIZE):
+    """Validates and upserts `rows`, dicts as read by read_menus. Returns the
+    imported menus and the errors of the skipped rows, both by row index.
+    The caller commits."""
+    menus, errores = validate_rows(rows)
+    creadas = resolve_categorias(session, menus, errores, crear_categorias)
+
+    # A menu repeated in the file keeps its last row
+    last = {}
+    for index, menu in menus.items():
+        key = (menu.categoria_id, menu.nombre)
+        if key in last:
+            errores.append({"index": last[key], "message": f"Replaced by row {index} with the same nombre and categoria"})
+        last[key] = index
+
+    importados = []
+    # In key order so concurrent imports lock the rows in the same order
+    keys = sorted(last)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        existing = set(session.execute(
+            select(DbMenu.categoria_id, DbMenu.nombre).filter(tuple_(DbMenu.categoria_id, DbMenu.nombre).in_(batch))
+        ).tuples())
+
+        # A row only updates the columns it has, the rows with the same ones share a statement
+        groups = {}
+        for key in batch:
+            menu = menus[last[key]]
+            columns = tuple(column for column in IMPORT_COLUMNS if column in menu.model_fields_set)
+            groups.setdefault(columns, []).append({
+                "nombre": menu.nombre,
+                "categoria_id": menu.categoria_id,
+                **{column: getattr(menu, column) for column in columns},
+                "arousal_resultante": 0,
+                "valencia_resultante": 0,
+                "emocion_resultante": "comun",
+                "numero_experiencias": 0
+            })
+
+        for columns, values in groups.items():
+            returned = session.execute(
+                upsert_menus(columns).values(values).returning(DbMenu.id, DbMenu.categoria_id, DbMenu.nombre))
+            for id, categoria_id, nombre in returned:
+                key = (categoria_id, nombre)
+                importados.append({
+                    "index": last[key],
+                    "id": id,
+                    "categoria_id": categoria_id,
+                    "accion": "actualizado" if key in existing else "creado"
+                })
+
+    return {
+        "creados": sum(1 for menu in importados if menu["accion"] == "creado"),
+        "actualizados": sum(1 for menu in importados if menu["accion"] == "actualizado"),
+        "categorias_creadas": creadas,
+        "menus": sorted(importados, key=lambda menu: menu["index"]),
+        "errores": sorted(errores, key=lambda error: error["index"])
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates or updates the menus of a JSON or CSV file")
+    parser.add_argument("archivo", help="JSON array of menus or CSV file with a header, by extension")
+    parser.add_argument("--crear-categorias", action="store_true", help="create the categories named in the file that do not exist")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    formato = "csv" if args.archivo.lower().endswith(".csv") else "json"
+    with open(args.archivo, encoding="utf-8-sig", newline="") as archivo:
+        rows = read_menus(archivo.read(), formato)
+
+    session = SessionLocal()
+    try:
+        result = import_menus(session, rows, args.crear_categorias)
+        session.commit()
+    finally:
+        session.close()
+
+    for error in result["errores"]:
+        logger.warning("Row %s skipped: %s", error["index"], error["message"])
+    logger.info("Menus imported: %s created, %s updated, %s categories created, %s rows skipped",
+                result["creados"], result["actualizados"], result["categorias_creadas"], len(result["errores"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Write-behind queue for POST /experiencia.
+
+With EXPERIENCIA_QUEUE set, experiencias are scored in the request, queued
+and answered with 202. A background task writes them in groups of up to
+`EXPERIENCIA_QUEUE_BATCH_SIZE`, one transaction and one aggregate update per
+menu for the whole group, waiting at most `EXPERIENCIA_QUEUE_FLUSH_INTERVAL`
+seconds for a group to fill, so many requests share one commit.
+
+The queue is kept by a backend: "memory" holds it in the process and loses
+what was not flushed on a crash, "file" journals it to a SQLite file of its
+own under `EXPERIENCIA_QUEUE_DIR`, locked while the worker lives. A starting
+worker adopts the journals no live worker holds, those of crashed workers.
+Entries leave the journal once their group is committed, a crash in between
+writes them twice.
+
+A group that fails because the database cannot be reached is retried, with
+a delay doubled up to `MAX_RETRY_DELAY`, for as long as it takes. One that
+fails otherwise, on its data, is halved until the entries that fail on
+their own are found, the rest are written. Such an entry is logged and
+dropped after `MAX_FLUSH_ATTEMPTS` attempts, the file backend also appends
+it to `dead_letters.ndjson`.
+"""
+import asyncio
+import collections
+import fcntl
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from sqlalchemy.exc import InterfaceError, OperationalError
+from starlette.concurrency import run_in_threadpool
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# "memory", "file" or empty to save every experiencia in its request
+EXPERIENCIA_QUEUE = os.getenv("EXPERIENCIA_QUEUE", "").lower()
+EXPERIENCIA_QUEUE_DIR = os.getenv("EXPERIENCIA_QUEUE_DIR", "experiencia_queue")
+EXPERIENCIA_QUEUE_BATCH_SIZE = int(os.getenv("EXPERIENCIA_QUEUE_BATCH_SIZE", "500"))
+EXPERIENCIA_QUEUE_FLUSH_INTERVAL = float(os.getenv("EXPERIENCIA_QUEUE_FLUSH_INTERVAL", "0.05"))
+# Requests get a 503 past this many queued experiencias
+EXPERIENCIA_QUEUE_MAX_SIZE = int(os.getenv("EXPERIENCIA_QUEUE_MAX_SIZE", "10000"))
+
+# Seconds between retries of a group that failed to be written, doubled up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = float(os.getenv("EXPERIENCIA_QUEUE_MAX_RETRY_DELAY", "30"))
+# Attempts at writing an entry that fails on its own before it is dropped, so it does not hold back the rest
+MAX_FLUSH_ATTEMPTS = int(os.getenv("EXPERIENCIA_QUEUE_MAX_ATTEMPTS", "5"))
+
+# The database is unreachable or the connection was lost, not a problem of the entries
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)
+
+
+def is_transient(error):
+    return isinstance(error, TRANSIENT_ERRORS) or getattr(error, "connection_invalidated", False)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self):
+        self.entries = collections.deque()
+
+    def put(self, entries):
+        self.entries.extend(entries)
+
+    def peek(self, limit):
+        return [self.entries[i] for i in range(min(limit, len(self.entries)))]
+
+    def remove(self, entries):
+        # Always the oldest ones, a group is taken from the head and this process is the only reader
+        for _ in entries:
+            self.entries.popleft()
+
+    def dead_letter(self, entries):
+        # Logged by the queue, nowhere else to keep them
+        self.remove(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        pass
+
+
+class FileBackend:
+    """Entries journaled as JSON rows of a SQLite file only this process
+    uses, each put committed before the request is answered."""
+
+    blocking = True
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.path = os.path.join(directory, f"journal-{os.getpid()}-{uuid.uuid4().hex[:8]}.sqlite3")
+        # Held until close, tells other workers this journal is not an orphan
+        self.lock_file = open_locked(self.path + ".lock")
+        self.connection = journal_connection(self.path)
+        self.size = 0
+        for path in sorted(glob.glob(os.path.join(directory, "journal-*.sqlite3"))):
+            if path != self.path:
+                self.adopt(path)
+
+    def adopt(self, path):
+        # The entries of a journal whose worker is gone, if none still holds it
+        try:
+            lock_file = open_locked(path + ".lock")
+        except BlockingIOError:
+            return
+        try:
+            orphan = journal_connection(path)
+            entries = orphan.execute("SELECT id, value FROM entries ORDER BY seq").fetchall()
+            orphan.close()
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO entries (id, value) VALUES (?, ?)", entries)
+            self.size = self.connection.execute("SELECT count(*) FROM entries").fetchone()[0]
+            for leftover in (path, path + "-wal", path + "-shm", path + ".lock"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            if entries:
+                logger.info("Adopted %d queued entries of %s", len(entries), path)
+        finally:
+            lock_file.close()
+
+    def put(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO entries (id, value) VALUES (?, ?)", [(id, json.dumps(value)) for id, value in entries])
+            self.size += len(entries)
+
+    def peek(self, limit):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, value FROM entries ORDER BY seq LIMIT ?", (limit,)).fetchall()
+        return [(id, json.loads(value)) for id, value in rows]
+
+    def remove(self, entries):
+        # By id, only what was written leaves the journal
+        with self.lock, self.connection:
+            deleted = self.connection.executemany("DELETE FROM entries WHERE id = ?", [(id,) for id, _ in entries]).rowcount
+            self.size -= deleted
+
+    def dead_letter(self, entries):
+        with open(os.path.join(self.directory, "dead_letters.ndjson"), "a") as file:
+            file.write("".join(json.dumps({"id": id, "value": value}) + "\n" for id, value in entries))
+        self.remove(entries)
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.connection.close()
+        # An empty journal is not left behind for the next worker to adopt
+        if not self.size:
+            for leftover in (self.path, self.path + "-wal", self.path + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self.lock_file.close()
+
+
+def open_locked(path):
+    # Raises BlockingIOError if another process holds the lock
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def journal_connection(path):
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS entries (seq INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, value TEXT NOT NULL)")
+    return connection
+
+
+class WriteBehindQueue:
+    """Values put in the queue are handed to `flush`, a coroutine taking a
+    list of (id, value), in groups and in order. A group stays queued until
+    `flush` returns. It is retried without limit while `flush` raises
+    errors `is_transient` accepts, and halved on any other error, an entry
+    failing alone is dropped after `max_attempts` attempts."""
+
+    def __init__(self, name, backend, flush, batch_size=EXPERIENCIA_QUEUE_BATCH_SIZE,
+                 flush_interval=EXPERIENCIA_QUEUE_FLUSH_INTERVAL, max_size=EXPERIENCIA_QUEUE_MAX_SIZE,
+                 max_attempts=MAX_FLUSH_ATTEMPTS, is_transient=is_transient):
+        self.name = name
+        self.backend = backend
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.is_transient = is_transient
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = None
+
+    async def call(self, method, *args):
+        return await run_in_threadpool(method, *args) if self.backend.blocking else method(*args)
+
+    async def put(self, value):
+        """Queues `value` and returns its id, raises QueueFull at `max_size`."""
+        if len(self.backend) >= self.max_size:
+            raise QueueFull()
+        id = uuid.uuid4().hex
+        await self.call(self.backend.put, [(id, value)])
+        self.wakeup.set()
+        return id
+
+    def depth(self):
+        return len(self.backend)
+
+    def start(self):
+        # Entries journaled before a restart are written first
+        if len(self.backend):
+            self.wakeup.set()
+        self.task = asyncio.create_task(self.run())
+        metrics.queue_depths[self.name] = self.depth
+
+    async def stop(self):
+        """Writes what is queued and stops the worker."""
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        metrics.queue_depths.pop(self.name, None)
+        self.backend.close()
+
+    async def run(self):
+        delay = RETRY_DELAY
+        while True:
+            if not len(self.backend):
+                if self.stopping:
+                    return
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            # Group commit, let a few more requests join the group unless it is full
+            if len(self.backend) < self.batch_size and not self.stopping:
+                await asyncio.sleep(self.flush_interval)
+
+            entries = await self.call(self.backend.peek, self.batch_size)
+            try:
+                await self.write(entries)
+            except Exception as error:
+                if not self.is_transient(error):
+                    raise
+                # What was written before the error has left the queue, the rest is read again
+                if self.stopping:
+                    logger.exception("Writing the %s queue failed on shutdown, %d entries left unwritten",
+                                     self.name, len(self.backend))
+                    return
+                logger.exception("Writing the %s queue failed, retrying in %.1fs", self.name, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            delay = RETRY_DELAY
+
+    async def write(self, entries):
+        # Writes `entries` or drops the ones that fail alone, raises the transient errors
+        attempts = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                await self.flush(entries)
+            except Exception as error:
+                if self.is_transient(error):
+                    raise
+                if len(entries) > 1:
+                    logger.warning("Writing %d entries of the %s queue failed (%s), writing them in halves",
+                                   len(entries), self.name, error)
+                    half = len(entries) // 2
+                    await self.write(entries[:half])
+                    await self.write(entries[half:])
+                    return
+
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.exception("Dropping an entry of the %s queue after %d failed attempts: %s",
+                                     self.name, attempts, json.dumps(entries, default=str))
+                    await self.call(self.backend.dead_letter, entries)
+                    metrics.queue_dropped[(self.name,)] += len(entries)
+                    return
+                await asyncio.sleep(min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+                continue
+
+            # Oldest first, the halves are written in order
+            await self.call(self.backend.remove, entries)
+            metrics.queue_flush_duration.observe((self.name,), time.perf_counter() - start)
+            metrics.queue_flush_size.observe((self.name,), len(entries))
+            return
+
+
+def create_queue(flush):
+    """The queue EXPERIENCIA_QUEUE asks for, None if it is not set."""
+    if not EXPERIENCIA_QUEUE:
+        return None
+    if EXPERIENCIA_QUEUE == "memory":
+        return WriteBehindQueue("experiencia", MemoryBackend(), flush)
+    if EXPERIENCIA_QUEUE == "file":
+        return WriteBehindQueue("experiencia", FileBackend(EXPERIENCIA_QUEUE_DIR), flush)
+    raise ValueError(f"Unknown EXPERIENCIA_QUEUE '{EXPERIENCIA_QUEUE}', expected memory or file")
@@ -0,0 +1,228 @@
+"""Menu photos stored as files named by the SHA-256 of their content.
+
+A menu's `foto` holds the URL of its photo, `/media/<hash>`, rather than the
+image itself, so list responses carry a few dozen bytes per menu. Photos
+sent as data URIs (`data:image/png;base64,...`) by POST /menus, PUT /menu,
+the importer or PUT /menus/{id}/foto are decoded and stored under
+`MEDIA_DIR`, an identical image is stored once. Thumbnails are generated on
+their first request and kept next to the photos, they need Pillow
+(in requirements.txt). To move the data URIs already in the database:
+
+    python -m app.media
+"""
+import argparse
+import base64
+import binascii
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import re
+import tempfile
+
+from sqlalchemy import func, select, update
+
+from .database import SessionLocal
+from .models import DbMenu
+
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MEDIA_URL = "/media/"
+MAX_FOTO_BYTES = int(os.getenv("MAX_FOTO_BYTES", str(10 * 1024 * 1024)))
+# Widths a thumbnail can be requested in, so requests cannot fill the disk with sizes
+THUMBNAIL_WIDTHS = (128, 256, 512)
+READ_CHUNK_SIZE = 64 * 1024
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Leading bytes of the image formats accepted
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def thumbnails_available():
+    return importlib.util.find_spec("PIL") is not None
+
+
+def content_type(head):
+    for signature, media_type in SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def blob_path(digest, width=None):
+    # Two levels of directories keep them small, thumbnails beside their photo
+    name = digest if width is None else f"{digest}-{width}"
+    return os.path.join(MEDIA_DIR, digest[:2], name)
+
+
+def store(data):
+    """Stores an image and returns its hash, raises ValueError if `data` is
+    not a JPEG, PNG, GIF or WebP image or is larger than MAX_FOTO_BYTES."""
+    if len(data) > MAX_FOTO_BYTES:
+        raise ValueError(f"Photos are limited to {MAX_FOTO_BYTES} bytes")
+    if content_type(data[:12]) is None:
+        raise ValueError("Photos must be JPEG, PNG, GIF or WebP images")
+
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Renamed into place so a reader never sees half a file
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+    return digest
+
+
+def decode_data_uri(value):
+    """Bytes of a base64 `data:` URI, raises ValueError if it is not one."""
+    header, separator, payload = value.partition(",")
+    if not separator or not header.endswith(";base64"):
+        raise ValueError("Photos must be base64 data URIs or URLs")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except binascii.Error:
+        raise ValueError("Invalid base64 in the photo data URI")
+
+
+def offload(foto):
+    """The value to save as a menu's foto: data URIs are stored and replaced
+    by their URL, URLs and None are kept. Raises ValueError for an invalid
+    image."""
+    if foto is None or not foto.startswith("data:"):
+        return foto
+    return foto_url(store(decode_data_uri(foto)))
+
+
+def foto_url(digest):
+    return MEDIA_URL + digest
+
+
+def is_hash(value):
+    return HASH_PATTERN.fullmatch(value) is not None
+
+
+def thumbnail_path(digest, width):
+    """Path of the thumbnail of a stored photo, `width` pixels wide at most,
+    generated on the first call. Needs Pillow."""
+    from PIL import Image
+
+    path = blob_path(digest, width)
+    if os.path.exists(path):
+        return path
+
+    with Image.open(blob_path(digest)) as image:
+        image.thumbnail((width, width * 4))
+        # PNG for images with transparency, JPEG for the rest
+        has_alpha = image.mode in ("RGBA", "LA", "P")
+        buffer = io.BytesIO()
+        if has_alpha:
+            image.save(buffer, "PNG", optimize=True)
+        else:
+            image.convert("RGB").save(buffer, "JPEG", quality=85, optimize=True)
+
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(buffer.getvalue())
+    os.replace(temporary, path)
+    return path
+
+
+def parse_range(header, size):
+    """(start, end) inclusive of a single `bytes=` range, None for a header
+    this does not serve (multiple ranges) so the whole file is sent. Raises
+    ValueError if the range is outside the file."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # The last `last` bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def read_range(path, start, end):
+    # Generator of the bytes start..end of a file, StreamingResponse runs it in the threadpool
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def offload_existing(session, batch_size=100):
+    """Stores the data URIs found in taca.menu as files and replaces them by
+    their URL, `batch_size` menus per transaction. Returns how many menus
+    were updated, menus with an invalid image are logged and left as they
+    are."""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(DbMenu.id, DbMenu.foto)
+            .filter(DbMenu.id > last_id, DbMenu.foto.like("data:%"))
+            .order_by(DbMenu.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return updated
+
+        for id, foto in rows:
+            try:
+                url = offload(foto)
+            except ValueError as error:
+                logger.warning("Menu %s keeps its photo: %s", id, error)
+                continue
+            session.execute(
+                update(DbMenu).where(DbMenu.id == id)
+                .values(foto=url, version=DbMenu.version + 1, actualizado=func.now())
+                .execution_options(synchronize_session=False)
+            )
+            updated += 1
+        session.commit()
+        last_id = rows[-1].id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Moves the photos saved as data URIs in taca.menu to the media store")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    session = SessionLocal()
+    try:
+        updated = offload_existing(session, args.batch_size)
+    finally:
+        session.close()
+    logger.info("Photos of %s menus moved to %s", updated, MEDIA_DIR)
+
+
+if __name__ == "__main__":
+    main()
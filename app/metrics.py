@@ -0,0 +1,223 @@
+"""Request metrics in the Prometheus text format, served on GET /metrics.
+
+MetricsMiddleware times every request by route template and counts the
+queries it ran and their time, from SQLAlchemy cursor events on every
+engine. The database work of a request may run in the threadpool or a
+greenlet, the per-request totals follow it through a context variable. Pool
+usage, cache hits and the depth of the write-behind queues are read when
+/metrics is scraped.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from .cache import cache
+from .database import engines
+
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this many seconds are logged as warnings
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "1"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # {label values: ([count per bucket], sum, count)}
+        self.series = {}
+
+    def observe(self, values, amount):
+        with self.lock:
+            counts, total, count = self.series.get(values) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+            self.series[values] = (counts, total + amount, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for values, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{label_text(names, values + (number(bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{label_text(names, values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{label_text(self.labels, values)} {number(total)}")
+                lines.append(f"{self.name}_count{label_text(self.labels, values)} {count}")
+        return lines
+
+
+def samples(name, help, kind, labels, series):
+    # Lines of a counter or gauge from {label values: value}
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{label_text(labels, values)} {number(value)}" for values, value in sorted(series.items()))
+    return lines
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, by route template",
+    ("method", "route", "status"), LATENCY_BUCKETS)
+request_queries = Histogram(
+    "http_request_db_queries", "Database queries run by a request",
+    ("method", "route"), QUERY_BUCKETS)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Time a request spent running database queries",
+    ("method", "route"), LATENCY_BUCKETS)
+queue_flush_duration = Histogram(
+    "queue_flush_duration_seconds", "Time to write a group of queued writes in one transaction",
+    ("queue",), LATENCY_BUCKETS)
+queue_flush_size = Histogram(
+    "queue_flush_size", "Queued writes committed together",
+    ("queue",), BATCH_BUCKETS)
+# {queue: function returning its depth}, registered by the write-behind queues while they run
+queue_depths = {}
+# {(queue,): writes dropped after failing every attempt}
+queue_dropped = Counter()
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+
+def instrument(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+for instrumented in engines().values():
+    instrument(instrumented)
+
+
+def route_template(scope):
+    # Bounded label values, unmatched paths would add one series per url
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware, unlike BaseHTTPMiddleware it times streamed responses
+    until their last chunk is sent. Background tasks run after that and are
+    not counted."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        # (status, seconds, queries, db seconds) once the response is sent
+        sent = None
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and sent is None:
+                sent = (status, time.perf_counter() - start, stats.queries, stats.db_seconds)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            self.record(scope, sent or (status, time.perf_counter() - start, stats.queries, stats.db_seconds))
+
+    def record(self, scope, sent):
+        status, elapsed, queries, db_seconds = sent
+        method, route = scope["method"], route_template(scope)
+        request_duration.observe((method, route, str(status)), elapsed)
+        request_queries.observe((method, route), queries)
+        request_db_duration.observe((method, route), db_seconds)
+
+        level = logging.WARNING if elapsed > SLOW_REQUEST_SECONDS else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(level, "request method=%s route=%s status=%s duration_ms=%.1f queries=%d db_ms=%.1f",
+                       method, route, status, elapsed * 1000, queries, db_seconds * 1000)
+
+
+def pool_series():
+    # {(engine, state): connections} of the pools that track them
+    series = {}
+    for name, sync_engine in engines().items():
+        pool = sync_engine.pool
+        for state in ("size", "checkedin", "checkedout", "overflow"):
+            if hasattr(pool, state):
+                series[(name, state)] = getattr(pool, state)()
+    return series
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = request_duration.render() + request_queries.render() + request_db_duration.render()
+    lines += samples("db_pool_connections", "Connections of the pool by state", "gauge", ("engine", "state"), pool_series())
+    lines += queue_flush_duration.render() + queue_flush_size.render()
+    lines += samples("queue_depth", "Writes waiting in a write-behind queue", "gauge", ("queue",),
+                     {(name,): depth() for name, depth in list(queue_depths.items())})
+    lines += samples("queue_dropped_total", "Queued writes dropped after failing every attempt", "counter", ("queue",),
+                     dict(queue_dropped))
+
+    stats = cache.stats()
+    namespaces = stats["namespaces"]
+    lines += samples("cache_hits_total", "Cache hits by key namespace", "counter", ("namespace",),
+                     {(namespace,): values["hits"] for namespace, values in namespaces.items()})
+    lines += samples("cache_misses_total", "Cache misses by key namespace", "counter", ("namespace",),
+                     {(namespace,): values["misses"] for namespace, values in namespaces.items()})
+    if stats["entries"] is not None:
+        lines += samples("cache_entries", "Entries in the in-process cache", "gauge", (), {(): stats["entries"]})
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,139 @@
+from datetime import date
+
+from sqlalchemy import Column, Date, DateTime, ForeignKey, Index, Integer, String, Float, JSON, func, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+
+from .database import Base
+
+
+# Native array/jsonb columns on PostgreSQL, JSON text on the SQLite stand-in
+StringList = JSON(none_as_null=True).with_variant(ARRAY(String), "postgresql")
+JsonDocument = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql")
+
+# Text search configuration of the menu full-text index
+SEARCH_CONFIG = "spanish"
+
+
+# Define the Menu model
+class DbMenu(Base):
+    __tablename__ = "menu"
+    __table_args__ = (
+        # GIN so ingredient containment filters (@>, &&) use the index
+        Index("ix_taca_menu_ingredientes", "ingredientes", postgresql_using="gin"),
+        # Natural key of a menu, bulk imports upsert on it. Also serves the lookups by categoria_id
+        Index("ix_taca_menu_categoria_nombre", "categoria_id", "nombre", unique=True),
+        # The menus written since a time, read by app.recommend to follow other workers' writes
+        Index("ix_taca_menu_actualizado", "actualizado"),
+        {"schema": "taca"}
+    )
+
+    id = Column(Integer, primary_key=True)
+    nombre = Column(String, unique=False)
+    categoria_id = Column(Integer, unique=False)
+    descripcion = Column(String, unique=False)
+    preparacion = Column(String, unique=False)
+    ingredientes = Column(StringList, unique=False)
+    foto = Column(String, unique=False, index=False)
+    arousal_resultante = Column(Float, unique= False)
+    valencia_resultante = Column(Float, unique= False)
+    emocion_resultante = Column(String, unique= False)
+    numero_experiencias = Column(Integer, unique= False)
+    # Bumped by every write to the menu, its aggregates included. ETag and Last-Modified of its reads
+    version = Column(Integer, nullable=False, server_default=text("1"))
+    actualizado = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+def menu_search_document():
+    """Weighted tsvector of a menu, the name ranks above the description.
+    Constants are inlined so queries match the expression index below."""
+    def weighted(column, weight):
+        return func.setweight(
+            func.to_tsvector(text(f"'{SEARCH_CONFIG}'::regconfig"), func.coalesce(column, text("''"))),
+            text(f"'{weight}'"))
+
+    return weighted(DbMenu.nombre, "A").op("||")(weighted(DbMenu.descripcion, "B"))
+
+
+Index("ix_taca_menu_busqueda", menu_search_document(), postgresql_using="gin").ddl_if(dialect="postgresql")
+
+
+class DbCategoria(Base):
+    __tablename__ = "categoria"
+    __table_args__ = {"schema": "taca"}
+
+    id = Column(Integer, primary_key=True)
+    categoria = Column(String, unique=True, index=True)
+    descripcion = Column(String, unique=True, index=False)
+
+class DbExperiencia(Base):
+    """One tasting. On PostgreSQL the table is partitioned by month of fecha
+    (ddl/create_tables.py), app.retention manages the partitions."""
+    __tablename__ = "experiencia"
+    __table_args__ = (
+        # A user's experiencias (optionally with one menu) and a menu's experiencias by date
+        Index("ix_taca_experiencia_usuario_menu", "usuario_id", "menu_id"),
+        Index("ix_taca_experiencia_menu_fecha", "menu_id", "fecha"),
+        {"schema": "taca"}
+    )
+
+    id = Column('id', Integer, primary_key=True)
+    fecha = Column('fecha', Date, nullable=False, default=date.today)
+    usuario_id = Column('usuario_id', Integer, unique=False, index=False)
+    menu_id = Column('menu_id', Integer, ForeignKey('taca.menu.id', ondelete='RESTRICT'), unique=False, index=False)
+    emocion_menu = Column('emocion_menu', JsonDocument, unique=False, index=False)
+    arousal_menu = Column('arousal_menu', Float, unique=False, index=False)
+    valencia_menu = Column('valencia_menu', Float, unique=False, index=False)
+    emocion_plato = Column('emocion_plato', JsonDocument, unique=False, index=False)
+    arousal_plato = Column('arousal_plato', Float, unique=False, index=False)
+    valencia_plato = Column('valencia_plato', Float, unique=False, index=False)
+    sam_valencia = Column('sam_valencia', Float, unique=False, index=False)
+    sam_arousal = Column('sam_arousal', Float, unique=False, index=False)
+    arousal_resultante = Column('arousal_resultante', Float, unique=False, index=False)
+    valencia_resultante = Column('valencia_resultante', Float, unique=False, index=False)
+    emocion_resultante = Column('emocion_resultante', String, unique=False, index=False)
+    reseña = Column('reseña', String, unique=False, index=False)
+    api = Column('api', String, unique=False, index=False)
+
+
+class DbExperienciaResumen(Base):
+    """Running totals of the experiencias of a user with a menu, kept by the
+    experiencia routes and rebuilt from the experiencia table by
+    app.summaries."""
+    __tablename__ = "experiencia_resumen"
+    __table_args__ = {"schema": "taca"}
+
+    usuario_id = Column('usuario_id', Integer, primary_key=True)
+    menu_id = Column('menu_id', Integer, ForeignKey('taca.menu.id', ondelete='RESTRICT'), primary_key=True)
+    numero_experiencias = Column('numero_experiencias', Integer, nullable=False)
+    valencia_total = Column('valencia_total', Float, nullable=False)
+    arousal_total = Column('arousal_total', Float, nullable=False)
+    ultima_fecha = Column('ultima_fecha', Date, unique=False, index=False)
+
+
+class DbExperienciaResumenArchivo(Base):
+    """Totals of a user with a menu over the experiencias dropped by
+    app.retention, so app.summaries still counts them when rebuilding."""
+    __tablename__ = "experiencia_resumen_archivo"
+    __table_args__ = {"schema": "taca"}
+
+    usuario_id = Column('usuario_id', Integer, primary_key=True)
+    menu_id = Column('menu_id', Integer, ForeignKey('taca.menu.id', ondelete='RESTRICT'), primary_key=True)
+    numero_experiencias = Column('numero_experiencias', Integer, nullable=False)
+    valencia_total = Column('valencia_total', Float, nullable=False)
+    arousal_total = Column('arousal_total', Float, nullable=False)
+    ultima_fecha = Column('ultima_fecha', Date, unique=False, index=False)
+
+
+class DbExperienciaDiaria(Base):
+    """Totals of the experiencias of a menu in a day per emocion_resultante,
+    kept by the experiencia routes and rebuilt by app.rollups. They outlive
+    the raw experiencias dropped by app.retention."""
+    __tablename__ = "experiencia_diaria"
+    __table_args__ = {"schema": "taca"}
+
+    menu_id = Column('menu_id', Integer, ForeignKey('taca.menu.id', ondelete='RESTRICT'), primary_key=True)
+    fecha = Column('fecha', Date, primary_key=True)
+    emocion_resultante = Column('emocion_resultante', String, primary_key=True)
+    numero_experiencias = Column('numero_experiencias', Integer, nullable=False)
+    valencia_total = Column('valencia_total', Float, nullable=False)
+    arousal_total = Column('arousal_total', Float, nullable=False)
@@ -0,0 +1,266 @@
+"""k nearest menus in the valence/arousal plane.
+
+The (valencia_resultante, arousal_resultante) point of every menu lives in an
+in-process grid, built from the menu table on the first query (in the
+threadpool) and moved by the routes that change a menu's aggregates, so a
+query only looks at the cells around its target. Other workers write too:
+every `RECOMMEND_CHECK_INTERVAL` seconds a query reads the menus whose
+`actualizado`, set by every write and indexed, is past the last one seen
+and moves their points. The last `RECOMMEND_REFRESH_WINDOW` seconds are
+read again each time, `actualizado` is when a write's transaction started
+so a slow one commits behind later ones. Menus deleted elsewhere are
+dropped when a query finds they are gone.
+"""
+import heapq
+import math
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func, select
+from starlette.concurrency import run_in_threadpool
+
+from .models import DbMenu, DbExperienciaResumen
+from .scoring import VALENCE_AROUSAL_TO_TASTE
+
+
+# Valence and arousal live in [-1, 1], cells are sized for about
+# POINTS_PER_CELL menus each over that square
+PLANE_AREA = 4.0
+POINTS_PER_CELL = 4
+MIN_CELL_SIZE = 0.002
+MAX_CELL_SIZE = 0.25
+
+RECOMMEND_CHECK_INTERVAL = float(os.getenv("RECOMMEND_CHECK_INTERVAL", "5"))
+# Longer than any transaction writing menus takes
+RECOMMEND_REFRESH_WINDOW = float(os.getenv("RECOMMEND_REFRESH_WINDOW", "30"))
+
+
+def taste_target(taste):
+    # Center of a taste's region, capped to the unit circle
+    min_angle, max_angle, min_module, max_module = VALENCE_AROUSAL_TO_TASTE[taste]
+    if min_module == 0:
+        return 0.0, 0.0
+
+    angle = math.radians((min_angle + max_angle) / 2)
+    module = (min_module + min(max_module, 1)) / 2
+    return module * math.cos(angle), module * math.sin(angle)
+
+
+TASTE_TARGETS = {taste: taste_target(taste) for taste in VALENCE_AROUSAL_TO_TASTE}
+
+
+def cell_size_for(count):
+    return min(MAX_CELL_SIZE, max(MIN_CELL_SIZE, math.sqrt(PLANE_AREA * POINTS_PER_CELL / max(count, 1))))
+
+
+class EmotionGrid:
+    """Uniform grid of menu points. A query scans rings of cells around its
+    target and stops once no unseen cell can hold a closer menu. Cells are
+    resized when the number of menus doubles."""
+
+    def __init__(self):
+        self.built = False
+        # Bumped by reset_menu_points(), a build that overlaps one is not kept
+        self.generation = 0
+        # Latest actualizado read from the menus, and when they were last checked
+        self.synced_to = None
+        self.checked_at = 0.0
+        self.clear()
+
+    def clear(self, cell_size=MAX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.points = {}
+        self.bounds = None
+        self.sized_for = 0
+
+    def cell(self, valencia, arousal):
+        return math.floor(valencia / self.cell_size), math.floor(arousal / self.cell_size)
+
+    def build(self, menus):
+        points = [
+            (menu.id, menu.categoria_id, menu.valencia_resultante, menu.arousal_resultante)
+            for menu in menus if menu.valencia_resultante is not None and menu.arousal_resultante is not None
+        ]
+        self.load(points)
+        self.built = True
+
+    def replace(self, other):
+        # Takes the points of a grid built elsewhere
+        self.cell_size, self.cells, self.points = other.cell_size, other.cells, other.points
+        self.bounds, self.sized_for = other.bounds, other.sized_for
+
+    def load(self, points):
+        self.clear(cell_size_for(len(points)))
+        for point in points:
+            self.insert(*point)
+
+        self.sized_for = len(points)
+
+    def insert(self, menu_id, categoria_id, valencia, arousal):
+        x, y = cell = self.cell(valencia, arousal)
+        self.cells[cell][menu_id] = (categoria_id, valencia, arousal)
+        self.points[menu_id] = cell
+        # Never shrunk, they only bound how far a query can look
+        if self.bounds is None:
+            self.bounds = [x, x, y, y]
+        else:
+            self.bounds = [min(self.bounds[0], x), max(self.bounds[1], x), min(self.bounds[2], y), max(self.bounds[3], y)]
+
+    def update(self, menu_id, categoria_id, valencia, arousal):
+        self.remove(menu_id)
+        if valencia is None or arousal is None:
+            return
+
+        self.insert(menu_id, categoria_id, valencia, arousal)
+        if len(self.points) > 2 * max(self.sized_for, POINTS_PER_CELL):
+            self.load([(id, *self.cells[cell][id]) for id, cell in self.points.items()])
+
+    def remove(self, menu_id):
+        cell = self.points.pop(menu_id, None)
+        if cell is not None:
+            del self.cells[cell][menu_id]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def nearest(self, valencia, arousal, k, categoria_id=None, exclude=()):
+        """Returns up to k (menu_id, distance) pairs, closest first."""
+        if not (math.isfinite(valencia) and math.isfinite(arousal)):
+            raise ValueError("valencia and arousal must be finite")
+        if not self.points:
+            return []
+
+        # Rings start from the cell of the grid closest to the target, a cell n rings away from
+        # it is at least n rings away from the target, and no ring is spent outside the grid
+        min_x, max_x, min_y, max_y = self.bounds
+        cx, cy = self.cell(valencia, arousal)
+        cx, cy = min(max(cx, min_x), max_x), min(max(cy, min_y), max_y)
+        max_ring = max(cx - min_x, max_x - cx, cy - min_y, max_y - cy)
+
+        # Max-heap of the k best as (-distance, -id)
+        best = []
+        for ring in range(max_ring + 1):
+            for cell in ring_cells(cx, cy, ring):
+                for menu_id, (menu_categoria_id, menu_valencia, menu_arousal) in self.cells.get(cell, {}).items():
+                    if categoria_id is not None and menu_categoria_id != categoria_id or menu_id in exclude:
+                        continue
+
+                    entry = (-math.hypot(menu_valencia - valencia, menu_arousal - arousal), -menu_id)
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+
+            # Every cell in the next ring is at least `ring` cells away from the target
+            if len(best) == k and -best[0][0] < ring * self.cell_size:
+                break
+
+        return [(-menu_id, -distance) for distance, menu_id in sorted(best, reverse=True)]
+
+
+def ring_cells(cx, cy, ring):
+    if ring == 0:
+        yield cx, cy
+        return
+
+    for x in range(cx - ring, cx + ring + 1):
+        yield x, cy - ring
+        yield x, cy + ring
+    for y in range(cy - ring + 1, cy + ring):
+        yield cx - ring, y
+        yield cx + ring, y
+
+
+menu_points = EmotionGrid()
+
+
+def update_menu_point(menu_id, categoria_id, valencia, arousal):
+    # Called by the routes that change a menu, a no-op until the grid is first built
+    if menu_points.built:
+        menu_points.update(menu_id, categoria_id, valencia, arousal)
+
+
+def remove_menu_point(menu_id):
+    if menu_points.built:
+        menu_points.remove(menu_id)
+
+
+def reset_menu_points():
+    # After writes the routes do not track (recompute jobs), rebuilt on the next query
+    menu_points.generation += 1
+    menu_points.built = False
+
+
+async def user_target(db, usuario_id):
+    """Mean point of a user's experiencias and the menus they already tried,
+    None for users without experiencias."""
+    resumenes = (await db.execute(
+        select(DbExperienciaResumen.menu_id, DbExperienciaResumen.numero_experiencias,
+               DbExperienciaResumen.valencia_total, DbExperienciaResumen.arousal_total)
+        .filter(DbExperienciaResumen.usuario_id == usuario_id)
+    )).all()
+    if not resumenes:
+        return None
+
+    count = sum(resumen.numero_experiencias for resumen in resumenes)
+    valencia = sum(resumen.valencia_total for resumen in resumenes) / count
+    arousal = sum(resumen.arousal_total for resumen in resumenes) / count
+    return valencia, arousal, {resumen.menu_id for resumen in resumenes}
+
+
+POINT_COLUMNS = (DbMenu.id, DbMenu.categoria_id, DbMenu.valencia_resultante, DbMenu.arousal_resultante)
+
+
+def build_grid(rows):
+    grid = EmotionGrid()
+    grid.build(rows)
+    return grid
+
+
+async def build_menu_points(db):
+    generation = menu_points.generation
+    # Read first, the writes made while the menus are read are picked up by the next refresh
+    synced_to = await db.scalar(select(func.max(DbMenu.actualizado)))
+    rows = (await db.execute(select(*POINT_COLUMNS))).all()
+    # Off the event loop, placing every menu is CPU bound
+    grid = await run_in_threadpool(build_grid, rows)
+
+    menu_points.replace(grid)
+    menu_points.synced_to = synced_to
+    # Reset meanwhile, answers this query and is built again on the next one
+    menu_points.built = generation == menu_points.generation
+    # Refreshed on the next query, for the writes made during the build
+    menu_points.checked_at = 0.0
+
+
+async def refresh_menu_points(db):
+    # The menus written since the last refresh, by the index on actualizado
+    statement = select(*POINT_COLUMNS, DbMenu.actualizado)
+    if menu_points.synced_to is not None:
+        statement = statement.filter(DbMenu.actualizado >= menu_points.synced_to - timedelta(seconds=RECOMMEND_REFRESH_WINDOW))
+    for menu_id, categoria_id, valencia, arousal, actualizado in await db.execute(statement):
+        menu_points.update(menu_id, categoria_id, valencia, arousal)
+        if menu_points.synced_to is None or actualizado > menu_points.synced_to:
+            menu_points.synced_to = actualizado
+
+
+async def nearest_menus(db, valencia, arousal, k, categoria_id=None, exclude=()):
+    """Returns the k menus closest to (valencia, arousal) with their
+    distances, closest first."""
+    if not menu_points.built:
+        await build_menu_points(db)
+    elif time.monotonic() - menu_points.checked_at >= RECOMMEND_CHECK_INTERVAL:
+        menu_points.checked_at = time.monotonic()
+        await refresh_menu_points(db)
+
+    while True:
+        nearest = menu_points.nearest(valencia, arousal, k, categoria_id, exclude)
+        menus = {menu.id: menu for menu in await db.scalars(select(DbMenu).filter(DbMenu.id.in_([id for id, _ in nearest])))}
+        # Deleted by another worker, dropped and looked up again
+        gone = [id for id, _ in nearest if id not in menus]
+        if not gone:
+            return [(menus[id], distance) for id, distance in nearest]
+        for id in gone:
+            menu_points.remove(id)
@@ -0,0 +1,288 @@
+"""Rebuilds the menu aggregates (valencia_resultante, arousal_resultante,
+emocion_resultante and numero_experiencias) from the experiencia table, and
+from the daily rollups for the days app.retention already dropped.
+
+    python -m app.recompute [--chunk-size 10000] [--rescore]
+"""
+import argparse
+import logging
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+
+import numpy as np
+from sqlalchemy import func, select, update
+
+from .database import SessionLocal
+from .models import DbMenu, DbExperiencia
+from .retention import retained_since
+from .rollups import menu_totals_before, rebuild_retained_rollups
+from .summaries import rebuild_summaries
+from .scoring import get_emocion_resultante_batch, score_experiencias_batch
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+
+RESCORE_COLUMNS = (
+    DbExperiencia.api, DbExperiencia.emocion_menu, DbExperiencia.emocion_plato,
+    DbExperiencia.valencia_menu, DbExperiencia.arousal_menu, DbExperiencia.valencia_plato, DbExperiencia.arousal_plato,
+    DbExperiencia.sam_valencia, DbExperiencia.sam_arousal
+)
+
+
+def rescore_chunk(session, rows):
+    """Scores the rows again with the current rules and saves the new values.
+    Returns the rows' (menu_id, valencia, arousal) and how many could not be
+    scored, which keep their stored values."""
+    scores, _ = score_experiencias_batch([row._asdict() for row in rows])
+    if scores:
+        # Bulk UPDATE by primary key, sent as a single executemany
+        session.execute(update(DbExperiencia), [{"id": rows[index].id, **score} for index, score in scores.items()])
+
+    resultantes = [
+        (row.menu_id, scores[index]["valencia_resultante"], scores[index]["arousal_resultante"]) if index in scores
+        else (row.menu_id, row.valencia_resultante, row.arousal_resultante)
+        for index, row in enumerate(rows)
+    ]
+    return resultantes, len(rows) - len(scores)
+
+
+def accumulate(totales, resultantes):
+    # Sums a chunk per menu with NumPy and merges it into the running totals
+    resultantes = [r for r in resultantes if None not in r]
+    if not resultantes:
+        return
+
+    menu_ids, valencias, arousals = (np.array(column) for column in zip(*resultantes))
+    menus, inverse = np.unique(menu_ids, return_inverse=True)
+    counts = np.bincount(inverse)
+    valencia_totals = np.bincount(inverse, weights=valencias)
+    arousal_totals = np.bincount(inverse, weights=arousals)
+
+    accumulate_sums(totales, zip(menus.tolist(), counts.tolist(), valencia_totals.tolist(), arousal_totals.tolist()))
+
+
+def accumulate_sums(totales, rows):
+    # Adds (menu_id, count, valencia_total, arousal_total) rows to the running totals
+    for menu_id, count, valencia, arousal in rows:
+        current = totales.setdefault(menu_id, [0, 0.0, 0.0])
+        current[0] += count
+        current[1] += valencia
+        current[2] += arousal
+
+
+def recompute_menu_aggregates(session, chunk_size=DEFAULT_CHUNK_SIZE, rescore=False, progress=None):
+    """Streams the experiencia table with a server-side cursor, `chunk_size`
+    rows at a time, and rewrites every menu aggregate from it in batched
+    updates. With `rescore` the valence, arousal and emotion of every
+    experiencia are computed again from its stored payloads first.
+
+    Memory is bounded by the chunk size and the number of menus. Every
+    experiencia saved bumps its menu's version in the same transaction, so
+    the menus whose version changed while the table was streamed are summed
+    again in SQL at the end, with the menus locked. Their experiencias are
+    then all counted whatever their id or when they were committed, and the
+    job can run while the service takes traffic.
+
+    Days older than the kept experiencias are added from the daily rollups,
+    only the kept ones are read (and rescored).
+
+    `progress(processed, total)` is called after every chunk. The caller owns
+    the transaction and commits it, nothing is committed here. Every menu
+    stays locked until then, experiencias cannot be saved meanwhile."""
+    retained = retained_since(session) or date.max
+    # Before the stream, an experiencia committed after this read changes its menu's version
+    versions_before = dict(session.execute(select(DbMenu.id, DbMenu.version)).all())
+    last_id = session.scalar(select(func.max(DbExperiencia.id))) or 0
+    streamed = [DbExperiencia.id <= last_id, DbExperiencia.fecha >= retained]
+    total = session.scalar(select(func.count()).select_from(DbExperiencia).filter(*streamed))
+
+    columns = [DbExperiencia.id, DbExperiencia.menu_id, DbExperiencia.valencia_resultante, DbExperiencia.arousal_resultante]
+    if rescore:
+        columns.extend(RESCORE_COLUMNS)
+
+    rows = session.execute(
+        select(*columns)
+        .filter(*streamed)
+        .order_by(DbExperiencia.id)
+        .execution_options(yield_per=chunk_size)
+    )
+
+    previous = menu_totals_before(session, retained)
+    totales = {menu_id: list(totals) for menu_id, totals in previous.items()}
+    processed = 0
+    invalid = 0
+    for chunk in rows.partitions():
+        if rescore:
+            resultantes, invalid_chunk = rescore_chunk(session, chunk)
+            invalid += invalid_chunk
+        else:
+            resultantes = [(row.menu_id, row.valencia_resultante, row.arousal_resultante) for row in chunk]
+
+        accumulate(totales, resultantes)
+        processed += len(chunk)
+        if progress is not None:
+            progress(processed, total)
+
+    # Lock the menus so no experiencia updates them between summing the changed ones and the write below
+    versions = dict(session.execute(select(DbMenu.id, DbMenu.version).order_by(DbMenu.id).with_for_update()).all())
+    menu_ids = list(versions)
+    changed = [menu_id for menu_id, version in versions.items() if versions_before.get(menu_id) != version]
+    for start in range(0, len(changed), chunk_size):
+        chunk = changed[start:start + chunk_size]
+        for menu_id in chunk:
+            totales[menu_id] = list(previous.get(menu_id, (0, 0.0, 0.0)))
+        # What the stream read of them is replaced, the rows it rescored are read back from this transaction
+        accumulate_sums(totales, session.execute(
+            select(
+                DbExperiencia.menu_id,
+                func.count(),
+                func.sum(DbExperiencia.valencia_resultante),
+                func.sum(DbExperiencia.arousal_resultante)
+            )
+            .filter(
+                DbExperiencia.menu_id.in_(chunk), DbExperiencia.fecha >= retained,
+                DbExperiencia.valencia_resultante.isnot(None), DbExperiencia.arousal_resultante.isnot(None)
+            )
+            .group_by(DbExperiencia.menu_id)
+        ))
+
+    aggregates = [(menu_id, *totales.pop(menu_id, (0, 0.0, 0.0))) for menu_id in menu_ids]
+    numero = np.array([count for _, count, _, _ in aggregates], dtype=float)
+    divisor = np.maximum(numero, 1)
+    valencias = np.array([valencia for _, _, valencia, _ in aggregates], dtype=float) / divisor
+    arousals = np.array([arousal for _, _, _, arousal in aggregates], dtype=float) / divisor
+    emociones = get_emocion_resultante_batch(valencias, arousals)
+
+    actualizado = datetime.now(timezone.utc)
+    updates = [
+        {
+            "id": menu_id,
+            "valencia_resultante": valencia,
+            "arousal_resultante": arousal,
+            "emocion_resultante": emocion,
+            "numero_experiencias": count,
+            "version": versions[menu_id] + 1,
+            "actualizado": actualizado
+        }
+        for (menu_id, count, _, _), valencia, arousal, emocion in zip(aggregates, valencias.tolist(), arousals.tolist(), emociones.tolist())
+    ]
+    for start in range(0, len(updates), chunk_size):
+        session.execute(update(DbMenu), updates[start:start + chunk_size])
+
+    return {
+        "experiencias": processed,
+        "menus": len(updates),
+        # Written to while the job ran, summed again at the end
+        "menus_modificados": len(changed),
+        "experiencias_invalidas": invalid,
+        # Experiencias of menus that no longer exist
+        "experiencias_huerfanas": sum(count for count, _, _ in totales.values())
+    }
+
+
+class RecomputeJob:
+    def __init__(self, chunk_size, rescore):
+        self.id = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.rescore = rescore
+        self.status = "pending"
+        self.processed = 0
+        self.total = None
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    def update_progress(self, processed, total):
+        self.processed = processed
+        self.total = total
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "chunk_size": self.chunk_size,
+            "rescore": self.rescore,
+            "processed": self.processed,
+            "total": self.total,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+def start_job(chunk_size=DEFAULT_CHUNK_SIZE, rescore=False):
+    # Only one recompute at a time, returns None while another one is running
+    with jobs_lock:
+        if any(job.status in ("pending", "running") for job in jobs.values()):
+            return None
+
+        job = RecomputeJob(chunk_size, rescore)
+        jobs[job.id] = job
+
+    return job
+
+
+def recompute(session, chunk_size=DEFAULT_CHUNK_SIZE, rescore=False, progress=None):
+    """Rebuilds and commits the menu aggregates, which releases the menus,
+    then with `rescore` the user summaries and daily rollups in a second
+    transaction: the rescored experiencias change them too, and they lock
+    the experiencia table while rebuilt."""
+    result = recompute_menu_aggregates(session, chunk_size, rescore, progress=progress)
+    session.commit()
+
+    if rescore:
+        result["resumenes"] = rebuild_summaries(session)
+        result["rollups"] = rebuild_retained_rollups(session)
+        session.commit()
+    return result
+
+
+def run_job(job):
+    job.status = "running"
+    job.started_at = time.time()
+    session = SessionLocal()
+    try:
+        job.result = recompute(session, job.chunk_size, job.rescore, progress=job.update_progress)
+        job.status = "finished"
+    except Exception as exc:
+        logger.exception("Recompute job %s failed", job.id)
+        session.rollback()
+        job.status = "failed"
+        job.error = str(exc)
+    finally:
+        session.close()
+        job.finished_at = time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuilds the menu aggregates from the experiencia table")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--rescore", action="store_true", help="score every experiencia again with the current rules")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    def log_progress(processed, total):
+        logger.info("%d/%d experiencias processed", processed, total)
+
+    session = SessionLocal()
+    try:
+        result = recompute(session, args.chunk_size, args.rescore, progress=log_progress)
+    finally:
+        session.close()
+
+    logger.info("Recompute finished: %s", result)
+
+
+if __name__ == "__main__":
+    main()
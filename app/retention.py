@@ -0,0 +1,133 @@
+"""Retention of the raw experiencias.
+
+On PostgreSQL taca.experiencia is partitioned by month of fecha
+(ddl/create_tables.py), so queries on a range of days only scan its months.
+This module creates the partitions of the coming months and drops the ones
+older than the retention. Before dropping them their experiencias are folded
+into the archived user summaries, and the daily rollups and menu aggregates
+already hold them. Other databases delete the expired rows instead.
+
+    python -m app.retention [--months 24] [--ahead 3]
+"""
+import argparse
+import logging
+import os
+from datetime import date, datetime
+
+from sqlalchemy import delete, func, select, text
+
+from .database import SessionLocal, engine
+from .models import DbExperiencia
+from .summaries import archive_summaries
+
+
+logger = logging.getLogger(__name__)
+
+# Months of raw experiencias kept besides the current one, unset keeps them all
+RETENTION_MONTHS = os.getenv("EXPERIENCIA_RETENTION_MONTHS")
+PARTITIONS_AHEAD = int(os.getenv("EXPERIENCIA_PARTITIONS_AHEAD", "3"))
+
+PARTITION_PREFIX = "experiencia_p"
+
+
+def month_start(day, months=0):
+    # First day of the month `months` after (or before) the one of `day`
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y_%m}"
+
+
+def is_partitioned(connection):
+    if connection.dialect.name != "postgresql":
+        return False
+
+    return connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('taca.experiencia')")).scalar() == "p"
+
+
+def partitions(connection):
+    """First day of the month of every partition, oldest first."""
+    names = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'taca.experiencia'::regclass")).scalars()
+    return sorted(
+        datetime.strptime(name[len(PARTITION_PREFIX):], "%Y_%m").date()
+        for name in names if name.startswith(PARTITION_PREFIX)
+    )
+
+
+def create_partitions(connection, desde, hasta):
+    # One partition per month between the ones of `desde` and `hasta`, both included
+    month = month_start(desde)
+    while month <= hasta:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS taca.{partition_name(month)} PARTITION OF taca.experiencia "
+            f"FOR VALUES FROM ('{month}') TO ('{month_start(month, 1)}')"))
+        month = month_start(month, 1)
+
+
+def ensure_partitions(ahead=PARTITIONS_AHEAD):
+    """Creates the partitions of the current month and the `ahead` next ones,
+    a no-op unless the experiencia table is partitioned."""
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            today = date.today()
+            create_partitions(connection, today, month_start(today, ahead))
+
+
+def retained_since(session):
+    """First day whose raw experiencias are all kept, None when there are
+    none. Older days only live in the rollups and archived summaries."""
+    connection = session.connection()
+    if is_partitioned(connection):
+        months = partitions(connection)
+        return months[0] if months else None
+
+    return session.scalar(select(func.min(DbExperiencia.fecha)))
+
+
+def drop_expired(session, months):
+    """Drops the raw experiencias before the month `months` months ago and
+    returns how many partitions or rows were removed. The caller commits."""
+    cutoff = month_start(date.today(), -months)
+    archive_summaries(session, cutoff)
+
+    connection = session.connection()
+    if is_partitioned(connection):
+        expired = [month for month in partitions(connection) if month < cutoff]
+        for month in expired:
+            connection.execute(text(f"DROP TABLE taca.{partition_name(month)}"))
+        return {"corte": cutoff, "particiones": len(expired)}
+
+    deleted = session.execute(delete(DbExperiencia).where(DbExperiencia.fecha < cutoff))
+    return {"corte": cutoff, "experiencias": deleted.rowcount}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates the upcoming experiencia partitions and drops the expired ones")
+    parser.add_argument("--months", type=int, default=RETENTION_MONTHS and int(RETENTION_MONTHS),
+                        help="months of experiencias kept besides the current one, all of them by default")
+    parser.add_argument("--ahead", type=int, default=PARTITIONS_AHEAD, help="months to create partitions for")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    ensure_partitions(args.ahead)
+    if args.months is None:
+        logger.info("No retention configured, every experiencia is kept")
+        return
+
+    session = SessionLocal()
+    try:
+        result = drop_expired(session, args.months)
+        session.commit()
+    finally:
+        session.close()
+
+    logger.info("Expired experiencias dropped: %s", result)
+
+
+if __name__ == "__main__":
+    main()
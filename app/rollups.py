@@ -0,0 +1,161 @@
+"""Daily totals of the experiencias of every menu per emocion_resultante
+(taca.experiencia_diaria). They keep the history of the raw experiencias
+dropped by app.retention, so the menu aggregates can be recomputed without
+them.
+
+The experiencia routes add to them in the same transaction as the
+experiencias. To rebuild a range of days from the experiencia table:
+
+    python -m app.rollups [--desde 2024-01-01] [--hasta 2024-06-30]
+"""
+import argparse
+import logging
+from datetime import date
+
+from sqlalchemy import delete, func, insert, select, text
+
+from .database import SessionLocal, engine
+from .models import DbMenu, DbExperiencia, DbExperienciaDiaria
+from .retention import retained_since
+from .summaries import dialect_insert
+
+
+logger = logging.getLogger(__name__)
+
+
+def upsert_rollups():
+    statement = dialect_insert(DbExperienciaDiaria)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[DbExperienciaDiaria.menu_id, DbExperienciaDiaria.fecha, DbExperienciaDiaria.emocion_resultante],
+        set_={
+            "numero_experiencias": DbExperienciaDiaria.numero_experiencias + excluded.numero_experiencias,
+            "valencia_total": DbExperienciaDiaria.valencia_total + excluded.valencia_total,
+            "arousal_total": DbExperienciaDiaria.arousal_total + excluded.arousal_total
+        }
+    )
+
+
+def rollup_rows(experiencias):
+    """Folds experiencia column values into one row per (menu_id, fecha,
+    emocion_resultante), sorted so concurrent writers lock them in the same
+    order."""
+    totales = {}
+    for values in experiencias:
+        if values["menu_id"] is None or values["emocion_resultante"] is None:
+            continue
+
+        key = (values["menu_id"], values["fecha"], values["emocion_resultante"])
+        count, valencia_total, arousal_total = totales.get(key, (0, 0.0, 0.0))
+        totales[key] = (count + 1, valencia_total + values["valencia_resultante"], arousal_total + values["arousal_resultante"])
+
+    return [
+        {
+            "menu_id": menu_id,
+            "fecha": fecha,
+            "emocion_resultante": emocion,
+            "numero_experiencias": count,
+            "valencia_total": valencia_total,
+            "arousal_total": arousal_total
+        }
+        for (menu_id, fecha, emocion), (count, valencia_total, arousal_total) in sorted(totales.items())
+    ]
+
+
+async def add_to_rollups(db, experiencias):
+    # Called with the column values of the experiencias about to be committed
+    rows = rollup_rows(experiencias)
+    if rows:
+        await db.execute(upsert_rollups(), rows)
+
+
+def day_range(column, desde, hasta):
+    filters = []
+    if desde is not None:
+        filters.append(column >= desde)
+    if hasta is not None:
+        filters.append(column <= hasta)
+    return filters
+
+
+def rebuild_rollups(session, desde=None, hasta=None):
+    """Replaces the rollups of the days between `desde` and `hasta` (both
+    included, open ended when None) with the totals of the experiencia table,
+    which only scans the partitions of those days. Days whose experiencias
+    were already dropped must be left out of the range. Returns the number of
+    rollups written. The caller commits."""
+    if engine.dialect.name == "postgresql":
+        session.execute(text("LOCK TABLE taca.experiencia IN SHARE MODE"))
+
+    session.execute(delete(DbExperienciaDiaria).where(*day_range(DbExperienciaDiaria.fecha, desde, hasta)))
+    result = session.execute(
+        insert(DbExperienciaDiaria).from_select(
+            ["menu_id", "fecha", "emocion_resultante", "numero_experiencias", "valencia_total", "arousal_total"],
+            select(
+                DbExperiencia.menu_id,
+                DbExperiencia.fecha,
+                DbExperiencia.emocion_resultante,
+                func.count(),
+                func.sum(DbExperiencia.valencia_resultante),
+                func.sum(DbExperiencia.arousal_resultante)
+            )
+            .join(DbMenu, DbMenu.id == DbExperiencia.menu_id)
+            .filter(
+                DbExperiencia.emocion_resultante.isnot(None),
+                DbExperiencia.valencia_resultante.isnot(None), DbExperiencia.arousal_resultante.isnot(None),
+                *day_range(DbExperiencia.fecha, desde, hasta)
+            )
+            .group_by(DbExperiencia.menu_id, DbExperiencia.fecha, DbExperiencia.emocion_resultante)
+        )
+    )
+
+    return result.rowcount
+
+
+def rebuild_retained_rollups(session):
+    # The rollups of every day whose experiencias are kept
+    desde = retained_since(session)
+    return 0 if desde is None else rebuild_rollups(session, desde)
+
+
+def menu_totals_before(session, before):
+    """(count, valencia_total, arousal_total) of every menu over the days
+    before `before`, read from the rollups."""
+    rows = session.execute(
+        select(
+            DbExperienciaDiaria.menu_id,
+            func.sum(DbExperienciaDiaria.numero_experiencias),
+            func.sum(DbExperienciaDiaria.valencia_total),
+            func.sum(DbExperienciaDiaria.arousal_total)
+        )
+        .filter(DbExperienciaDiaria.fecha < before)
+        .group_by(DbExperienciaDiaria.menu_id)
+    )
+    return {menu_id: [count, valencia_total, arousal_total] for menu_id, count, valencia_total, arousal_total in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuilds the daily experiencia rollups of a range of days")
+    parser.add_argument("--desde", type=date.fromisoformat, help="first day, defaults to the oldest kept experiencia")
+    parser.add_argument("--hasta", type=date.fromisoformat, help="last day, open ended by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    session = SessionLocal()
+    try:
+        desde = args.desde or retained_since(session)
+        if desde is None:
+            logger.info("No experiencias to roll up")
+            return
+
+        count = rebuild_rollups(session, desde, args.hasta)
+        session.commit()
+    finally:
+        session.close()
+
+    logger.info("Rebuilt %d daily rollups", count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import logging
+import math
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+EMOTION_TO_VALENCE_AROUSAL = {
+    #valence, arousal, angle diff
+    "happy": (0.866, 0.5, 30),
+    "surprise": (0.0, 1, 60),
+    "fear": (-0.5, 0.866, 30),
+    "angry": (-0.866, 0.5, 30),
+    "disgust": (-1.0, 0.0, 30),
+    "sad": (-0.866, -0.5, 30),
+    "neutral": (0.0, 0.0, 0)
+}
+
+
+VALENCE_AROUSAL_TO_TASTE = {
+    "comun": (0, 360, 0, 0.25),
+    "exquisito": (0, 45, 0.25, 1.5),
+    "delicioso": (45, 90, 0.25, 1.5),
+    "feo": (90, 135, 0.25, 1.5),
+    "desagradable": (135, 180, 0.25, 1.5),
+    "pasado": (180, 225, 0.25, 1.5),
+    "insulso": (225, 270, 0.25, 1.5),
+    "poco sabroso": (270, 315, 0.25, 1.5),
+    "sabroso": (315, 360, 0.25, 1.5),
+}
+
+
+def get_emocion_resultante(valence, arousal):
+    if valence == 0 and arousal == 0:
+        return "comun"
+
+    angle = calculate_angle(valence, arousal)
+    module = math.sqrt(valence * valence + arousal * arousal)
+    for taste, (min_angle, max_angle, min_module, max_module) in VALENCE_AROUSAL_TO_TASTE.items():
+        if min_module <= module and max_module > module:
+            if min_angle <= angle and max_angle > angle:
+                return taste
+        
+    return 'undefined'
+
+
+def calculate_angle(x, y):
+    # Calculate the angle in radians
+    angle_radians = math.atan2(y, x)
+    
+    # Convert the angle to degrees
+    angle_degrees = math.degrees(angle_radians)
+
+    if angle_degrees < 0:
+        angle_degrees += 360
+    
+    return angle_degrees
+
+def calculate_valence_arousal(emocion_json, dominant_emotion):
+    valence = emocion_json["happy"] * EMOTION_TO_VALENCE_AROUSAL["happy"][0] / 100
+    arousal = emocion_json[dominant_emotion] * EMOTION_TO_VALENCE_AROUSAL[dominant_emotion][1] / 100
+    del emocion_json["happy"]
+    del emocion_json["surprise"]
+    del emocion_json["neutral"]
+
+    highest_emotion_negative = sorted(emocion_json.items(), key=lambda item: item[1], reverse=True)[0]
+    valence_negative = highest_emotion_negative[1] * EMOTION_TO_VALENCE_AROUSAL[highest_emotion_negative[0]][0] / 100
+    logger.debug("valence=%s arousal=%s valence_negative=%s", valence, arousal, valence_negative)
+    return valence + valence_negative, arousal
+
+
+
+
+# Batch scoring. Emotion vectors are rows of EMOTIONS percentages, in the
+# order deepface reports them, and dominant emotions their column index.
+EMOTIONS = ("angry", "disgust", "fear", "happy", "sad", "surprise", "neutral")
+
+EMOTION_VALENCE = np.array([EMOTION_TO_VALENCE_AROUSAL[e][0] for e in EMOTIONS])
+EMOTION_AROUSAL = np.array([EMOTION_TO_VALENCE_AROUSAL[e][1] for e in EMOTIONS])
+
+HAPPY = EMOTIONS.index("happy")
+NEGATIVE_EMOTIONS = np.array([i for i, e in enumerate(EMOTIONS) if e not in ("happy", "surprise", "neutral")])
+
+
+def build_taste_lookup(tastes):
+    """Splits the valence/arousal plane into the cells delimited by the module
+    and angle bounds of `tastes` and labels every cell with the first taste
+    covering it, which is what get_emocion_resultante's scan would return."""
+    module_edges = sorted({edge for _, _, min_module, max_module in tastes.values() for edge in (min_module, max_module)})
+    angle_edges = sorted({edge for min_angle, max_angle, _, _ in tastes.values() for edge in (min_angle, max_angle)})
+    labels = list(tastes) + ["undefined"]
+
+    lookup = np.full((len(module_edges) - 1, len(angle_edges) - 1), len(labels) - 1)
+    for mi in range(len(module_edges) - 1):
+        for ai in range(len(angle_edges) - 1):
+            for ti, (min_angle, max_angle, min_module, max_module) in enumerate(tastes.values()):
+                if min_module <= module_edges[mi] and module_edges[mi + 1] <= max_module \
+                        and min_angle <= angle_edges[ai] and angle_edges[ai + 1] <= max_angle:
+                    lookup[mi, ai] = ti
+                    break
+
+    return np.array(module_edges), np.array(angle_edges), lookup, np.array(labels, dtype=object)
+
+
+MODULE_EDGES, ANGLE_EDGES, TASTE_LOOKUP, TASTE_LABELS = build_taste_lookup(VALENCE_AROUSAL_TO_TASTE)
+
+
+def emotion_vector(emotion):
+    return [float(emotion[e]) for e in EMOTIONS]
+
+
+def calculate_valence_arousal_batch(emotions, dominant):
+    """Vectorized calculate_valence_arousal for a (n, len(EMOTIONS)) array of
+    emotion percentages and the (n,) column indexes of their dominant emotion."""
+    emotions = np.asarray(emotions, dtype=float)
+    dominant = np.asarray(dominant, dtype=int)
+    rows = np.arange(len(emotions))
+
+    valence = emotions[:, HAPPY] * EMOTION_VALENCE[HAPPY] / 100
+    arousal = emotions[rows, dominant] * EMOTION_AROUSAL[dominant] / 100
+
+    negative = emotions[:, NEGATIVE_EMOTIONS]
+    strongest = np.argmax(negative, axis=1)
+    valence_negative = negative[rows, strongest] * EMOTION_VALENCE[NEGATIVE_EMOTIONS][strongest] / 100
+
+    return valence + valence_negative, arousal
+
+
+def get_emocion_resultante_batch(valence, arousal):
+    """Vectorized get_emocion_resultante, returns an array of taste labels."""
+    valence = np.asarray(valence, dtype=float)
+    arousal = np.asarray(arousal, dtype=float)
+
+    angle = np.degrees(np.arctan2(arousal, valence))
+    angle = np.where(angle < 0, angle + 360, angle)
+    module = np.sqrt(valence * valence + arousal * arousal)
+
+    mi = np.searchsorted(MODULE_EDGES, module, side="right") - 1
+    ai = np.searchsorted(ANGLE_EDGES, angle, side="right") - 1
+    inside = (mi >= 0) & (mi < TASTE_LOOKUP.shape[0]) & (ai >= 0) & (ai < TASTE_LOOKUP.shape[1])
+
+    taste = np.full(valence.shape, len(TASTE_LABELS) - 1)
+    taste[inside] = TASTE_LOOKUP[mi[inside], ai[inside]]
+
+    labels = TASTE_LABELS[taste]
+    labels[(valence == 0) & (arousal == 0)] = "comun"
+
+    return labels
+
+
+def score_experiencias_batch(payloads):
+    """Scores a batch of experiencia payloads (dicts with the Experiencia
+    fields and the deepface emotion dicts). Returns by input index the valence
+    and arousal of the menu, the plato and the overall experience plus its
+    emotion, and the errors of the payloads that could not be scored."""
+    scores = {}
+    errores = []
+    deepface = []
+    for index, payload in enumerate(payloads):
+        score = {field: payload.get(field) for field in ("valencia_menu", "arousal_menu", "valencia_plato", "arousal_plato")}
+
+        if payload.get("api") == 'deepface':
+            try:
+                deepface.append((
+                    index,
+                    emotion_vector(payload["emocion_menu"]["emotion"]),
+                    emotion_vector(payload["emocion_plato"]["emotion"]),
+                    EMOTIONS.index(payload["emocion_menu"]["dominant_emotion"])
+                ))
+            except (KeyError, TypeError, ValueError):
+                errores.append({"index": index, "message": "Invalid experiencia payload"})
+                continue
+
+        score["sam_valencia"] = payload.get("sam_valencia")
+        score["sam_arousal"] = payload.get("sam_arousal")
+        scores[index] = score
+
+    if deepface:
+        indexes, menus, platos, dominant = zip(*deepface)
+        valencia_menu, arousal_menu = calculate_valence_arousal_batch(menus, dominant)
+        valencia_plato, arousal_plato = calculate_valence_arousal_batch(platos, dominant)
+
+        for index, *values in zip(indexes, valencia_menu.tolist(), arousal_menu.tolist(), valencia_plato.tolist(), arousal_plato.tolist()):
+            scores[index]["valencia_menu"], scores[index]["arousal_menu"], scores[index]["valencia_plato"], scores[index]["arousal_plato"] = values
+
+    for index in [i for i, score in scores.items() if None in score.values()]:
+        del scores[index]
+        errores.append({"index": index, "message": "Invalid experiencia payload"})
+
+    if scores:
+        components = np.array([
+            [score["valencia_menu"], score["valencia_plato"], score["sam_valencia"],
+             score["arousal_menu"], score["arousal_plato"], score["sam_arousal"]]
+            for score in scores.values()
+        ], dtype=float)
+        valencia = (components[:, 0] + components[:, 1] + components[:, 2]) / 3
+        arousal = (components[:, 3] + components[:, 4] + components[:, 5]) / 3
+        emocion = get_emocion_resultante_batch(valencia, arousal)
+        for score, *resultante in zip(scores.values(), valencia.tolist(), arousal.tolist(), emocion.tolist()):
+            del score["sam_valencia"], score["sam_arousal"]
+            score["valencia_resultante"], score["arousal_resultante"], score["emocion_resultante"] = resultante
+
+    return scores, sorted(errores, key=lambda error: error["index"])
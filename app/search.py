@@ -0,0 +1,180 @@
+"""Menu search by text (nombre/descripcion), ingredients and category.
+
+On PostgreSQL queries run on the weighted full-text GIN index over nombre and
+descripcion and the GIN index on ingredientes. Other backends, the SQLite
+stand-in used by the tests, get an in-process inverted index built from the
+menu table on the first search and kept up to date by the menu writes.
+"""
+import math
+import re
+import unicodedata
+from collections import defaultdict
+
+from sqlalchemy import String, func, select, text, type_coerce
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from .database import engine
+from .models import DbMenu, SEARCH_CONFIG, menu_search_document
+
+
+# Relative weight of a description match, as ts_rank weighs 'B' against 'A'
+DESCRIPCION_WEIGHT = 0.4
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(value):
+    # Lowercased words without accents, "Jamón ibérico" -> ["jamon", "iberico"]
+    if not value:
+        return []
+
+    value = value.lower()
+    if not value.isascii():
+        value = "".join(c for c in unicodedata.normalize("NFKD", value) if not unicodedata.combining(c))
+
+    return WORD.findall(value)
+
+
+class InvertedIndex:
+    """Postings of the nombre/descripcion words, ingredients and category of
+    every menu. Text matches need every query word and are ranked by the sum
+    of the words' idf times their weight in the menu."""
+
+    def __init__(self):
+        self.built = False
+        # Bumped by every write, a build that overlaps one is discarded
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.terms = defaultdict(dict)
+        self.ingredientes = defaultdict(set)
+        self.categorias = defaultdict(set)
+        self.documents = {}
+
+    def build(self, menus):
+        self.clear()
+        for menu in menus:
+            self.add(menu)
+
+        self.built = True
+
+    def add(self, menu):
+        self.remove(menu.id)
+
+        weights = defaultdict(float)
+        for term in tokenize(menu.nombre):
+            weights[term] += 1
+        for term in tokenize(menu.descripcion):
+            weights[term] += DESCRIPCION_WEIGHT
+
+        for term, weight in weights.items():
+            self.terms[term][menu.id] = weight
+        for ingrediente in set(menu.ingredientes or []):
+            self.ingredientes[ingrediente].add(menu.id)
+        self.categorias[menu.categoria_id].add(menu.id)
+        self.documents[menu.id] = (list(weights), set(menu.ingredientes or []), menu.categoria_id)
+
+    def remove(self, menu_id):
+        document = self.documents.pop(menu_id, None)
+        if document is None:
+            return
+
+        terms, ingredientes, categoria_id = document
+        for term in terms:
+            self.terms[term].pop(menu_id, None)
+        for ingrediente in ingredientes:
+            self.ingredientes[ingrediente].discard(menu_id)
+        self.categorias[categoria_id].discard(menu_id)
+
+    def search(self, q=None, ingredientes=None, categoria_id=None):
+        # Returns the ids of every matching menu, best first
+        candidates = None
+        for ids in [self.ingredientes.get(i, set()) for i in ingredientes or []]:
+            candidates = set(ids) if candidates is None else candidates & ids
+        if categoria_id is not None:
+            ids = self.categorias.get(categoria_id, set())
+            candidates = set(ids) if candidates is None else candidates & ids
+
+        terms = set(tokenize(q))
+        if not terms:
+            return sorted(self.documents if candidates is None else candidates)
+
+        scores = None
+        for term in terms:
+            postings = self.terms.get(term, {})
+            idf = math.log(1 + len(self.documents) / (1 + len(postings)))
+            if scores is None:
+                scores = {id: idf * weight for id, weight in postings.items() if candidates is None or id in candidates}
+            else:
+                scores = {id: score + idf * postings[id] for id, score in scores.items() if id in postings}
+
+        return sorted(scores, key=lambda id: (-scores[id], id))
+
+
+search_index = InvertedIndex()
+
+
+def index_menu(menu):
+    # Called by the menu writes, a no-op until the index is first built
+    search_index.generation += 1
+    if search_index.built:
+        search_index.add(menu)
+
+
+def reset_search_index():
+    # After bulk writes (imports), rebuilt on the next search
+    search_index.generation += 1
+    search_index.built = False
+
+
+def unindex_menu(menu_id):
+    search_index.generation += 1
+    if search_index.built:
+        search_index.remove(menu_id)
+
+
+async def search_menus(db, q=None, ingredientes=None, categoria_id=None, offset=0, limit=10):
+    """Returns the page of matching menus, best ranked first, and the total
+    number of matches."""
+    if engine.dialect.name == "postgresql":
+        return await search_menus_fulltext(db, q, ingredientes, categoria_id, offset, limit)
+
+    if not search_index.built:
+        generation = search_index.generation
+        menus = await db.execute(select(DbMenu.id, DbMenu.nombre, DbMenu.descripcion, DbMenu.ingredientes, DbMenu.categoria_id))
+        search_index.build(menus)
+        # A menu written meanwhile may be missing, build again on the next search
+        search_index.built = generation == search_index.generation
+
+    ids = search_index.search(q, ingredientes, categoria_id)
+    page = ids[offset:offset + limit]
+    menus = {menu.id: menu for menu in await db.scalars(select(DbMenu).filter(DbMenu.id.in_(page)))}
+
+    return [menus[id] for id in page if id in menus], len(ids)
+
+
+def fulltext_filters(q, ingredientes, categoria_id):
+    """WHERE clauses and ORDER BY of a search on the PostgreSQL indexes."""
+    filters = []
+    order_by = [DbMenu.id]
+    if q:
+        document = menu_search_document()
+        tsquery = func.websearch_to_tsquery(text(f"'{SEARCH_CONFIG}'::regconfig"), q)
+        filters.append(document.op("@@")(tsquery))
+        order_by.insert(0, func.ts_rank(document, tsquery).desc())
+    if ingredientes:
+        # @> on the GIN index, the column is only an ARRAY on PostgreSQL
+        filters.append(type_coerce(DbMenu.ingredientes, ARRAY(String)).contains(ingredientes))
+    if categoria_id is not None:
+        filters.append(DbMenu.categoria_id == categoria_id)
+
+    return filters, order_by
+
+
+async def search_menus_fulltext(db, q, ingredientes, categoria_id, offset, limit):
+    filters, order_by = fulltext_filters(q, ingredientes, categoria_id)
+    menus = await db.scalars(select(DbMenu).filter(*filters).order_by(*order_by).offset(offset).limit(limit))
+    total = await db.scalar(select(func.count()).select_from(DbMenu).filter(*filters))
+
+    return list(menus), total
@@ -0,0 +1,160 @@
+"""Per user and menu totals of the experiencias (taca.experiencia_resumen), so
+a user's history is read with primary key lookups instead of scanning the
+experiencia table.
+
+The experiencia routes add to them in the same transaction as the
+experiencias. The experiencias dropped by app.retention are folded into
+taca.experiencia_resumen_archivo first. To rebuild them from the whole
+history:
+
+    python -m app.summaries
+"""
+import logging
+
+from sqlalchemy import case, delete, func, insert, select, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .database import SessionLocal, engine
+from .models import DbMenu, DbExperiencia, DbExperienciaResumen, DbExperienciaResumenArchivo
+
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_COLUMNS = ["usuario_id", "menu_id", "numero_experiencias", "valencia_total", "arousal_total", "ultima_fecha"]
+
+
+def dialect_insert(table):
+    # INSERT supporting ON CONFLICT, both backends share the syntax
+    return (postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert)(table)
+
+
+def upsert_summaries(table=DbExperienciaResumen, select_from=None):
+    # Adds to the totals, of the VALUES given on execution or of a SELECT
+    statement = dialect_insert(table)
+    if select_from is not None:
+        statement = statement.from_select(SUMMARY_COLUMNS, select_from)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.usuario_id, table.menu_id],
+        set_={
+            "numero_experiencias": table.numero_experiencias + excluded.numero_experiencias,
+            "valencia_total": table.valencia_total + excluded.valencia_total,
+            "arousal_total": table.arousal_total + excluded.arousal_total,
+            "ultima_fecha": case(
+                (table.ultima_fecha.is_(None) | (excluded.ultima_fecha > table.ultima_fecha), excluded.ultima_fecha),
+                else_=table.ultima_fecha
+            )
+        }
+    )
+
+
+def experiencia_totals(*filters):
+    # Totals per user and menu of the experiencias matching the filters
+    return (
+        select(
+            DbExperiencia.usuario_id,
+            DbExperiencia.menu_id,
+            func.count().label("numero_experiencias"),
+            func.sum(DbExperiencia.valencia_resultante).label("valencia_total"),
+            func.sum(DbExperiencia.arousal_resultante).label("arousal_total"),
+            func.max(DbExperiencia.fecha).label("ultima_fecha")
+        )
+        # Orphan experiencias from before the foreign key have no menu to summarize
+        .join(DbMenu, DbMenu.id == DbExperiencia.menu_id)
+        .filter(
+            DbExperiencia.usuario_id.isnot(None),
+            DbExperiencia.valencia_resultante.isnot(None), DbExperiencia.arousal_resultante.isnot(None),
+            *filters
+        )
+        .group_by(DbExperiencia.usuario_id, DbExperiencia.menu_id)
+    )
+
+
+def summary_rows(experiencias):
+    """Folds experiencia column values into one row per (usuario_id, menu_id),
+    sorted so concurrent writers lock the summaries in the same order."""
+    totales = {}
+    for values in experiencias:
+        if values["usuario_id"] is None or values["menu_id"] is None:
+            continue
+
+        key = (values["usuario_id"], values["menu_id"])
+        count, valencia_total, arousal_total, fecha = totales.get(key, (0, 0.0, 0.0, None))
+        totales[key] = (
+            count + 1,
+            valencia_total + values["valencia_resultante"],
+            arousal_total + values["arousal_resultante"],
+            values["fecha"] if fecha is None or values["fecha"] > fecha else fecha
+        )
+
+    return [
+        {
+            "usuario_id": usuario_id,
+            "menu_id": menu_id,
+            "numero_experiencias": count,
+            "valencia_total": valencia_total,
+            "arousal_total": arousal_total,
+            "ultima_fecha": fecha
+        }
+        for (usuario_id, menu_id), (count, valencia_total, arousal_total, fecha) in sorted(totales.items())
+    ]
+
+
+async def add_to_summaries(db, experiencias):
+    # Called with the column values of the experiencias about to be committed
+    rows = summary_rows(experiencias)
+    if rows:
+        await db.execute(upsert_summaries(), rows)
+
+
+def rebuild_summaries(session):
+    """Replaces every summary with the totals of the experiencia table plus
+    the archived ones in a single INSERT ... SELECT, experiencia writes wait
+    for it on PostgreSQL. Returns the number of summaries. The caller
+    commits."""
+    if engine.dialect.name == "postgresql":
+        session.execute(text("LOCK TABLE taca.experiencia IN SHARE MODE"))
+
+    archivo = DbExperienciaResumenArchivo
+    totales = union_all(
+        experiencia_totals(),
+        select(archivo.usuario_id, archivo.menu_id, archivo.numero_experiencias, archivo.valencia_total,
+               archivo.arousal_total, archivo.ultima_fecha)
+    ).subquery()
+
+    session.execute(delete(DbExperienciaResumen))
+    session.execute(
+        insert(DbExperienciaResumen).from_select(
+            SUMMARY_COLUMNS,
+            select(
+                totales.c.usuario_id, totales.c.menu_id, func.sum(totales.c.numero_experiencias),
+                func.sum(totales.c.valencia_total), func.sum(totales.c.arousal_total), func.max(totales.c.ultima_fecha)
+            ).group_by(totales.c.usuario_id, totales.c.menu_id)
+        )
+    )
+
+    return session.scalar(select(func.count()).select_from(DbExperienciaResumen))
+
+
+def archive_summaries(session, before):
+    """Adds the totals of the experiencias older than `before` to the
+    archived summaries, called by app.retention before dropping them."""
+    session.execute(upsert_summaries(DbExperienciaResumenArchivo, experiencia_totals(DbExperiencia.fecha < before)))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    session = SessionLocal()
+    try:
+        count = rebuild_summaries(session)
+        session.commit()
+    finally:
+        session.close()
+
+    logger.info("Rebuilt %d experiencia summaries", count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+
+from .cache import Cache, MemoryBackend, MISSING
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_entries=2, ttl=60)
+    run(backend.set("a", 1))
+    run(backend.set("b", 2))
+    assert run(backend.get("a")) == 1
+    run(backend.set("c", 3))
+
+    assert run(backend.get("b")) is MISSING
+    assert run(backend.get("a")) == 1
+    assert run(backend.get("c")) == 3
+
+
+def test_memory_backend_expires_entries():
+    backend = MemoryBackend(max_entries=10, ttl=60)
+    run(backend.set("a", 1, ttl=0))
+    run(backend.set("b", 2))
+
+    assert run(backend.get("a")) is MISSING
+    assert run(backend.get("b")) == 2
+    assert backend.size() == 1
+
+
+def test_cache_loads_once_and_counts_per_namespace():
+    cache = Cache(MemoryBackend(max_entries=10, ttl=60))
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return {"id": 1}
+
+    assert run(cache.get_or_load("menu:1", loader)) == {"id": 1}
+    assert run(cache.get_or_load("menu:1", loader)) == {"id": 1}
+    run(cache.invalidate("menu:1"))
+    assert run(cache.get_or_load("menu:1", loader)) == {"id": 1}
+
+    assert len(loads) == 2
+    assert cache.stats()["namespaces"]["menu"] == {"hits": 1, "misses": 2, "hit_ratio": 1 / 3}
+
+
+def test_cache_does_not_store_missing_values():
+    cache = Cache(MemoryBackend(max_entries=10, ttl=60))
+
+    async def loader():
+        return None
+
+    run(cache.get_or_load("menu:0", loader))
+    run(cache.get_or_load("menu:0", loader))
+
+    assert cache.stats()["namespaces"]["menu"]["misses"] == 2
+
+
+def test_cache_loads_only_missing_keys_in_one_call():
+    cache = Cache(MemoryBackend(max_entries=10, ttl=60))
+    loads = []
+
+    async def loader(keys):
+        loads.append(keys)
+        # menu:3 does not exist
+        return {key: {"id": key} for key in keys if key != "menu:3"}
+
+    run(cache.get_or_load("menu:1", lambda: asyncio.sleep(0, {"id": "menu:1"})))
+    values = run(cache.get_many_or_load(["menu:1", "menu:2", "menu:3"], loader))
+
+    assert values == {"menu:1": {"id": "menu:1"}, "menu:2": {"id": "menu:2"}}
+    assert loads == [["menu:2", "menu:3"]]
+    assert run(cache.get_many_or_load(["menu:2", "menu:3"], loader)) == {"menu:2": {"id": "menu:2"}}
+    assert loads[-1] == ["menu:3"]
+
+
+def test_loads_started_before_an_invalidation_are_not_stored():
+    cache = Cache(MemoryBackend(max_entries=10, ttl=60))
+
+    async def scenario():
+        async def stale_loader():
+            # The row is updated and its key invalidated while this load reads the old one
+            await cache.invalidate("menu:1")
+            return {"id": 1, "nombre": "antiguo"}
+
+        async def stale_many_loader(keys):
+            await cache.invalidate("menu:2")
+            return {key: {"id": key} for key in keys}
+
+        assert await cache.get_or_load("menu:1", stale_loader) == {"id": 1, "nombre": "antiguo"}
+        values = await cache.get_many_or_load(["menu:2", "menu:3"], stale_many_loader)
+        assert set(values) == {"menu:2", "menu:3"}
+        return [await cache.backend.get(key) for key in ["menu:1", "menu:2", "menu:3"]]
+
+    assert run(scenario()) == [MISSING, MISSING, {"id": "menu:3"}]
+
+
+def test_evicted_generations_do_not_go_back():
+    backend = MemoryBackend(max_entries=1, ttl=60)
+
+    async def scenario():
+        generations = await backend.get_generations(["a"])
+        await backend.delete("a")
+        # Pushes the generation of "a" out
+        await backend.delete("b")
+        await backend.set_many({"a": 1}, generations=generations)
+        return await backend.get("a")
+
+    assert run(scenario()) is MISSING
@@ -0,0 +1,203 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+
+from . import ingest, metrics
+from .database import SessionLocal
+from .ingest import FileBackend, MemoryBackend, QueueFull, WriteBehindQueue
+from .main import app
+from .models import DbMenu, DbExperiencia
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_queue_writes_in_groups():
+    groups = []
+
+    async def flush(entries):
+        groups.append([value for _, value in entries])
+
+    async def scenario():
+        queue = WriteBehindQueue("prueba", MemoryBackend(), flush, batch_size=3, flush_interval=0.01)
+        queue.start()
+        for value in range(7):
+            await queue.put(value)
+        await queue.stop()
+
+    run(scenario())
+    assert groups == [[0, 1, 2], [3, 4, 5], [6]]
+    assert "prueba" not in metrics.queue_depths
+
+
+def test_queue_retries_failed_groups(monkeypatch):
+    monkeypatch.setattr(ingest, "RETRY_DELAY", 0.01)
+    attempts = []
+
+    async def flush(entries):
+        attempts.append(len(entries))
+        if len(attempts) == 1:
+            raise OperationalError("INSERT", {}, ConnectionRefusedError("database down"))
+
+    async def scenario():
+        queue = WriteBehindQueue("prueba", MemoryBackend(), flush, flush_interval=0)
+        queue.start()
+        await queue.put("a")
+        await queue.put("b")
+        # The first attempt and its retry, a failure while stopping is not retried
+        await asyncio.sleep(0.1)
+        await queue.stop()
+        return queue.depth()
+
+    assert run(scenario()) == 0
+    assert attempts == [2, 2]
+
+
+def test_queue_rejects_puts_when_full():
+    async def scenario():
+        queue = WriteBehindQueue("prueba", MemoryBackend(), None, max_size=1)
+        await queue.put("a")
+        try:
+            await queue.put("b")
+        except QueueFull:
+            return True
+
+    assert run(scenario())
+
+
+def test_queue_outlasts_outages(monkeypatch):
+    monkeypatch.setattr(ingest, "RETRY_DELAY", 0.001)
+    monkeypatch.setattr(ingest, "MAX_RETRY_DELAY", 0.002)
+    failures = []
+    written = []
+
+    async def flush(entries):
+        # Far more failures than max_attempts, as during a failover
+        if len(failures) < 20:
+            failures.append(1)
+            raise OperationalError("INSERT", {}, ConnectionRefusedError("database down"))
+        written.extend(value for _, value in entries)
+
+    async def scenario():
+        queue = WriteBehindQueue("caida", MemoryBackend(), flush, flush_interval=0, max_attempts=3)
+        queue.start()
+        for value in ["a", "b", "c"]:
+            await queue.put(value)
+        await asyncio.sleep(0.3)
+        await queue.stop()
+
+    run(scenario())
+    assert written == ["a", "b", "c"]
+    assert metrics.queue_dropped[("caida",)] == 0
+
+
+def test_bad_entries_are_found_by_halving_the_group(monkeypatch):
+    monkeypatch.setattr(ingest, "RETRY_DELAY", 0.001)
+    groups = []
+
+    async def flush(entries):
+        values = [value for _, value in entries]
+        if "malo" in values:
+            raise RuntimeError("cannot be written")
+        groups.append(values)
+
+    async def scenario():
+        queue = WriteBehindQueue("mitades", MemoryBackend(), flush, batch_size=8, flush_interval=0.05, max_attempts=2)
+        queue.start()
+        for value in ["a", "b", "c", "malo", "d", "e", "f", "g"]:
+            await queue.put(value)
+        await asyncio.sleep(0.2)
+        await queue.stop()
+        return queue.depth()
+
+    assert run(scenario()) == 0
+    assert groups == [["a", "b"], ["c"], ["d", "e", "f", "g"]]
+    assert metrics.queue_dropped[("mitades",)] == 1
+
+
+def test_failing_groups_are_dropped_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(ingest, "RETRY_DELAY", 0.001)
+    written = []
+
+    async def flush(entries):
+        if any(value == "malo" for _, value in entries):
+            raise RuntimeError("cannot be written")
+        written.extend(value for _, value in entries)
+
+    async def scenario():
+        queue = WriteBehindQueue("prueba", MemoryBackend(), flush, batch_size=1, flush_interval=0, max_attempts=3)
+        queue.start()
+        for value in ["a", "malo", "b"]:
+            await queue.put(value)
+        await asyncio.sleep(0.1)
+        await queue.stop()
+
+    run(scenario())
+    assert written == ["a", "b"]
+    assert metrics.queue_dropped[("prueba",)] == 1
+
+
+def test_file_journals_are_per_worker(tmp_path):
+    directory = str(tmp_path)
+    first = FileBackend(directory)
+    first.put([("1", {"menu_id": 1}), ("2", {"menu_id": 2})])
+
+    # A live worker's journal is left alone
+    second = FileBackend(directory)
+    assert len(second) == 0
+    second.put([("3", {"menu_id": 3})])
+
+    # Removing what was written leaves the rest, by id
+    first.remove([("2", {"menu_id": 2})])
+    assert first.peek(10) == [("1", {"menu_id": 1})]
+    first.close()
+    second.close()
+
+
+def test_file_queue_adopts_journals_of_dead_workers(tmp_path):
+    directory = str(tmp_path)
+    backend = FileBackend(directory)
+    backend.put([("1", {"menu_id": 1}), ("2", {"menu_id": 2})])
+    backend.close()
+
+    flushed = []
+
+    async def flush(entries):
+        flushed.extend(entries)
+
+    async def scenario():
+        queue = WriteBehindQueue("prueba", FileBackend(directory), flush, flush_interval=0)
+        queue.start()
+        await queue.stop()
+
+    run(scenario())
+    assert flushed == [("1", {"menu_id": 1}), ("2", {"menu_id": 2})]
+    assert len(FileBackend(directory)) == 0
+
+
+def test_experiencias_are_queued(monkeypatch):
+    monkeypatch.setattr(ingest, "EXPERIENCIA_QUEUE", "memory")
+    with SessionLocal() as db:
+        menu = DbMenu(nombre="plato encolado", ingredientes=["i1"], valencia_resultante=0, arousal_resultante=0,
+                      emocion_resultante="comun", numero_experiencias=0)
+        db.add(menu)
+        db.commit()
+        menu_id = menu.id
+
+    payload = {
+        "usuario_id": 1, "menu_id": menu_id, "emocion_menu": {}, "arousal_menu": 0.5, "valencia_menu": 0.5,
+        "emocion_plato": {}, "arousal_plato": 0.5, "valencia_plato": 0.5, "sam_valencia": 0.5, "sam_arousal": 0.5, "api": "sam"
+    }
+    with TestClient(app) as client:
+        responses = [client.post("/experiencia", json=payload) for _ in range(3)]
+        assert [response.status_code for response in responses] == [202] * 3
+        assert responses[0].json()["estado"] == "encolada"
+        assert 'queue_depth{queue="experiencia"}' in client.get("/metrics").text
+        assert client.post("/experiencia", json={**payload, "menu_id": 0}).status_code == 404
+    # Closing the client stops the app, which writes what is still queued
+
+    with SessionLocal() as db:
+        assert db.get(DbMenu, menu_id).numero_experiencias == 3
+        assert db.query(DbExperiencia).filter(DbExperiencia.menu_id == menu_id).count() == 3
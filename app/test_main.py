@@ -1,9 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+import json
+import math
+from datetime import date, timedelta
+import uuid
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import func, select, update
+from .database import SessionLocal
+from . import importer, recommend
 from .main import app
+from .models import DbMenu, DbExperiencia
+from .summaries import rebuild_summaries
+from .rollups import rebuild_rollups
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def client_lifespan():
+    # Share one event loop (and its pooled connections) across the module
+    with client:
+        yield
+
+
 def test_read_root():
     response = client.get("/")
     assert response.status_code == 200
@@ -12,9 +33,9 @@ def test_read_root():
 
 def test_menu_creation():
     data = {
-        "categoria": "c1",
+        "categoria_id": 1,
         "descripcion": "plato de prueba",
-        "praparacion": "preparas el plato",
+        "preparacion": "preparas el plato",
         "ingredientes": ["i1", "i2", "i3", "i4"]
     }
     response = client.post("/menus", json=data)
@@ -25,9 +46,9 @@ def test_menu_creation():
 
 def test_get_menu():
     data = {
-        "categoria": "c1",
+        "categoria_id": 1,
         "descripcion": "plato de prueba",
-        "praparacion": "preparas el plato",
+        "preparacion": "preparas el plato",
         "ingredientes": ["i1", "i2", "i3","i4"]
     }
     menu = client.post("/menus", json=data)
@@ -45,9 +66,9 @@ def test_get_menu_not_found():
 
 def test_delete_menu_then_not_found():
     menu = client.post("/menus", json={
-        "categoria": "c1",
+        "categoria_id": 1,
         "descripcion": "plato de prueba",
-        "praparacion": "preparas el plato",
+        "preparacion": "preparas el plato",
         "ingredientes": ["i1", "i2", "i3","i4"]
     })
     response = client.delete(f"/menus/{menu.json()['id']}")
@@ -64,4 +85,620 @@ def test_delete_menu_not_found():
 def test_hello_name_with_alex():
     response = client.get("/hello/Alex")
     assert response.status_code == 200
-    assert response.json() == {"message": "Hello, Alex!"}
\ No newline at end of file
+    assert response.json() == {"message": "Hello, Alex!"}
+
+def test_menu_por_usuario_categoria_aggregates_experiences():
+    menu = client.post("/menus", json={
+        "nombre": "plato agregado",
+        "categoria_id": 424242,
+        "descripcion": "plato de prueba",
+        "preparacion": "preparas el plato",
+        "ingredientes": ["i1", "i2"]
+    }).json()
+    for valencia, arousal in [(0.9, 0.3), (0.3, 0.9)]:
+        client.post("/experiencia", json={
+            "usuario_id": 424242,
+            "menu_id": menu["id"],
+            "emocion_menu": {},
+            "arousal_menu": arousal,
+            "valencia_menu": valencia,
+            "emocion_plato": {},
+            "arousal_plato": arousal,
+            "valencia_plato": valencia,
+            "sam_valencia": valencia,
+            "sam_arousal": arousal,
+            "api": "sam"
+        })
+
+    response = client.get("/menu_por_usuario_categoria?usuarioid=424242&categoriaid=424242")
+    assert response.status_code == 200
+    platos = [p for p in response.json() if p["id"] == menu["id"]]
+    assert len(platos) == 1
+    assert platos[0]["numero_experiencias"] == 2
+    assert platos[0]["valencia_resultante"] == pytest.approx(0.6)
+    assert platos[0]["arousal_resultante"] == pytest.approx(0.6)
+    assert platos[0]["emocion_resultante"] == "delicioso"
+
+    # Its history is kept, the menu cannot be deleted
+    response = client.delete(f"/menus/{menu['id']}")
+    assert response.status_code == 409
+    assert client.get(f"/menus/{menu['id']}").json()["numero_experiencias"] == 2
+    assert len(client.get("/menu_por_usuario_categoria?usuarioid=424242&categoriaid=424242").json()) == 1
+
+
+def test_get_menus_cursor_pagination():
+    created = [
+        client.post("/menus", json={"nombre": f"plato {i}", "ingredientes": ["i1"]}).json()["id"]
+        for i in range(3)
+    ]
+
+    ids = []
+    response = client.get("/menus?per_page=2&include_total=false").json()
+    while True:
+        assert response["total"] is None
+        ids.extend(m["id"] for m in response["menus"])
+        if response["next_cursor"] is None:
+            break
+        response = client.get(f"/menus?per_page=2&include_total=false&cursor={response['next_cursor']}").json()
+        assert response["page"] is None
+
+    assert ids == sorted(set(ids))
+    assert set(created) <= set(ids)
+
+    response = client.get(f"/menus?per_page=2&after_id={created[0]}")
+    assert response.status_code == 200
+    assert [m["id"] for m in response.json()["menus"]] == created[1:]
+    assert response.json()["total"] == len(ids)
+
+
+def test_get_menus_limits():
+    assert client.get("/menus?per_page=101").status_code == 422
+    response = client.get("/menus?cursor=not-a-cursor")
+    assert response.status_code == 400
+    assert response.json() == {"message": "Invalid cursor"}
+
+
+def post_experiencia(menu_id, valencia, arousal, usuario_id=1):
+    return client.post("/experiencia", json={
+        "usuario_id": usuario_id,
+        "menu_id": menu_id,
+        "emocion_menu": {},
+        "arousal_menu": arousal,
+        "valencia_menu": valencia,
+        "emocion_plato": {},
+        "arousal_plato": arousal,
+        "valencia_plato": valencia,
+        "sam_valencia": valencia,
+        "sam_arousal": arousal,
+        "api": "sam"
+    })
+
+
+def test_create_experiencia_menu_not_found():
+    response = post_experiencia(0, 0.5, 0.5)
+    assert response.status_code == 404
+    assert response.json() == {"message": "Menu not found"}
+
+
+def test_concurrent_experiencias_do_not_lose_updates():
+    menu_id = client.post("/menus", json={"nombre": "plato concurrido", "ingredientes": ["i1"]}).json()["id"]
+    valencias = [i / 40 for i in range(40)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(lambda v: post_experiencia(menu_id, v, -v / 2), valencias))
+
+    assert all(r.status_code == 201 for r in responses)
+    menu = client.get(f"/menus/{menu_id}").json()
+    assert menu["numero_experiencias"] == len(valencias)
+    assert menu["valencia_resultante"] == pytest.approx(sum(valencias) / len(valencias))
+    assert menu["arousal_resultante"] == pytest.approx(-sum(valencias) / len(valencias) / 2)
+    assert menu["emocion_resultante"] == "sabroso"
+
+
+def test_create_experiencias_lote():
+    menus = [
+        client.post("/menus", json={"nombre": f"plato lote {i}", "ingredientes": ["i1"]}).json()["id"]
+        for i in range(2)
+    ]
+    experiencia = {
+        "usuario_id": 7,
+        "emocion_menu": {},
+        "emocion_plato": {},
+        "api": "sam"
+    }
+    lote = [
+        {**experiencia, "menu_id": menus[0], "valencia_menu": 0.6, "valencia_plato": 0.6, "sam_valencia": 0.6,
+         "arousal_menu": 0.3, "arousal_plato": 0.3, "sam_arousal": 0.3},
+        {**experiencia, "menu_id": 0, "valencia_menu": 0.6, "valencia_plato": 0.6, "sam_valencia": 0.6,
+         "arousal_menu": 0.3, "arousal_plato": 0.3, "sam_arousal": 0.3},
+        {**experiencia, "menu_id": menus[1], "valencia_menu": -0.6, "valencia_plato": -0.6, "sam_valencia": -0.6,
+         "arousal_menu": 0.3, "arousal_plato": 0.3, "sam_arousal": 0.3},
+        {**experiencia, "menu_id": menus[0], "valencia_menu": 0.2, "valencia_plato": 0.2, "sam_valencia": 0.2,
+         "arousal_menu": 0.1, "arousal_plato": 0.1, "sam_arousal": 0.1},
+        {**experiencia, "menu_id": menus[0], "api": "deepface", "emocion_menu": {"emotion": {}}},
+        # Does not match the schema, rejected alone
+        {**experiencia, "menu_id": "primero", "sam_valencia": 0.5, "sam_arousal": 0.5},
+    ]
+
+    response = client.post("/experiencia/lote", json=lote)
+    assert response.status_code == 201
+    body = response.json()
+    assert [e["index"] for e in body["experiencias"]] == [0, 2, 3]
+    assert [e["menu_id"] for e in body["experiencias"]] == [menus[0], menus[1], menus[0]]
+    assert len({e["id"] for e in body["experiencias"]}) == 3
+    assert body["experiencias"][1]["emocion_resultante"] == "desagradable"
+    assert body["errores"] == [
+        {"index": 1, "message": "Menu not found"},
+        {"index": 4, "message": "Invalid experiencia payload"},
+        {"index": 5, "message": "Invalid experiencia, menu_id: Input should be a valid integer, unable to parse string as an integer"}
+    ]
+
+    menu = client.get(f"/menus/{menus[0]}").json()
+    assert menu["numero_experiencias"] == 2
+    assert menu["valencia_resultante"] == pytest.approx(0.4)
+    assert menu["arousal_resultante"] == pytest.approx(0.2)
+    assert client.get(f"/menus/{menus[1]}").json()["numero_experiencias"] == 1
+
+
+def test_create_experiencias_lote_too_large():
+    response = client.post("/experiencia/lote", json=[{}] * 1001)
+    assert response.status_code == 422
+
+
+def test_create_experiencia_deepface():
+    menu_id = client.post("/menus", json={"nombre": "plato deepface", "ingredientes": ["i1"]}).json()["id"]
+    emotion = {"angry": 1.0, "disgust": 0.5, "fear": 8.5, "happy": 70.0, "sad": 5.0, "surprise": 10.0, "neutral": 5.0}
+
+    response = client.post("/experiencia", json={
+        "usuario_id": 1,
+        "menu_id": menu_id,
+        "emocion_menu": {"emotion": emotion, "dominant_emotion": "happy"},
+        "emocion_plato": {"emotion": emotion, "dominant_emotion": "happy"},
+        "sam_valencia": 0.5,
+        "sam_arousal": 0.5,
+        "api": "deepface"
+    })
+
+    assert response.status_code == 201
+    body = response.json()
+    assert body["emocion_menu"]["emotion"] == emotion
+    assert body["valencia_menu"] == pytest.approx(0.70 * 0.866 - 0.085 * 0.5)
+    assert body["arousal_menu"] == pytest.approx(0.70 * 0.5)
+    assert body["valencia_resultante"] == pytest.approx((2 * (0.70 * 0.866 - 0.085 * 0.5) + 0.5) / 3)
+    assert body["emocion_resultante"] == "exquisito"
+
+
+def test_recalcular_agregados_job():
+    response = client.post("/recalcular_agregados?chunk_size=500")
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+
+    # Background tasks run before the test client returns the response
+    job = client.get(f"/recalcular_agregados/{job_id}").json()
+    assert job["status"] == "finished"
+    assert job["processed"] == job["total"]
+    assert job["result"]["menus"] > 0
+    # Summaries and rollups only change when rescoring
+    assert "resumenes" not in job["result"]
+
+    job = client.get(f"/recalcular_agregados/{client.post('/recalcular_agregados?rescore=true').json()['id']}").json()
+    assert job["status"] == "finished"
+    assert job["result"]["resumenes"] >= 0
+
+    assert client.get("/recalcular_agregados/unknown").status_code == 404
+
+
+def test_cached_menu_is_invalidated_on_writes():
+    menu_id = client.post("/menus", json={"nombre": "plato cacheado", "categoria_id": 5150, "ingredientes": ["i1"]}).json()["id"]
+    assert client.get(f"/menus/{menu_id}").json()["numero_experiencias"] == 0
+    assert client.get("/menu_por_categorias?categoria2=5150").json()[0]["numero_experiencias"] == 0
+    hits = client.get("/estadisticas_cache").json()["namespaces"]["menu"]["hits"]
+    assert client.get(f"/menus/{menu_id}").json()["numero_experiencias"] == 0
+    assert client.get("/estadisticas_cache").json()["namespaces"]["menu"]["hits"] == hits + 1
+
+    post_experiencia(menu_id, 0.5, 0.5)
+    assert client.get(f"/menus/{menu_id}").json()["numero_experiencias"] == 1
+    assert client.get("/menu_por_categorias?categoria2=5150").json()[0]["numero_experiencias"] == 1
+
+    client.put(f"/menu/{menu_id}", json={"nombre": "plato renombrado", "categoria_id": 5151})
+    assert client.get(f"/menus/{menu_id}").json()["nombre"] == "plato renombrado"
+    assert client.get("/menu_por_categorias?categoria2=5150").json() == []
+    assert client.get("/menu_por_categorias?categoria2=5151").json()[0]["nombre"] == "plato renombrado"
+
+    menu_id = client.post("/menus", json={"nombre": "plato borrado", "categoria_id": 5151, "ingredientes": ["i1"]}).json()["id"]
+    assert len(client.get("/menu_por_categorias?categoria2=5151").json()) == 2
+    assert client.get(f"/menus/{menu_id}").status_code == 200
+    client.delete(f"/menus/{menu_id}")
+    assert client.get(f"/menus/{menu_id}").status_code == 404
+    assert len(client.get("/menu_por_categorias?categoria2=5151").json()) == 1
+
+
+def test_cached_categorias_are_invalidated_on_create():
+    client.get("/consultar_categorias")
+    nombre = f"cacheada {uuid.uuid4().hex}"
+    categoria = client.post("/crear_categorias", json={"categoria": nombre, "descripcion": nombre}).json()
+    assert categoria["id"] in [c["id"] for c in client.get("/consultar_categorias").json()["categorias"]]
+
+
+def test_structured_columns_round_trip():
+    ingredientes = ["sal, pimienta", "aceite de oliva"]
+    menu_id = client.post("/menus", json={"nombre": "plato estructurado", "categoria_id": 5152, "ingredientes": ingredientes}).json()["id"]
+    assert client.get(f"/menus/{menu_id}").json()["ingredientes"] == ingredientes
+    assert client.get("/menu_por_categorias?categoria2=5152").json()[0]["ingredientes"] == ingredientes
+
+    emotion = {"angry": 0.0, "disgust": 0.0, "fear": 0.0, "happy": 100.0, "sad": 0.0, "surprise": 0.0, "neutral": 0.0}
+    payload = {"emotion": emotion, "dominant_emotion": "happy", "region": None, "note": "it's fine"}
+    client.post("/experiencia", json={
+        "usuario_id": 1, "menu_id": menu_id, "emocion_menu": payload, "emocion_plato": payload,
+        "sam_valencia": 0.5, "sam_arousal": 0.5, "api": "deepface"
+    })
+
+    with SessionLocal() as session:
+        experiencia = session.scalars(select(DbExperiencia).filter(DbExperiencia.menu_id == menu_id)).one()
+        assert experiencia.emocion_menu == payload
+        assert session.get(DbMenu, menu_id).ingredientes == ingredientes
+
+
+def test_buscar_menus():
+    categoria_id = 5153
+    client.post("/menus", json={"nombre": "Pollo al horno", "descripcion": "con papas", "categoria_id": categoria_id,
+                                "ingredientes": ["pollo", "papa"]})
+    client.post("/menus", json={"nombre": "Ensalada tibia", "descripcion": "con pollo grillado", "categoria_id": categoria_id,
+                                "ingredientes": ["pollo", "lechuga"]})
+    client.post("/menus", json={"nombre": "Tortilla", "descripcion": "de papas", "categoria_id": categoria_id,
+                                "ingredientes": ["huevo", "papa"]})
+
+    response = client.get(f"/buscar_menus?q=pollo&categoria_id={categoria_id}")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 2
+    assert [m["nombre"] for m in body["menus"]] == ["Pollo al horno", "Ensalada tibia"]
+
+    body = client.get(f"/buscar_menus?ingredientes=papa&ingredientes=huevo&categoria_id={categoria_id}").json()
+    assert [m["nombre"] for m in body["menus"]] == ["Tortilla"]
+
+    # Menus written after the first search are found too
+    client.post("/menus", json={"nombre": "Pollo frito", "categoria_id": categoria_id, "ingredientes": ["pollo"]})
+    body = client.get(f"/buscar_menus?q=pollo&categoria_id={categoria_id}&per_page=2&page=2").json()
+    assert body["total"] == 3
+    assert len(body["menus"]) == 1
+
+
+def test_recomendaciones():
+    categoria_id = 5154
+    menus = {}
+    for nombre, valencia, arousal in [("dulce", 0.8, 0.3), ("picante", 0.3, 0.8), ("amargo", -0.7, -0.2)]:
+        menus[nombre] = client.post("/menus", json={"nombre": nombre, "categoria_id": categoria_id, "ingredientes": ["i1"]}).json()["id"]
+        post_experiencia(menus[nombre], valencia, arousal, usuario_id=5154)
+
+    body = client.get(f"/recomendaciones?valencia=0.7&arousal=0.35&categoria_id={categoria_id}&k=2").json()
+    assert [m["id"] for m in body["menus"]] == [menus["dulce"], menus["picante"]]
+    assert body["menus"][0]["distancia"] == pytest.approx(math.hypot(0.1, 0.05))
+
+    body = client.get(f"/recomendaciones?emocion=exquisito&categoria_id={categoria_id}&k=1").json()
+    assert body["menus"][0]["id"] == menus["dulce"]
+
+    # Aggregates changed by /experiencia move the menu in the index, to (0.35, 0.2125)
+    for _ in range(3):
+        post_experiencia(menus["amargo"], 0.7, 0.35)
+    body = client.get(f"/recomendaciones?valencia=0.35&arousal=0.2125&categoria_id={categoria_id}&k=1").json()
+    assert body["menus"][0]["id"] == menus["amargo"]
+    assert body["menus"][0]["distancia"] == pytest.approx(0, abs=1e-9)
+
+    # A user gets the menus closest to their average that they did not try yet
+    otro = client.post("/menus", json={"nombre": "nuevo", "categoria_id": categoria_id, "ingredientes": ["i1"]}).json()["id"]
+    body = client.get(f"/recomendaciones?usuario_id=5154&categoria_id={categoria_id}").json()
+    assert [m["id"] for m in body["menus"]] == [otro]
+
+    client.delete(f"/menus/{otro}")
+    assert client.get(f"/recomendaciones?usuario_id=5154&categoria_id={categoria_id}").json()["menus"] == []
+    assert client.get("/recomendaciones?usuario_id=987654").status_code == 404
+    assert client.get("/recomendaciones?emocion=rico").status_code == 400
+    assert client.get("/recomendaciones").status_code == 400
+    for valencia in ["inf", "nan", "500"]:
+        assert client.get(f"/recomendaciones?valencia={valencia}&arousal=0").status_code == 422
+
+
+def test_recomendaciones_see_writes_of_other_workers(monkeypatch):
+    monkeypatch.setattr(recommend, "RECOMMEND_CHECK_INTERVAL", 0)
+    url = "/recomendaciones?valencia=0.99&arousal=-0.99&categoria_id=5155&k=1"
+    assert client.get(url).json()["menus"] == []
+
+    # Written behind the app's back, as another worker would
+    with SessionLocal() as db:
+        menu = DbMenu(nombre="de otro worker", categoria_id=5155, valencia_resultante=0.99, arousal_resultante=-0.99,
+                      emocion_resultante="comun", numero_experiencias=1)
+        db.add(menu)
+        db.commit()
+        assert [m["id"] for m in client.get(url).json()["menus"]] == [menu.id]
+
+        # Moved away, and deleted
+        db.execute(update(DbMenu).where(DbMenu.id == menu.id).values(valencia_resultante=-0.99, actualizado=func.now()))
+        db.commit()
+        assert client.get(url).json()["menus"][0]["distancia"] == pytest.approx(1.98)
+
+        db.delete(menu)
+        db.commit()
+    assert client.get(url).json()["menus"] == []
+
+
+def test_recomendaciones_do_not_rebuild_after_local_writes(monkeypatch):
+    monkeypatch.setattr(recommend, "RECOMMEND_CHECK_INTERVAL", 0)
+    builds = []
+    build_grid = recommend.build_grid
+    monkeypatch.setattr(recommend, "build_grid", lambda rows: builds.append(1) or build_grid(rows))
+    menu_id = client.post("/menus", json={"nombre": "plato sin rebuild", "categoria_id": 5164, "ingredientes": ["i1"]}).json()["id"]
+    url = "/recomendaciones?valencia=0.6&arousal=0.3&categoria_id=5164&k=1"
+    client.get(url)
+    built = len(builds)
+
+    for _ in range(3):
+        post_experiencia(menu_id, 0.6, 0.3)
+        assert client.get(url).json()["menus"][0]["id"] == menu_id
+    assert len(builds) == built
+
+
+def test_perfil_usuario():
+    usuario_id = 5155
+    categoria = client.post("/crear_categorias", json={"categoria": f"perfil {uuid.uuid4().hex}", "descripcion": uuid.uuid4().hex}).json()
+    plato = client.post("/menus", json={"nombre": "plato perfil", "categoria_id": categoria["id"], "ingredientes": ["i1"]}).json()["id"]
+    otro = client.post("/menus", json={"nombre": "plato perfil 2", "categoria_id": 5156, "ingredientes": ["i1"]}).json()["id"]
+    response = post_experiencia(plato, 0.9, 0.3, usuario_id=usuario_id)
+    assert response.json()["fecha"] == date.today().isoformat()
+    post_experiencia(plato, 0.3, 0.9, usuario_id=usuario_id)
+    client.post("/experiencia/lote", json=[
+        {"usuario_id": usuario_id, "menu_id": otro, "sam_valencia": -0.6, "sam_arousal": -0.3, "valencia_menu": -0.6,
+         "arousal_menu": -0.3, "valencia_plato": -0.6, "arousal_plato": -0.3, "api": "sam"}
+    ])
+
+    perfil = client.get(f"/perfil_usuario/{usuario_id}").json()
+    assert perfil["numero_experiencias"] == 3
+    assert perfil["valencia_resultante"] == pytest.approx(0.2)
+    assert perfil["ultima_fecha"] == date.today().isoformat()
+    categorias = {c["categoria_id"]: c for c in perfil["categorias"]}
+    assert categorias[categoria["id"]]["categoria"] == categoria["categoria"]
+    assert categorias[categoria["id"]]["emocion_resultante"] == "delicioso"
+    assert categorias[categoria["id"]]["menus"][0]["numero_experiencias"] == 2
+    assert categorias[5156]["categoria"] is None
+    assert categorias[5156]["valencia_resultante"] == pytest.approx(-0.6)
+
+    # Rebuilding the summaries from the experiencias gives the same profile
+    with SessionLocal() as session:
+        rebuild_summaries(session)
+        session.commit()
+    assert client.get(f"/perfil_usuario/{usuario_id}").json() == perfil
+
+    assert client.get("/perfil_usuario/987654").status_code == 404
+
+
+def test_tendencias():
+    today = date.today()
+    earlier = today - timedelta(days=14)
+    plato = client.post("/menus", json={"nombre": "plato tendencia", "categoria_id": 5157, "ingredientes": ["i1"]}).json()["id"]
+    for valencia, arousal in [(0.9, 0.3), (0.3, 0.9), (0.6, 0.6)]:
+        post_experiencia(plato, valencia, arousal)
+    with SessionLocal() as session:
+        session.add(DbExperiencia(menu_id=plato, usuario_id=1, fecha=earlier, valencia_resultante=-0.4, arousal_resultante=-0.2, emocion_resultante="pasado"))
+        session.commit()
+        rebuild_rollups(session, earlier, earlier)
+        session.commit()
+
+    tendencias = client.get(f"/tendencias/menu/{plato}", params={"periodo": "dia"}).json()
+    assert (tendencias["desde"], tendencias["hasta"]) == ((today - timedelta(weeks=12)).isoformat(), today.isoformat())
+    antes, hoy = tendencias["series"]
+    assert (antes["inicio"], antes["numero_experiencias"], antes["emociones"]) == (earlier.isoformat(), 1, {"pasado": 1})
+    assert hoy["numero_experiencias"] == 3
+    assert sum(hoy["emociones"].values()) == 3
+    assert hoy["valencia_media"] == pytest.approx(0.6)
+    assert hoy["valencia_percentiles"] == {"p25": 0.3, "p50": 0.6, "p75": 0.9}
+    assert hoy["arousal_percentiles"]["p50"] == pytest.approx(0.6)
+
+    semanas = client.get(f"/tendencias/menu/{plato}", params={"desde": earlier.isoformat()}).json()["series"]
+    assert semanas[-1]["inicio"] == (today - timedelta(days=today.weekday())).isoformat()
+    assert sum(punto["numero_experiencias"] for punto in semanas) == 4
+
+    categoria = client.get("/tendencias/categoria/5157", params={"periodo": "mes", "desde": earlier.isoformat()}).json()["series"]
+    assert categoria[-1]["inicio"] == today.replace(day=1).isoformat()
+    assert sum(punto["numero_experiencias"] for punto in categoria) == 4
+
+    # Cached per window, a new experiencia shows up in other windows right away
+    post_experiencia(plato, 0.0, 0.0)
+    assert client.get(f"/tendencias/menu/{plato}", params={"periodo": "dia"}).json() == tendencias
+    assert client.get(f"/tendencias/menu/{plato}", params={"periodo": "dia", "hasta": today.isoformat(), "desde": earlier.isoformat()}).json()["series"][-1]["numero_experiencias"] == 4
+
+    assert client.get("/tendencias/menu/987654").status_code == 404
+    assert client.get(f"/tendencias/menu/{plato}", params={"desde": today.isoformat(), "hasta": earlier.isoformat()}).status_code == 400
+    assert client.get(f"/tendencias/menu/{plato}", params={"periodo": "dia", "desde": "2020-01-01"}).status_code == 400
+    assert client.get(f"/tendencias/menu/{plato}", params={"periodo": "anio"}).status_code == 422
+
+
+def test_exportar():
+    categoria_id = 5158
+    platos = [client.post("/menus", json={"nombre": f"plato exportado {i}", "categoria_id": categoria_id, "ingredientes": ["i1", "i2"]}).json()["id"]
+              for i in range(3)]
+    for plato in platos:
+        post_experiencia(plato, 0.4, 0.1)
+    post_experiencia(platos[0], -0.2, 0.3)
+
+    response = client.get("/exportar/menus", params={"categoria_id": categoria_id})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    menus = [json.loads(line) for line in response.text.splitlines()]
+    assert [menu["id"] for menu in menus] == platos
+    assert menus[0]["ingredientes"] == ["i1", "i2"]
+
+    response = client.get("/exportar/experiencias", params={"formato": "csv", "menu_id": platos[0], "desde": date.today().isoformat()})
+    assert response.headers["content-type"].startswith("text/csv")
+    assert 'filename="experiencias.csv"' in response.headers["content-disposition"]
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert sorted(float(row["valencia_resultante"]) for row in rows) == pytest.approx([-0.2, 0.4])
+    assert rows[0]["fecha"] == date.today().isoformat()
+    assert json.loads(rows[0]["emocion_menu"]) == {}
+
+    response = client.get("/exportar/experiencias", params={"categoria_id": categoria_id})
+    assert len(response.text.splitlines()) == 4
+    response = client.get("/exportar/experiencias", params={"categoria_id": categoria_id, "hasta": "2020-01-01"})
+    assert response.text == ""
+
+
+def test_exportar_parquet():
+    pq = pytest.importorskip("pyarrow.parquet")
+    plato = client.post("/menus", json={"nombre": "plato parquet", "categoria_id": 5159, "ingredientes": ["i1"]}).json()["id"]
+    post_experiencia(plato, 0.4, 0.1)
+
+    response = client.get("/exportar/menus", params={"formato": "parquet", "categoria_id": 5159})
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column("id").to_pylist() == [plato]
+    assert json.loads(table.column("ingredientes")[0].as_py()) == ["i1"]
+
+
+def test_importar_menus():
+    categoria = f"importada {uuid.uuid4().hex[:8]}"
+    response = client.post("/importar/menus", params={"crear_categorias": True}, json=[
+        {"nombre": "plato importado", "categoria": categoria, "ingredientes": ["harina"]},
+        {"nombre": "plato importado 2", "categoria_id": 5160, "descripcion": "primera"},
+        {"categoria_id": 5160},
+        {"nombre": "plato sin categoria"},
+        {"nombre": "plato importado 2", "categoria_id": 5160, "descripcion": "segunda"},
+    ])
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["creados"], result["actualizados"], result["categorias_creadas"]) == (2, 0, 1)
+    assert [error["index"] for error in result["errores"]] == [1, 2, 3]
+    importado, importado_2 = result["menus"]
+    assert client.get(f"/menus/{importado_2['id']}").json()["descripcion"] == "segunda"
+    categorias = {c["categoria"]: c["id"] for c in client.get("/consultar_categorias").json()["categorias"]}
+    assert client.get(f"/menus/{importado['id']}").json()["categoria_id"] == categorias[categoria]
+
+    # Upserted on (categoria_id, nombre), the aggregates are kept
+    post_experiencia(importado_2["id"], 0.4, 0.1)
+    archivo = "nombre,categoria_id,preparacion,ingredientes\nplato importado 2,5160,al horno,\"queso, huevo\"\nplato importado 3,5160,,[\"sal\"]\n"
+    result = client.post("/importar/menus", content=archivo, headers={"Content-Type": "text/csv"}).json()
+    assert (result["creados"], result["actualizados"], result["errores"]) == (1, 1, [])
+    menu = client.get(f"/menus/{importado_2['id']}").json()
+    assert (menu["descripcion"], menu["preparacion"], menu["ingredientes"]) == ("segunda", "al horno", ["queso", "huevo"])
+    assert menu["numero_experiencias"] == 1
+    assert client.get("/buscar_menus", params={"q": "importado", "categoria_id": 5160}).json()["total"] == 2
+
+    assert client.post("/importar/menus", params={"crear_categorias": False}, json=[{"nombre": "x", "categoria": "no existe"}]).json()["errores"] == [
+        {"index": 0, "message": "Categoria 'no existe' not found"}
+    ]
+    assert client.post("/importar/menus", content="{", headers={"Content-Type": "application/json"}).status_code == 400
+    response = client.post("/menus", json={"nombre": "plato importado 3", "categoria_id": 5160})
+    assert response.status_code == 409
+
+
+def test_importar_menus_keeps_the_columns_a_row_leaves_out(monkeypatch):
+    client.post("/importar/menus", json=[
+        {"nombre": "plato con foto", "categoria_id": 5163, "foto": "http://f/a.png", "descripcion": "original"},
+        {"nombre": "plato sin foto", "categoria_id": 5163},
+    ])
+    # Only the second row has foto, only the first descripcion
+    result = client.post("/importar/menus", json=[
+        {"nombre": "plato con foto", "categoria_id": 5163, "preparacion": "al vapor"},
+        {"nombre": "plato sin foto", "categoria_id": 5163, "foto": "http://f/b.png", "descripcion": None},
+    ]).json()
+    assert (result["actualizados"], result["errores"]) == (2, [])
+    con_foto, sin_foto = (client.get(f"/menus/{menu['id']}").json() for menu in result["menus"])
+    assert (con_foto["foto"], con_foto["descripcion"], con_foto["preparacion"]) == ("http://f/a.png", "original", "al vapor")
+    assert (sin_foto["foto"], sin_foto["descripcion"]) == ("http://f/b.png", None)
+
+    monkeypatch.setattr(importer, "MAX_IMPORT_BYTES", 10)
+    assert client.post("/importar/menus", json=[{"nombre": "plato grande", "categoria_id": 5163}]).status_code == 413
+
+
+def test_metrics():
+    menu_id = client.post("/menus", json={"nombre": "plato medido", "categoria_id": 5161}).json()["id"]
+    client.get(f"/menus/{menu_id}")
+    client.get(f"/menus/{menu_id}")
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    # Labelled by route template, not by url
+    assert any(line.startswith('http_request_duration_seconds_count{method="GET",route="/menus/{id}",status="200"}') for line in lines)
+    assert not any(f"/menus/{menu_id}" in line for line in lines)
+    assert any(line.startswith('http_request_db_queries_sum{method="POST",route="/menus"}') and float(line.split()[-1]) >= 1 for line in lines)
+    assert any(line.startswith('cache_hits_total{namespace="menu"}') for line in lines)
+    assert "# TYPE db_pool_connections gauge" in lines
+
+
+def test_menus_fields_projection():
+    menu_id = client.post("/menus", json={"nombre": "plato proyectado", "categoria_id": 5162, "ingredientes": ["i1"]}).json()["id"]
+
+    response = client.get("/menus", params={"after_id": menu_id - 1, "per_page": 1, "fields": "nombre,ingredientes"}).json()
+    assert response["menus"] == [{"id": menu_id, "nombre": "plato proyectado", "ingredientes": ["i1"]}]
+
+    menus = client.get("/menu_por_categorias", params={"categoria2": 5162, "fields": "nombre,categoria"}).json()
+    assert menus == [{"nombre": "plato proyectado", "categoria": 5162}]
+    assert client.get("/menu_por_categorias", params={"categoria2": 5162}).json()[0]["ingredientes"] == ["i1"]
+
+    response = client.get("/menus", params={"fields": "nombre,clave"})
+    assert response.status_code == 400
+    assert response.json() == {"message": "Unknown fields: clave"}
+
+
+def test_conditional_gets():
+    categoria_id = uuid.uuid4().int % 1000000 + 2000000
+    menu_id = client.post("/menus", json={"nombre": "plato validado", "categoria_id": categoria_id}).json()["id"]
+
+    response = client.get(f"/menus/{menu_id}")
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+    assert response.headers["cache-control"] == "no-cache"
+    not_modified = client.get(f"/menus/{menu_id}", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+    assert client.get(f"/menus/{menu_id}", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get(f"/menus/{menu_id}", headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}).status_code == 200
+
+    categoria = client.get("/menu_por_categorias", params={"categoria2": categoria_id})
+    projected = client.get("/menu_por_categorias", params={"categoria2": categoria_id, "fields": "nombre"})
+    assert projected.headers["etag"] != categoria.headers["etag"]
+    assert client.get("/menu_por_categorias", params={"categoria2": categoria_id},
+                      headers={"If-None-Match": categoria.headers["etag"]}).status_code == 304
+
+    # An experiencia and an update each change the menu and its category
+    assert client.post("/experiencia", json={
+        "usuario_id": 1, "menu_id": menu_id, "emocion_menu": {}, "arousal_menu": 0.5, "valencia_menu": 0.5,
+        "emocion_plato": {}, "arousal_plato": 0.5, "valencia_plato": 0.5, "sam_valencia": 0.5, "sam_arousal": 0.5, "api": "sam"
+    }).status_code == 201
+    response = client.get(f"/menus/{menu_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["numero_experiencias"] == 1
+    client.put(f"/menu/{menu_id}", json={"descripcion": "nueva"})
+    assert client.get(f"/menus/{menu_id}").headers["etag"] not in (etag, response.headers["etag"])
+    assert client.get("/menu_por_categorias", params={"categoria2": categoria_id},
+                      headers={"If-None-Match": categoria.headers["etag"]}).status_code == 200
+
+    page = client.get("/menus", params={"after_id": menu_id - 1, "per_page": 1})
+    assert client.get("/menus", params={"after_id": menu_id - 1, "per_page": 1},
+                      headers={"If-None-Match": page.headers["etag"]}).status_code == 304
+    projected = client.get("/menus", params={"after_id": menu_id - 1, "per_page": 1, "fields": "nombre"})
+    assert projected.headers["etag"] != page.headers["etag"]
+    client.put(f"/menu/{menu_id}", json={"descripcion": "otra"})
+    changed = client.get("/menus", params={"after_id": menu_id - 1, "per_page": 1}, headers={"If-None-Match": page.headers["etag"]})
+    assert changed.status_code == 200
+    assert changed.json()["menus"][0]["descripcion"] == "otra"
+
+    categorias = client.get("/consultar_categorias")
+    assert client.get("/consultar_categorias", headers={"If-None-Match": f'W/{categorias.headers["etag"]}'}).status_code == 304
+
+
+def test_get_menus_lote():
+    ids = [client.post("/menus", json={"nombre": f"plato del lote {i}", "categoria_id": 7373}).json()["id"] for i in range(3)]
+    client.get(f"/menus/{ids[1]}")
+
+    response = client.get("/menus/lote", params={"ids": [ids[2], 0, ids[0], ids[1], ids[2]]})
+    assert response.status_code == 200
+    # One entry per id asked for, in the same order
+    assert [menu and menu["id"] for menu in response.json()["menus"]] == [ids[2], None, ids[0], ids[1], ids[2]]
+    assert response.json()["no_encontrados"] == [0]
+    assert client.get("/menus/lote", params={"ids": [ids[2], 0, ids[0], ids[1], ids[2]]},
+                      headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    assert client.get("/menus/lote", params={"ids": [ids[2], 0, ids[0], ids[1]]},
+                      headers={"If-None-Match": response.headers["etag"]}).status_code == 200
+
+    assert client.get("/menus/lote", params={"ids": list(range(1, 102))}).status_code == 400
+    response = client.get("/menus/lote")
+    assert response.status_code == 400
+    assert response.json() == {"message": "At least one id is required"}
@@ -0,0 +1,125 @@
+import base64
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+from . import media
+from .database import SessionLocal
+from .main import app
+from .models import DbMenu
+
+
+# A 1x1 PNG
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+client = TestClient(app)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def client_lifespan():
+    # Share one event loop (and its pooled connections) across the module
+    with client:
+        yield
+
+
+@pytest.fixture(autouse=True)
+def media_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_DIR", str(tmp_path))
+
+
+def test_parse_range():
+    assert media.parse_range("bytes=0-9", 100) == (0, 9)
+    assert media.parse_range("bytes=90-", 100) == (90, 99)
+    assert media.parse_range("bytes=-10", 100) == (90, 99)
+    assert media.parse_range("bytes=95-200", 100) == (95, 99)
+    assert media.parse_range("bytes=0-1,5-6", 100) is None
+    with pytest.raises(ValueError):
+        media.parse_range("bytes=100-", 100)
+
+
+def test_store_is_content_addressed():
+    digest = media.store(PNG)
+    assert media.store(PNG) == digest
+    assert media.offload("data:image/png;base64," + base64.b64encode(PNG).decode()) == f"/media/{digest}"
+    assert media.offload("https://example.com/plato.png") == "https://example.com/plato.png"
+    with pytest.raises(ValueError):
+        media.store(b"not an image")
+
+
+def test_menu_fotos_are_served_from_the_store():
+    data_uri = "data:image/png;base64," + base64.b64encode(PNG).decode()
+    menu = client.post("/menus", json={"nombre": "plato con foto", "categoria_id": 8181, "foto": data_uri}).json()
+    foto = client.get(f"/menus/{menu['id']}").json()["foto"]
+    assert foto == f"/media/{media.store(PNG)}"
+    assert client.get("/menu_por_categorias", params={"categoria2": 8181, "fields": "foto"}).json() == [{"foto": foto}]
+
+    response = client.get(foto)
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    assert "immutable" in response.headers["cache-control"]
+    assert client.get(foto, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+    partial = client.get(foto, headers={"Range": "bytes=1-3"})
+    assert partial.status_code == 206
+    assert partial.content == PNG[1:4]
+    assert partial.headers["content-range"] == f"bytes 1-3/{len(PNG)}"
+    assert client.get(foto, headers={"Range": f"bytes={len(PNG)}-"}).status_code == 416
+
+    assert client.get(foto, params={"ancho": 100}).status_code == 400
+    assert client.get("/media/" + "0" * 64).status_code == 404
+
+
+def test_thumbnails():
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", (600, 300), "red").save(buffer, format="PNG")
+    foto = f"/media/{media.store(buffer.getvalue())}"
+
+    response = client.get(foto, params={"ancho": 128})
+    assert response.status_code == 200
+    assert response.headers["etag"] != client.get(foto).headers["etag"]
+    with Image.open(io.BytesIO(response.content)) as thumbnail:
+        assert thumbnail.size == (128, 64)
+
+
+def test_thumbnails_without_pillow(monkeypatch):
+    monkeypatch.setattr(media, "thumbnails_available", lambda: False)
+    foto = f"/media/{media.store(PNG)}"
+    response = client.get(foto, params={"ancho": 128})
+    assert response.status_code == 501
+    assert response.json() == {"message": "Thumbnails need Pillow installed"}
+
+
+def test_put_menu_foto():
+    menu_id = client.post("/menus", json={"nombre": "plato subido", "categoria_id": 8181}).json()["id"]
+    response = client.put(f"/menus/{menu_id}/foto", content=PNG, headers={"Content-Type": "image/png"})
+    assert response.status_code == 200
+    assert client.get(f"/menus/{menu_id}").json()["foto"] == response.json()["foto"]
+
+    assert client.put(f"/menus/{menu_id}/foto", content=b"texto").status_code == 415
+    assert client.post("/menus", json={"nombre": "foto rota", "categoria_id": 8181, "foto": "data:image/png;base64,%%"}).status_code == 400
+
+
+def test_put_menu_foto_rejects_large_bodies(monkeypatch):
+    monkeypatch.setattr(media, "MAX_FOTO_BYTES", 64)
+    menu_id = client.post("/menus", json={"nombre": "plato grande", "categoria_id": 8181}).json()["id"]
+    large = PNG + b"\0" * 100
+
+    # Announced by Content-Length, and streamed in chunks without it
+    assert client.put(f"/menus/{menu_id}/foto", content=large).status_code == 413
+    assert client.put(f"/menus/{menu_id}/foto", content=iter([large[:50], large[50:]])).status_code == 413
+    assert client.get(f"/menus/{menu_id}").json()["foto"] is None
+
+
+def test_offload_existing_data_uris():
+    with SessionLocal() as db:
+        menu = DbMenu(nombre="plato antiguo", categoria_id=8182, foto="data:image/png;base64," + base64.b64encode(PNG).decode())
+        broken = DbMenu(nombre="plato roto", categoria_id=8182, foto="data:text/plain;base64,aG9sYQ==")
+        db.add_all([menu, broken])
+        db.commit()
+
+        assert media.offload_existing(db, batch_size=1) == 1
+        db.expire_all()
+        assert db.get(DbMenu, menu.id).foto == f"/media/{media.store(PNG)}"
+        assert db.get(DbMenu, broken.id).foto.startswith("data:")
@@ -0,0 +1,121 @@
+"""The hot queries must keep running on their indexes. Each test asks the
+database for the plan of a query the routes issue and checks it names the
+expected index, so dropping or reshaping one fails here instead of in
+production latency."""
+from datetime import date
+
+import pytest
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .database import engine
+from .models import DbMenu, DbExperiencia, DbExperienciaDiaria, DbExperienciaResumen
+from .retention import is_partitioned
+from .search import fulltext_filters
+
+
+postgresql_only = pytest.mark.skipif(engine.dialect.name != "postgresql", reason="PostgreSQL indexes")
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, "postgresql")
+def explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+def plan(statement):
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            # The test tables are tiny, a sequential scan would always be cheaper
+            connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        rows = connection.execute(Explain(statement)).all()
+
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def uses_index(statement, name):
+    # On a partitioned table the plan names the indexes of the partitions
+    names = [name]
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            names.extend(connection.execute(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:name)"), {"name": f"taca.{name}"}).scalars())
+
+    explained = plan(statement)
+    return any(index in explained for index in names)
+
+
+def test_experiencias_of_user_and_menu_use_composite_index():
+    statement = select(DbExperiencia).filter(DbExperiencia.usuario_id == 1, DbExperiencia.menu_id == 2)
+    assert uses_index(statement, "ix_taca_experiencia_usuario_menu")
+
+
+def test_experiencias_of_user_use_composite_index_prefix():
+    statement = select(DbExperiencia).filter(DbExperiencia.usuario_id == 1)
+    assert uses_index(statement, "ix_taca_experiencia_usuario_menu")
+
+
+def test_experiencias_of_menu_by_fecha_use_composite_index():
+    statement = select(func.count()).select_from(DbExperiencia).filter(
+        DbExperiencia.menu_id == 2, DbExperiencia.fecha.between(date(2024, 1, 1), date(2024, 1, 31)))
+    assert uses_index(statement, "ix_taca_experiencia_menu_fecha")
+
+
+def test_experiencias_of_a_month_only_scan_its_partition():
+    with engine.connect() as connection:
+        if not is_partitioned(connection):
+            pytest.skip("experiencia is not partitioned")
+
+    statement = select(func.count()).select_from(DbExperiencia).filter(DbExperiencia.fecha.between(date(2024, 1, 1), date(2024, 1, 31)))
+    explained = plan(statement)
+    assert "experiencia_p2024_01" in explained
+    assert "experiencia_p2024_02" not in explained and "experiencia_p2023_12" not in explained
+
+
+def test_menus_of_categoria_use_index():
+    statement = select(DbMenu).filter(DbMenu.categoria_id == 3)
+    assert "ix_taca_menu_categoria_nombre" in plan(statement)
+
+
+def test_summaries_of_user_use_primary_key():
+    statement = select(DbExperienciaResumen).filter(DbExperienciaResumen.usuario_id == 1)
+    expected = "experiencia_resumen_pkey" if engine.dialect.name == "postgresql" else "sqlite_autoindex_experiencia_resumen"
+    assert expected in plan(statement)
+
+
+def test_rollups_of_menu_by_fecha_use_primary_key():
+    statement = select(DbExperienciaDiaria).filter(
+        DbExperienciaDiaria.menu_id == 2, DbExperienciaDiaria.fecha.between(date(2024, 1, 1), date(2024, 3, 31)))
+    expected = "experiencia_diaria_pkey" if engine.dialect.name == "postgresql" else "sqlite_autoindex_experiencia_diaria"
+    assert expected in plan(statement)
+
+
+def test_menus_keyset_page_uses_primary_key():
+    statement = select(DbMenu).filter(DbMenu.id > 100).order_by(DbMenu.id).limit(20)
+    expected = "menu_pkey" if engine.dialect.name == "postgresql" else "INTEGER PRIMARY KEY"
+    assert expected in plan(statement)
+
+
+@postgresql_only
+def test_fulltext_search_uses_gin_index():
+    filters, order_by = fulltext_filters("milanesa", [], None)
+    assert "ix_taca_menu_busqueda" in plan(select(DbMenu).filter(*filters))
+
+
+@postgresql_only
+def test_ingredientes_search_uses_gin_index():
+    filters, order_by = fulltext_filters(None, ["queso", "huevo"], None)
+    assert "ix_taca_menu_ingredientes" in plan(select(DbMenu).filter(*filters))
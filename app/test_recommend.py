@@ -0,0 +1,59 @@
+import math
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from .recommend import EmotionGrid, TASTE_TARGETS
+from .scoring import get_emocion_resultante
+
+
+def brute_force(points, valencia, arousal, k, categoria_id=None, exclude=()):
+    distances = sorted(
+        (math.hypot(v - valencia, a - arousal), id) for id, (c, v, a) in points.items()
+        if (categoria_id is None or c == categoria_id) and id not in exclude
+    )
+    return [(id, distance) for distance, id in distances[:k]]
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(34)
+    points = {id: (rng.randint(1, 3), rng.uniform(-1, 1), rng.uniform(-1, 1)) for id in range(2000)}
+    grid = EmotionGrid()
+    grid.build([SimpleNamespace(id=id, categoria_id=c, valencia_resultante=v, arousal_resultante=a) for id, (c, v, a) in points.items()])
+
+    for _ in range(50):
+        valencia, arousal = rng.uniform(-1.2, 1.2), rng.uniform(-1.2, 1.2)
+        assert grid.nearest(valencia, arousal, 10) == brute_force(points, valencia, arousal, 10)
+        assert grid.nearest(valencia, arousal, 5, categoria_id=2, exclude={1, 2, 3}) == \
+            brute_force(points, valencia, arousal, 5, categoria_id=2, exclude={1, 2, 3})
+
+
+def test_targets_outside_the_grid_start_from_its_edge():
+    points = {id: (1, id / 100, id / 200) for id in range(100)}
+    grid = EmotionGrid()
+    grid.build([SimpleNamespace(id=id, categoria_id=c, valencia_resultante=v, arousal_resultante=a) for id, (c, v, a) in points.items()])
+
+    for valencia, arousal in [(1e9, 0), (-1e9, -1e9), (1.5, -1.5)]:
+        assert grid.nearest(valencia, arousal, 3) == brute_force(points, valencia, arousal, 3)
+    with pytest.raises(ValueError):
+        grid.nearest(math.nan, 0, 3)
+
+
+def test_updates_move_points_and_resize_the_grid():
+    grid = EmotionGrid()
+    grid.build([])
+    for id in range(1000):
+        grid.update(id, 1, id / 1000, 0)
+    assert grid.cell_size < 0.25
+
+    grid.update(0, 1, 0.9, 0.9)
+    assert grid.nearest(1, 1, 1) == [(0, pytest.approx(math.hypot(0.1, 0.1)))]
+    grid.remove(0)
+    assert grid.nearest(1, 1, 1)[0][0] == 999
+    assert len(grid.nearest(0, 0, 2000)) == 999
+
+
+def test_taste_targets_fall_in_their_taste():
+    for taste, (valencia, arousal) in TASTE_TARGETS.items():
+        assert get_emocion_resultante(valencia, arousal) == taste
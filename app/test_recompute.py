@@ -0,0 +1,100 @@
+import pytest
+from sqlalchemy import update
+
+from .database import SessionLocal, engine
+from .models import DbMenu, DbExperiencia
+from .recompute import recompute_menu_aggregates
+
+
+def add_menu_with_experiencias(session, experiencias):
+    menu = DbMenu(nombre="plato recalculado", ingredientes=["i1"], valencia_resultante=0, arousal_resultante=0,
+                  emocion_resultante="comun", numero_experiencias=0)
+    session.add(menu)
+    session.flush()
+    session.add_all([DbExperiencia(menu_id=menu.id, usuario_id=1, **experiencia) for experiencia in experiencias])
+    session.commit()
+    return menu.id
+
+
+def sam_experiencia(valencia, arousal):
+    return {
+        "api": "sam", "emocion_menu": {}, "emocion_plato": {},
+        "valencia_menu": valencia, "valencia_plato": valencia, "sam_valencia": valencia,
+        "arousal_menu": arousal, "arousal_plato": arousal, "sam_arousal": arousal,
+        "valencia_resultante": valencia, "arousal_resultante": arousal, "emocion_resultante": "exquisito"
+    }
+
+
+def test_recompute_repairs_drifted_aggregates():
+    session = SessionLocal()
+    menu_id = add_menu_with_experiencias(session, [sam_experiencia(0.2, 0.1), sam_experiencia(0.6, 0.5), sam_experiencia(1.0, 0.6)])
+    empty_menu_id = add_menu_with_experiencias(session, [])
+    session.execute(update(DbMenu).where(DbMenu.id.in_([menu_id, empty_menu_id])).values(
+        valencia_resultante=-1, arousal_resultante=-1, emocion_resultante="pasado", numero_experiencias=99))
+    session.commit()
+
+    progress = []
+    result = recompute_menu_aggregates(session, chunk_size=2, progress=lambda processed, total: progress.append((processed, total)))
+    session.expire_all()
+
+    menu = session.get(DbMenu, menu_id)
+    assert menu.numero_experiencias == 3
+    assert abs(menu.valencia_resultante - 0.6) < 1e-9
+    assert abs(menu.arousal_resultante - 0.4) < 1e-9
+    assert menu.emocion_resultante == "exquisito"
+    empty_menu = session.get(DbMenu, empty_menu_id)
+    assert (empty_menu.numero_experiencias, empty_menu.valencia_resultante, empty_menu.emocion_resultante) == (0, 0, "comun")
+
+    assert result["experiencias"] == progress[-1][0] == progress[-1][1]
+    assert all(processed - previous <= 2 for (processed, _), (previous, _) in zip(progress[1:], progress))
+    session.close()
+
+
+def test_recompute_rescore_from_stored_payloads():
+    session = SessionLocal()
+    emotion = {"angry": 1.0, "disgust": 0.5, "fear": 8.5, "happy": 70.0, "sad": 5.0, "surprise": 10.0, "neutral": 5.0}
+    payload = {"emotion": emotion, "dominant_emotion": "happy"}
+    menu_id = add_menu_with_experiencias(session, [
+        {"api": "deepface", "emocion_menu": payload, "emocion_plato": payload, "sam_valencia": 0.5, "sam_arousal": 0.5,
+         "valencia_menu": 0, "arousal_menu": 0, "valencia_plato": 0, "arousal_plato": 0,
+         "valencia_resultante": 0, "arousal_resultante": 0, "emocion_resultante": "comun"},
+        {"api": "deepface", "emocion_menu": "not a payload", "emocion_plato": None,
+         "valencia_resultante": 0.1, "arousal_resultante": 0.1, "emocion_resultante": "comun"},
+    ])
+
+    result = recompute_menu_aggregates(session, rescore=True)
+    session.expire_all()
+
+    experiencia = session.query(DbExperiencia).filter(DbExperiencia.menu_id == menu_id).order_by(DbExperiencia.id).first()
+    assert abs(experiencia.valencia_menu - (0.70 * 0.866 - 0.085 * 0.5)) < 1e-9
+    assert experiencia.emocion_resultante == "exquisito"
+    assert result["experiencias_invalidas"] >= 1
+    menu = session.get(DbMenu, menu_id)
+    assert menu.numero_experiencias == 2
+    assert abs(menu.valencia_resultante - (experiencia.valencia_resultante + 0.1) / 2) < 1e-9
+    session.close()
+
+
+@pytest.mark.skipif(engine.dialect.name != "postgresql", reason="SQLite blocks writers while the table is streamed")
+def test_recompute_counts_experiencias_saved_while_it_runs():
+    session = SessionLocal()
+    menu_id = add_menu_with_experiencias(session, [sam_experiencia(0.2, 0.2), sam_experiencia(0.4, 0.4)])
+
+    def save_experiencia(processed, total):
+        # As POST /experiencia does from another connection, once, while the table is streamed. With an id
+        # below the last one streamed, like a transaction that took its id early and committed late
+        if processed > 2:
+            return
+        with SessionLocal() as other:
+            other.add(DbExperiencia(id=-menu_id, menu_id=menu_id, usuario_id=1, **sam_experiencia(0.9, 0.9)))
+            other.execute(update(DbMenu).where(DbMenu.id == menu_id).values(version=DbMenu.version + 1))
+            other.commit()
+
+    result = recompute_menu_aggregates(session, chunk_size=2, progress=save_experiencia)
+    session.commit()
+
+    menu = session.get(DbMenu, menu_id)
+    assert menu.numero_experiencias == 3
+    assert abs(menu.valencia_resultante - 0.5) < 1e-9
+    assert result["menus_modificados"] >= 1
+    session.close()
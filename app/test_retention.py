@@ -0,0 +1,75 @@
+from datetime import date, timedelta
+
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .models import DbMenu, DbExperiencia, DbExperienciaDiaria, DbExperienciaResumen
+from .recompute import recompute_menu_aggregates
+from .retention import drop_expired, month_start, retained_since
+from .rollups import rebuild_rollups, rollup_rows
+from .summaries import rebuild_summaries
+
+
+def test_month_start():
+    assert month_start(date(2024, 5, 17)) == date(2024, 5, 1)
+    assert month_start(date(2024, 11, 30), 2) == date(2025, 1, 1)
+    assert month_start(date(2024, 1, 31), -13) == date(2022, 12, 1)
+
+
+def test_rollup_rows_fold_per_menu_day_and_emotion():
+    day = date(2024, 5, 1)
+    rows = rollup_rows([
+        {"menu_id": 2, "fecha": day, "emocion_resultante": "exquisito", "valencia_resultante": 0.5, "arousal_resultante": 0.1},
+        {"menu_id": 1, "fecha": day, "emocion_resultante": "pasado", "valencia_resultante": -0.4, "arousal_resultante": -0.2},
+        {"menu_id": 2, "fecha": day, "emocion_resultante": "exquisito", "valencia_resultante": 0.3, "arousal_resultante": 0.3},
+        {"menu_id": 2, "fecha": day, "emocion_resultante": None, "valencia_resultante": 0.3, "arousal_resultante": 0.3},
+    ])
+
+    assert [(row["menu_id"], row["emocion_resultante"], row["numero_experiencias"]) for row in rows] == [
+        (1, "pasado", 1), (2, "exquisito", 2)
+    ]
+    assert abs(rows[1]["valencia_total"] - 0.8) < 1e-9
+
+
+def test_retention_keeps_dropped_history():
+    usuario_id = 7101
+    today = date.today()
+    old = month_start(today, -14) + timedelta(days=4)
+    session = SessionLocal()
+    menu = DbMenu(nombre="plato retenido", categoria_id=7101, valencia_resultante=0, arousal_resultante=0,
+                  emocion_resultante="comun", numero_experiencias=0)
+    session.add(menu)
+    session.flush()
+    session.add_all([
+        DbExperiencia(usuario_id=usuario_id, menu_id=menu.id, fecha=fecha, valencia_resultante=valencia,
+                      arousal_resultante=0.2, emocion_resultante="exquisito")
+        for fecha, valencia in [(old, 0.2), (old, 0.4), (today, 0.6)]
+    ])
+    session.commit()
+    rebuild_rollups(session, old)
+    rebuild_summaries(session)
+    session.commit()
+
+    result = drop_expired(session, 12)
+    session.commit()
+    assert result["corte"] == month_start(today, -12)
+    assert retained_since(session) > old
+
+    fechas = session.scalars(select(DbExperiencia.fecha).filter(DbExperiencia.menu_id == menu.id)).all()
+    assert fechas == [today]
+    rollups = session.scalars(select(DbExperienciaDiaria).filter(DbExperienciaDiaria.menu_id == menu.id).order_by(DbExperienciaDiaria.fecha)).all()
+    assert [(rollup.fecha, rollup.numero_experiencias) for rollup in rollups] == [(old, 2), (today, 1)]
+
+    # The dropped experiencias still count once everything is rebuilt
+    rebuild_summaries(session)
+    session.commit()
+    resumen = session.get(DbExperienciaResumen, (usuario_id, menu.id))
+    assert resumen.numero_experiencias == 3
+    assert abs(resumen.valencia_total - 1.2) < 1e-9
+
+    recompute_menu_aggregates(session)
+    session.expire_all()
+    menu = session.get(DbMenu, menu.id)
+    assert menu.numero_experiencias == 3
+    assert abs(menu.valencia_resultante - 0.4) < 1e-9
+    session.close()
@@ -0,0 +1,47 @@
+import random
+
+import numpy as np
+import pytest
+
+from .scoring import (
+    EMOTIONS, VALENCE_AROUSAL_TO_TASTE, get_emocion_resultante, calculate_valence_arousal, emotion_vector,
+    calculate_valence_arousal_batch, get_emocion_resultante_batch
+)
+
+
+def random_emotion(rng):
+    weights = [rng.random() for _ in EMOTIONS]
+    return {e: w * 100 / sum(weights) for e, w in zip(EMOTIONS, weights)}
+
+
+def test_valence_arousal_batch_matches_scalar():
+    rng = random.Random(34)
+    emotions = [random_emotion(rng) for _ in range(500)]
+    dominant = [rng.choice(EMOTIONS) for _ in emotions]
+
+    valence, arousal = calculate_valence_arousal_batch(
+        [emotion_vector(e) for e in emotions], [EMOTIONS.index(d) for d in dominant])
+
+    expected = [calculate_valence_arousal(dict(e), d) for e, d in zip(emotions, dominant)]
+    assert valence.tolist() == [v for v, _ in expected]
+    assert arousal.tolist() == [a for _, a in expected]
+
+
+def test_emocion_resultante_batch_matches_scalar():
+    rng = random.Random(34)
+    points = [(rng.uniform(-1.6, 1.6), rng.uniform(-1.6, 1.6)) for _ in range(2000)]
+    # Bin edges and the special cases of the scalar scan
+    points += [(0, 0), (0.25, 0), (0, 0.25), (1.5, 0), (-1.5, 0), (0.5, 0.5), (-0.5, -0.5), (0.5, -1e-18), (float("nan"), 0)]
+
+    labels = get_emocion_resultante_batch([v for v, _ in points], [a for _, a in points])
+
+    assert labels.tolist() == [get_emocion_resultante(v, a) for v, a in points]
+
+
+@pytest.mark.parametrize("taste", [t for t in VALENCE_AROUSAL_TO_TASTE if t != "comun"])
+def test_emocion_resultante_batch_sector_centers(taste):
+    min_angle, max_angle, min_module, max_module = VALENCE_AROUSAL_TO_TASTE[taste]
+    angle = np.radians((min_angle + max_angle) / 2)
+    module = (min_module + max_module) / 2
+
+    assert get_emocion_resultante_batch([module * np.cos(angle)], [module * np.sin(angle)]).tolist() == [taste]
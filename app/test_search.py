@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+from .search import InvertedIndex, tokenize
+
+
+def menu(id, nombre, descripcion=None, ingredientes=(), categoria_id=1):
+    return SimpleNamespace(id=id, nombre=nombre, descripcion=descripcion, ingredientes=list(ingredientes), categoria_id=categoria_id)
+
+
+def test_tokenize_strips_case_and_accents():
+    assert tokenize("Jamón IBÉRICO, con pan") == ["jamon", "iberico", "con", "pan"]
+    assert tokenize(None) == []
+
+
+def test_search_ranks_name_matches_first():
+    index = InvertedIndex()
+    index.build([
+        menu(1, "Ensalada", "con pollo asado"),
+        menu(2, "Pollo asado", "con papas"),
+        menu(3, "Arroz con pollo"),
+        menu(4, "Milanesa"),
+    ])
+
+    assert index.search("pollo") == [2, 3, 1]
+    assert index.search("pollo asado") == [2, 1]
+    assert index.search("pescado") == []
+
+
+def test_search_filters_by_ingredientes_and_categoria():
+    index = InvertedIndex()
+    index.build([
+        menu(1, "Tarta", ingredientes=["harina", "huevo"], categoria_id=1),
+        menu(2, "Tortilla", ingredientes=["huevo", "papa"], categoria_id=2),
+        menu(3, "Omelette", ingredientes=["huevo"], categoria_id=2),
+    ])
+
+    assert index.search(ingredientes=["huevo"]) == [1, 2, 3]
+    assert index.search(ingredientes=["huevo", "papa"]) == [2]
+    assert index.search(ingredientes=["huevo"], categoria_id=2) == [2, 3]
+    assert index.search("tortilla", categoria_id=1) == []
+
+
+def test_add_and_remove_keep_postings_consistent():
+    index = InvertedIndex()
+    index.build([menu(1, "Pollo al horno", ingredientes=["pollo"])])
+
+    index.add(menu(1, "Pescado al horno", ingredientes=["merluza"]))
+    assert index.search("pollo") == []
+    assert index.search("pescado") == [1]
+    assert index.search(ingredientes=["pollo"]) == []
+
+    index.remove(1)
+    assert index.search("horno") == []
+    assert index.search() == []
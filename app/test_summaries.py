@@ -0,0 +1,51 @@
+from datetime import date, timedelta
+
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .models import DbMenu, DbExperiencia, DbExperienciaResumen
+from .summaries import rebuild_summaries, summary_rows
+
+
+def experiencia(usuario_id, menu_id, valencia, arousal, fecha):
+    return {"usuario_id": usuario_id, "menu_id": menu_id, "valencia_resultante": valencia, "arousal_resultante": arousal, "fecha": fecha}
+
+
+def test_summary_rows_fold_per_user_and_menu():
+    rows = summary_rows([
+        experiencia(2, 1, 0.5, 0.1, date(2024, 5, 2)),
+        experiencia(1, 1, 0.2, 0.2, date(2024, 5, 1)),
+        experiencia(2, 1, 0.3, 0.3, date(2024, 5, 1)),
+        experiencia(None, 1, 0.3, 0.3, date(2024, 5, 1)),
+    ])
+
+    assert [(row["usuario_id"], row["menu_id"], row["numero_experiencias"], row["ultima_fecha"]) for row in rows] == [
+        (1, 1, 1, date(2024, 5, 1)),
+        (2, 1, 2, date(2024, 5, 2)),
+    ]
+    assert abs(rows[1]["valencia_total"] - 0.8) < 1e-9
+
+
+def test_rebuild_summaries_from_history():
+    usuario_id = 7001
+    today = date.today()
+    first_day, last_day, other_day = today - timedelta(days=60), today - timedelta(days=5), today - timedelta(days=90)
+    session = SessionLocal()
+    menus = [DbMenu(nombre=f"resumen {i}", categoria_id=7001) for i in range(2)]
+    session.add_all(menus)
+    session.flush()
+    first, second = menus[0].id, menus[1].id
+    session.add_all([
+        DbExperiencia(usuario_id=usuario_id, menu_id=menu_id, valencia_resultante=valencia, arousal_resultante=0.1, fecha=fecha)
+        for menu_id, valencia, fecha in [(first, 0.2, first_day), (first, 0.4, last_day), (second, -0.5, other_day)]
+    ])
+    session.commit()
+
+    assert rebuild_summaries(session) >= 2
+    session.commit()
+
+    resumenes = session.scalars(
+        select(DbExperienciaResumen).filter(DbExperienciaResumen.usuario_id == usuario_id).order_by(DbExperienciaResumen.menu_id)).all()
+    assert [(r.menu_id, r.numero_experiencias, r.ultima_fecha) for r in resumenes] == [(first, 2, last_day), (second, 1, other_day)]
+    assert abs(resumenes[0].valencia_total - 0.6) < 1e-9
+    session.close()
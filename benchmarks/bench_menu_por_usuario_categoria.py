@@ -0,0 +1,132 @@
+"""Latency of /menu_por_usuario_categoria against category size.
+
+Seeds a throwaway category with N menus and one user with a few experiences
+per menu, then times the endpoint against the previous N+1 implementation
+(one session and one join query per plato).
+
+Run from the repository root against the configured database:
+
+    python -m benchmarks.bench_menu_por_usuario_categoria --sizes 10 100 1000
+"""
+import argparse
+import statistics
+import time
+
+from fastapi.testclient import TestClient
+
+from app.database import SessionLocal
+from app.main import app
+from app.models import DbMenu, DbExperiencia, DbExperienciaResumen
+from app.scoring import get_emocion_resultante
+from app.summaries import rebuild_summaries
+
+
+BENCH_CATEGORIA_ID = 999999
+BENCH_USUARIO_ID = 999999
+
+
+def legacy_get_experiencia(usuarioid, categoriaid):
+    list_exp = []
+    db = SessionLocal()
+    platos = db.query(DbMenu).filter(DbMenu.categoria_id == categoriaid).all()
+    db.close()
+
+    for plato in platos:
+        db = SessionLocal()
+        experiencias = db.query(DbExperiencia, DbMenu).join(DbMenu, DbExperiencia.menu_id == DbMenu.id).filter(
+            DbExperiencia.usuario_id == usuarioid).filter(DbExperiencia.menu_id == plato.id).all()
+        db.close()
+        count = 0
+        valencia_res = 0
+        arousal_res = 0
+        for exp, menu in experiencias:
+            valencia_res = valencia_res + exp.valencia_resultante
+            arousal_res = arousal_res + exp.arousal_resultante
+            count = count + 1
+
+        if count > 0:
+            list_exp.append({
+                "id": plato.id,
+                "arousal_resultante": arousal_res / count,
+                "valencia_resultante": valencia_res / count,
+                "emocion_resultante": get_emocion_resultante(valencia_res, arousal_res),
+                "numero_experiencias": count
+            })
+
+    return list_exp
+
+
+def seed(size, experiencias_por_menu):
+    db = SessionLocal()
+    menus = [
+        DbMenu(
+            nombre=f"bench {i}",
+            categoria_id=BENCH_CATEGORIA_ID,
+            descripcion="plato de benchmark",
+            preparacion="preparas el plato",
+            ingredientes=["i1", "i2", "i3"],
+            arousal_resultante=0,
+            valencia_resultante=0,
+            emocion_resultante="comun",
+            numero_experiencias=0
+        ) for i in range(size)
+    ]
+    db.add_all(menus)
+    db.flush()
+    db.add_all([
+        DbExperiencia(
+            usuario_id=BENCH_USUARIO_ID,
+            menu_id=menu.id,
+            valencia_resultante=0.5,
+            arousal_resultante=0.25,
+            emocion_resultante="exquisito"
+        ) for menu in menus for _ in range(experiencias_por_menu)
+    ])
+    # Written behind the service's back, so its summaries are rebuilt
+    rebuild_summaries(db)
+    db.commit()
+    db.close()
+
+
+def cleanup():
+    db = SessionLocal()
+    db.query(DbExperiencia).filter(DbExperiencia.usuario_id == BENCH_USUARIO_ID).delete()
+    db.query(DbExperienciaResumen).filter(DbExperienciaResumen.usuario_id == BENCH_USUARIO_ID).delete()
+    db.query(DbMenu).filter(DbMenu.categoria_id == BENCH_CATEGORIA_ID).delete()
+    db.commit()
+    db.close()
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000])
+    parser.add_argument("--experiencias-por-menu", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    url = f"/menu_por_usuario_categoria?usuarioid={BENCH_USUARIO_ID}&categoriaid={BENCH_CATEGORIA_ID}"
+
+    print(f"{'platos':>8} {'legacy ms':>12} {'aggregated ms':>14} {'speedup':>8}")
+    with TestClient(app) as client:
+        for size in args.sizes:
+            cleanup()
+            seed(size, args.experiencias_por_menu)
+            try:
+                legacy = measure(lambda: legacy_get_experiencia(BENCH_USUARIO_ID, BENCH_CATEGORIA_ID), args.repeat)
+                aggregated = measure(lambda: client.get(url).raise_for_status(), args.repeat)
+            finally:
+                cleanup()
+            print(f"{size:>8} {legacy:>12.1f} {aggregated:>14.1f} {legacy / aggregated:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
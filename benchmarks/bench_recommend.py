@@ -0,0 +1,67 @@
+"""k nearest menus: grid index vs brute force.
+
+Builds the EmotionGrid of app.recommend over N random menu points and times
+k nearest queries against computing every distance with NumPy.
+
+    python -m benchmarks.bench_recommend --sizes 1000 100000 1000000
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.recommend import EmotionGrid
+
+
+def random_menus(size, seed=34):
+    # Most menus gather around mildly positive experiences, some anywhere
+    rng = random.Random(seed)
+    menus = []
+    for id in range(size):
+        if rng.random() < 0.8:
+            valencia, arousal = rng.gauss(0.3, 0.3), rng.gauss(0.2, 0.3)
+        else:
+            valencia, arousal = rng.uniform(-1, 1), rng.uniform(-1, 1)
+        menus.append(SimpleNamespace(id=id, categoria_id=id % 20, valencia_resultante=valencia, arousal_resultante=arousal))
+
+    return menus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    print(f"{'menus':>8} {'build ms':>9} {'grid us':>9} {'numpy us':>9} {'speedup':>8}")
+    for size in args.sizes:
+        menus = random_menus(size)
+        start = time.perf_counter()
+        grid = EmotionGrid()
+        grid.build(menus)
+        build = (time.perf_counter() - start) * 1000
+
+        points = np.array([(m.valencia_resultante, m.arousal_resultante) for m in menus])
+        targets = [(rng.uniform(-1, 1), rng.uniform(-1, 1)) for _ in range(args.queries)]
+
+        start = time.perf_counter()
+        for valencia, arousal in targets:
+            grid.nearest(valencia, arousal, args.k)
+        indexed = (time.perf_counter() - start) / args.queries * 1e6
+
+        start = time.perf_counter()
+        for valencia, arousal in targets:
+            distances = np.hypot(points[:, 0] - valencia, points[:, 1] - arousal)
+            nearest = np.argpartition(distances, args.k)[:args.k]
+            nearest[np.argsort(distances[nearest])]
+        brute = (time.perf_counter() - start) / args.queries * 1e6
+
+        print(f"{size:>8} {build:>9.1f} {indexed:>9.1f} {brute:>9.1f} {brute / indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
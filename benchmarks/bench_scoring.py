@@ -0,0 +1,74 @@
+"""Scalar vs batch emotion scoring.
+
+Scores N random deepface payloads with calculate_valence_arousal and
+get_emocion_resultante one at a time, and with their NumPy batch versions
+from app.scoring.
+
+    python -m benchmarks.bench_scoring --sizes 1 100 10000 100000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from app.scoring import (
+    EMOTIONS, get_emocion_resultante, calculate_valence_arousal, emotion_vector, calculate_valence_arousal_batch,
+    get_emocion_resultante_batch
+)
+
+
+def random_payloads(size, seed=34):
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(size):
+        weights = [rng.random() for _ in EMOTIONS]
+        payloads.append(({e: w * 100 / sum(weights) for e, w in zip(EMOTIONS, weights)}, rng.choice(EMOTIONS)))
+
+    return payloads
+
+
+def score_scalar(payloads):
+    labels = []
+    for emotion, dominant in payloads:
+        # calculate_valence_arousal deletes keys from its argument
+        valence, arousal = calculate_valence_arousal(dict(emotion), dominant)
+        labels.append(get_emocion_resultante(valence, arousal))
+
+    return labels
+
+
+def score_batch(payloads):
+    emotions = np.array([emotion_vector(emotion) for emotion, _ in payloads])
+    dominant = np.array([EMOTIONS.index(d) for _, d in payloads])
+    valence, arousal = calculate_valence_arousal_batch(emotions, dominant)
+    return get_emocion_resultante_batch(valence, arousal).tolist()
+
+
+def best_of(fn, payloads, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(payloads)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'payloads':>10} {'scalar ms':>12} {'batch ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        payloads = random_payloads(size)
+        assert score_scalar(payloads) == score_batch(payloads)
+        scalar = best_of(score_scalar, payloads, args.repeat)
+        batch = best_of(score_batch, payloads, args.repeat)
+        print(f"{size:>10} {scalar:>12.3f} {batch:>10.3f} {scalar / batch:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
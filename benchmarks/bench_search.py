@@ -0,0 +1,132 @@
+"""Latency of /buscar_menus against catalog size.
+
+Seeds a synthetic catalog of N menus (random names, descriptions and
+ingredients from a fixed vocabulary) and times a few searches through the
+endpoint against what clients did before it existed: reading every menu and
+filtering them locally.
+
+Run from the repository root against the configured database:
+
+    python -m benchmarks.bench_search --sizes 1000 10000 100000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, insert, select
+
+from app.database import SessionLocal
+from app.main import app
+from app.models import DbMenu
+from app.search import search_index, tokenize
+
+
+BENCH_CATEGORIA_ID = 999000
+BENCH_CATEGORIAS = 20
+
+PLATOS = ["milanesa", "tarta", "ensalada", "guiso", "risotto", "pizza", "empanada", "sopa", "wok", "lasagna",
+          "tortilla", "hamburguesa", "ravioles", "curry", "pastel", "brochette", "revuelto", "canelones"]
+INGREDIENTES = ["pollo", "carne", "cerdo", "merluza", "salmon", "papa", "batata", "arroz", "queso", "huevo",
+                "tomate", "cebolla", "morron", "zapallo", "espinaca", "hongos", "lentejas", "garbanzos", "jamon", "choclo"]
+ESTILOS = ["casero", "al horno", "grillado", "frito", "al vapor", "picante", "de la abuela", "gratinado"]
+
+SEARCHES = {
+    "text": {"q": "pollo"},
+    "text x2": {"q": "tarta espinaca"},
+    "ingredientes x2": {"ingredientes": ["queso", "huevo"]},
+    "text + categoria": {"q": "guiso", "categoria_id": BENCH_CATEGORIA_ID + 3},
+}
+
+
+def synthetic_menus(size, seed=34):
+    rng = random.Random(seed)
+    menus = []
+    for i in range(size):
+        ingredientes = rng.sample(INGREDIENTES, rng.randint(2, 6))
+        menus.append({
+            "nombre": f"{rng.choice(PLATOS)} de {ingredientes[0]} {rng.choice(ESTILOS)} {i}",
+            "categoria_id": BENCH_CATEGORIA_ID + i % BENCH_CATEGORIAS,
+            "descripcion": f"con {' y '.join(ingredientes[1:3])}, {rng.choice(ESTILOS)}",
+            "preparacion": "preparas el plato",
+            "ingredientes": ingredientes,
+            "arousal_resultante": 0,
+            "valencia_resultante": 0,
+            "emocion_resultante": "comun",
+            "numero_experiencias": 0
+        })
+
+    return menus
+
+
+def seed(size):
+    menus = synthetic_menus(size)
+    with SessionLocal() as db:
+        for start in range(0, len(menus), 10000):
+            db.execute(insert(DbMenu), menus[start:start + 10000])
+        db.commit()
+
+    # Written behind the app's back, rebuild the in-process index on the next search
+    search_index.built = False
+
+
+def cleanup():
+    with SessionLocal() as db:
+        db.execute(delete(DbMenu).where(DbMenu.categoria_id.between(BENCH_CATEGORIA_ID, BENCH_CATEGORIA_ID + BENCH_CATEGORIAS)))
+        db.commit()
+
+    search_index.built = False
+
+
+def scan(q=None, ingredientes=(), categoria_id=None):
+    # Read the whole catalog and filter it locally, as clients did with /menus
+    with SessionLocal() as db:
+        menus = db.scalars(select(DbMenu)).all()
+
+    terms = set(tokenize(q))
+    return [
+        menu for menu in menus
+        if terms <= set(tokenize(menu.nombre)) | set(tokenize(menu.descripcion))
+        and set(ingredientes) <= set(menu.ingredientes or [])
+        and (categoria_id is None or menu.categoria_id == categoria_id)
+    ]
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'menus':>8} {'search':>18} {'matches':>8} {'scan ms':>10} {'endpoint ms':>12} {'speedup':>8}")
+    with TestClient(app) as client:
+        for size in args.sizes:
+            cleanup()
+            seed(size)
+            try:
+                # The first search pays for building the in-process index on SQLite
+                start = time.perf_counter()
+                client.get("/buscar_menus", params={"q": "warmup"}).raise_for_status()
+                print(f"{size:>8} {'first search':>18} {'':>8} {'':>10} {(time.perf_counter() - start) * 1000:>12.1f}")
+
+                for name, params in SEARCHES.items():
+                    matches = client.get("/buscar_menus", params=params).json()["total"]
+                    scanned = measure(lambda: scan(**params), args.repeat)
+                    endpoint = measure(lambda: client.get("/buscar_menus", params=params).raise_for_status(), args.repeat)
+                    print(f"{size:>8} {name:>18} {matches:>8} {scanned:>10.1f} {endpoint:>12.1f} {scanned / endpoint:>7.1f}x")
+            finally:
+                cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""CPU time per /menus page: ORM objects and pydantic models vs result tuples.
+
+Seeds a throwaway category with N menus and builds a page of each size the
+way get_menus used to (DbMenu objects, an ExistingMenu per row, a
+MenuListResponse rendered by JSONResponse) and the way it does now (dicts
+from the selected columns, rendered by ORJSONResponse), with every column
+and with a `fields=nombre` projection. Times are process CPU time, the
+query included.
+
+    python -m benchmarks.bench_serialization --sizes 10 100 1000
+"""
+import argparse
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy import delete, insert, select
+
+from app.database import SessionLocal
+from app.main import MENU_COLUMNS, MenuListResponse, existing_menu
+from app.models import DbMenu
+
+
+BENCH_CATEGORIA_ID = 980000
+
+
+def seed(size):
+    with SessionLocal() as db:
+        db.execute(insert(DbMenu), [
+            {
+                "nombre": f"plato {i}",
+                "categoria_id": BENCH_CATEGORIA_ID,
+                "descripcion": "plato de benchmark con una descripcion de largo habitual",
+                "preparacion": "preparas el plato siguiendo los pasos de la receta",
+                "ingredientes": ["harina", "huevo", "queso", "tomate"],
+                "arousal_resultante": 0.25,
+                "valencia_resultante": 0.5,
+                "emocion_resultante": "exquisito",
+                "numero_experiencias": 12
+            } for i in range(size)
+        ])
+        db.commit()
+
+
+def cleanup():
+    with SessionLocal() as db:
+        db.execute(delete(DbMenu).where(DbMenu.categoria_id == BENCH_CATEGORIA_ID))
+        db.commit()
+
+
+def orm_page(db, size):
+    menus = [existing_menu(m) for m in db.scalars(
+        select(DbMenu).filter(DbMenu.categoria_id == BENCH_CATEGORIA_ID).order_by(DbMenu.id).limit(size))]
+    response = MenuListResponse(menus=menus, total=size, page=1, per_page=size, next_cursor=None)
+    # What FastAPI does with a returned model when the route has no response_model
+    return JSONResponse(jsonable_encoder(response)).body
+
+
+def tuple_page(db, size, names):
+    statement = (
+        select(*[MENU_COLUMNS[name] for name in names])
+        .filter(DbMenu.categoria_id == BENCH_CATEGORIA_ID).order_by(DbMenu.id).limit(size)
+    )
+    menus = [dict(zip(names, row)) for row in db.execute(statement)]
+    return ORJSONResponse({"menus": menus, "total": size, "page": 1, "per_page": size, "next_cursor": None}).body
+
+
+def cpu_ms(fn, repeat):
+    # Best of `repeat` runs, each in its own session as a request would be
+    timings = []
+    for _ in range(repeat):
+        with SessionLocal() as db:
+            start = time.process_time()
+            fn(db)
+            timings.append(time.process_time() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    cleanup()
+    seed(max(args.sizes))
+    try:
+        print(f"{'page':>6} {'orm ms':>8} {'tuples ms':>10} {'nombre ms':>10} {'speedup':>8}")
+        for size in args.sizes:
+            orm = cpu_ms(lambda db: orm_page(db, size), args.repeat)
+            tuples = cpu_ms(lambda db: tuple_page(db, size, list(MENU_COLUMNS)), args.repeat)
+            nombre = cpu_ms(lambda db: tuple_page(db, size, ["id", "nombre"]), args.repeat)
+            print(f"{size:>6} {orm:>8.2f} {tuples:>10.2f} {nombre:>10.2f} {orm / tuples:>7.1f}x")
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
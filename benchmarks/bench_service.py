@@ -0,0 +1,267 @@
+"""Latency and throughput of the main endpoints over a large synthetic catalog.
+
+Seeds the configured database with a catalog of menus spread over a range of
+throwaway categories and a history of experiencias from many users, then
+sends every scenario `--requests` times through the app from `--concurrency`
+threads and reports p50/p99 latency and requests per second. The scorers
+behind POST /experiencia are timed on their own too. Results are written to
+benchmarks/results/<commit>.json, `--compare` prints the change against an
+earlier file. The seeded rows are deleted at the end unless `--keep`.
+
+    python -m benchmarks.bench_service --menus 10000 --experiencias 200000
+    python -m benchmarks.bench_service --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, insert, select
+
+from app.database import SessionLocal, engine, DATABASE_ASYNC
+from app.main import app
+from app.models import DbMenu, DbExperiencia, DbExperienciaDiaria, DbExperienciaResumen
+from app.recompute import recompute_menu_aggregates
+from app.retention import create_partitions, is_partitioned
+from app.rollups import rebuild_rollups
+from app.scoring import EMOTIONS, calculate_valence_arousal, get_emocion_resultante
+from app.summaries import rebuild_summaries
+from benchmarks.bench_scoring import random_payloads
+
+
+BENCH_CATEGORIA_ID = 990000
+BENCH_USUARIO_ID = 990000
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+INSERT_CHUNK_SIZE = 10000
+
+
+def seed(menus, categorias, usuarios, experiencias, dias, rng):
+    """Inserts the catalog and the history behind the service's back and
+    rebuilds what the routes would have kept: summaries, rollups and menu
+    aggregates. Returns the ids of the seeded menus."""
+    hoy = date.today()
+    desde = hoy - timedelta(days=dias - 1)
+    with SessionLocal() as db:
+        if is_partitioned(db.connection()):
+            create_partitions(db.connection(), desde, hoy)
+
+        ids = list(db.scalars(
+            insert(DbMenu).returning(DbMenu.id, sort_by_parameter_order=True),
+            [
+                {
+                    "nombre": f"plato {i}",
+                    "categoria_id": BENCH_CATEGORIA_ID + i % categorias,
+                    "descripcion": "plato de benchmark",
+                    "preparacion": "preparas el plato",
+                    "ingredientes": ["i1", "i2", "i3"],
+                    "arousal_resultante": 0,
+                    "valencia_resultante": 0,
+                    "emocion_resultante": "comun",
+                    "numero_experiencias": 0
+                } for i in range(menus)
+            ]
+        ))
+
+        for start in range(0, experiencias, INSERT_CHUNK_SIZE):
+            rows = []
+            for _ in range(min(INSERT_CHUNK_SIZE, experiencias - start)):
+                valencia, arousal = rng.uniform(-1, 1), rng.uniform(-1, 1)
+                rows.append({
+                    "usuario_id": BENCH_USUARIO_ID + rng.randrange(usuarios),
+                    "menu_id": rng.choice(ids),
+                    "fecha": desde + timedelta(days=rng.randrange(dias)),
+                    "valencia_resultante": valencia,
+                    "arousal_resultante": arousal,
+                    "emocion_resultante": get_emocion_resultante(valencia, arousal),
+                    "api": "sam"
+                })
+            db.execute(insert(DbExperiencia), rows)
+
+        rebuild_summaries(db)
+        rebuild_rollups(db, desde)
+        db.commit()
+        recompute_menu_aggregates(db)
+        db.commit()
+
+    return ids
+
+
+def cleanup():
+    # Experiencias, summaries and rollups first, they keep their menus from being deleted
+    with SessionLocal() as db:
+        menu_ids = select(DbMenu.id).where(DbMenu.categoria_id >= BENCH_CATEGORIA_ID)
+        for model in (DbExperiencia, DbExperienciaResumen, DbExperienciaDiaria):
+            db.execute(delete(model).where(model.menu_id.in_(menu_ids)))
+        db.execute(delete(DbMenu).where(DbMenu.categoria_id >= BENCH_CATEGORIA_ID))
+        db.commit()
+
+
+def experiencia_payload(rng, menu_ids, usuarios):
+    emotion = {e: w for e, w in zip(EMOTIONS, [rng.random() * 100 for _ in EMOTIONS])}
+    deepface = {"emotion": emotion, "dominant_emotion": max(emotion, key=emotion.get)}
+    return {
+        "usuario_id": BENCH_USUARIO_ID + rng.randrange(usuarios),
+        "menu_id": rng.choice(menu_ids),
+        "emocion_menu": deepface,
+        "emocion_plato": deepface,
+        "sam_valencia": rng.uniform(-1, 1),
+        "sam_arousal": rng.uniform(-1, 1),
+        "api": "deepface"
+    }
+
+
+def scenarios(menu_ids, categorias, usuarios, rng):
+    """{name: function sending one request}, each picking its own random
+    arguments so cached and uncached reads mix as in production."""
+    def categoria():
+        return BENCH_CATEGORIA_ID + rng.randrange(categorias)
+
+    return {
+        "GET /menus": lambda client: client.get("/menus", params={"limit": 20}),
+        "GET /menus/{id}": lambda client: client.get(f"/menus/{rng.choice(menu_ids)}"),
+        "GET /menus/lote": lambda client: client.get("/menus/lote", params={"ids": rng.sample(menu_ids, 20)}),
+        "POST /experiencia": lambda client: client.post("/experiencia", json=experiencia_payload(rng, menu_ids, usuarios)),
+        "GET /menu_por_categorias": lambda client: client.get("/menu_por_categorias", params={"categoria2": categoria()}),
+        "GET /menu_por_usuario_categoria": lambda client: client.get("/menu_por_usuario_categoria", params={
+            "usuarioid": BENCH_USUARIO_ID + rng.randrange(usuarios), "categoriaid": categoria()}),
+    }
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    return sorted_values[max(0, -(-len(sorted_values) * p // 100) - 1)]
+
+
+def run_scenario(client, send, requests, concurrency, warmup):
+    def timed(_):
+        start = time.perf_counter()
+        response = send(client)
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        return elapsed
+
+    for _ in range(warmup):
+        timed(None)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        timings = sorted(executor.map(timed, range(requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        "requests": requests,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "rps": requests / wall
+    }
+
+
+def micro_benchmarks(size, repeat):
+    # Nanoseconds per call, best of `repeat` runs over the same payloads
+    payloads = random_payloads(size)
+    points = [(random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(size)]
+
+    def best(fn):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return min(timings) / size * 1e9
+
+    return {
+        # calculate_valence_arousal deletes keys from its argument, copying it is part of the cost
+        "calculate_valence_arousal_ns": best(lambda: [calculate_valence_arousal(dict(e), d) for e, d in payloads]),
+        "get_emocion_resultante_ns": best(lambda: [get_emocion_resultante(v, a) for v, a in points]),
+    }
+
+
+def commit():
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return head + ("-dirty" if dirty else "")
+
+
+def print_results(results, previous=None):
+    endpoints = results["endpoints"]
+    before = (previous or {}).get("endpoints", {})
+
+    print(f"{'scenario':<32} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'vs p50':>8} {'vs req/s':>9}")
+    for name, values in endpoints.items():
+        line = f"{name:<32} {values['p50_ms']:>8.2f} {values['p99_ms']:>8.2f} {values['rps']:>8.1f}"
+        if name in before:
+            line += f" {values['p50_ms'] / before[name]['p50_ms'] - 1:>+8.0%} {values['rps'] / before[name]['rps'] - 1:>+9.0%}"
+        print(line)
+
+    for name, value in results["micro"].items():
+        line = f"{name:<32} {value:>8.0f}"
+        if name in (previous or {}).get("micro", {}):
+            line += f" {value / previous['micro'][name] - 1:>+17.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--menus", type=int, default=10000)
+    parser.add_argument("--categorias", type=int, default=50)
+    parser.add_argument("--usuarios", type=int, default=1000)
+    parser.add_argument("--experiencias", type=int, default=200000)
+    parser.add_argument("--dias", type=int, default=90, help="days of history the experiencias are spread over")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--micro-size", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=34)
+    parser.add_argument("--output", type=Path, help="results file, benchmarks/results/<commit>.json by default")
+    parser.add_argument("--compare", type=Path, help="earlier results file to compare with")
+    parser.add_argument("--keep", action="store_true", help="leave the seeded rows in the database")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cleanup()
+    start = time.perf_counter()
+    menu_ids = seed(args.menus, args.categorias, args.usuarios, args.experiencias, args.dias, rng)
+    print(f"Seeded {args.menus} menus and {args.experiencias} experiencias in {time.perf_counter() - start:.1f}s")
+
+    results = {
+        "commit": commit(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "database": engine.dialect.name,
+        "async": DATABASE_ASYNC,
+        "python": platform.python_version(),
+        "parametros": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+        "endpoints": {},
+        "micro": micro_benchmarks(args.micro_size, args.repeat)
+    }
+    try:
+        with TestClient(app) as client:
+            for name, send in scenarios(menu_ids, args.categorias, args.usuarios, rng).items():
+                results["endpoints"][name] = run_scenario(client, send, args.requests, args.concurrency, args.warmup)
+    finally:
+        if not args.keep:
+            cleanup()
+
+    output = args.output or RESULTS_DIR / f"{results['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+
+    print_results(results, json.loads(args.compare.read_text()) if args.compare else None)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()